@@ -130,6 +130,53 @@ let digest_options = [
   (["-d"; "--digest"],    0, i_ "print the digest",         new no_arg `ShowDigest);
 ]
 
+let digest_cache_options = [
+  ([      "--cache"],     0, i_ "reuse digests of unchanged files from previous runs", new no_arg `UseDigestCache);
+]
+
+let verify_options = [
+  ([      "--fast"],      0, i_ "stop at the first difference from the .manifest", new no_arg `FastVerify);
+  ([      "--sample"],    1, i_ "only hash this percentage of the files",          new one_arg Number @@ fun p -> `SampleVerify p);
+]
+
+let max_age_option =
+  ([      "--max-age"],   1, i_ "age limit, in days",                             new one_arg Number @@ fun n -> `MaxAge n)
+
+let jobs_option =
+  ([      "--jobs"],      1, i_ "number of implementations to process in parallel", new one_arg Number @@ fun n -> `AuditJobs n)
+
+let audit_options = [
+  jobs_option;
+  ([      "--json"],      0, i_ "print the result for each implementation as JSON", new no_arg `ShowJSON);
+  ([      "--resume"],    0, i_ "continue an interrupted audit",                  new no_arg `ResumeAudit);
+  ([      "--incremental"], 0, i_ "skip implementations which haven't changed since they last verified", new no_arg `IncrementalAudit);
+  max_age_option;
+]
+
+let optimise_options = [
+  ([      "--full"],      0, i_ "forget previous runs and check every implementation", new no_arg `FullOptimise);
+  ([      "--mode"],      1, i_ "share duplicates using hard-links or reflinks",  new one_arg LinkMode @@ fun m -> `OptimiseMode m);
+]
+
+(* (--max-age is in audit_options) *)
+let gc_options = [
+  ([      "--max-size"],  1, i_ "remove old implementations until the cache is this size", new one_arg Size @@ fun s -> `MaxSize s);
+  ([      "--force"],     0, i_ "allow collecting a cache other than your own",     new no_arg `ForceGC);
+]
+
+let add_options = [
+  ([      "--link"],      0, i_ "share the files' data with the directory using reflinks (copy-on-write)", new no_arg `LinkSource);
+]
+
+(* (--jobs is in audit_options) *)
+let add_batch_options = [
+  ([      "--max-tmp"],   1, i_ "limit on the temporary space used for unpacking", new one_arg Size @@ fun s -> `MaxTmp s);
+]
+
+let store_list_options = [
+  ([      "--usage"],     0, i_ "show the size and last use of each implementation", new no_arg `ShowUsage);
+]
+
 let xml_output = [
   (["--xml"], 0, i_ "print selections as XML", new no_arg `ShowXML);
 ]
@@ -165,7 +212,7 @@ let show_version_options : (_, _) opt_spec list = [
 ]
 
 let spec : (_, zi_arg_type) argparse_spec = {
-  options_spec = generic_select_options @ offline_options @ digest_options @
+  options_spec = generic_select_options @ offline_options @ digest_options @ digest_cache_options @ verify_options @ audit_options @ optimise_options @ gc_options @ add_options @ add_batch_options @ store_list_options @
                  xml_output @ diff_options @ download_options @ show_options @
                  run_options @ show_version_options @ common_options;
   no_more_options = function
@@ -227,14 +274,16 @@ let make_subgroup name subcommands =
   (name, Subgroup subcommands)
 
 let store_subcommands : subgroup = [
-  make_subcommand "add"       "DIGEST (DIRECTORY | (ARCHIVE [EXTRACT]))"   handle_store @@ common_options;
-  make_subcommand "audit"     "[DIRECTORY]"                                handle_store @@ common_options;
+  make_subcommand "add"       "[--link] DIGEST (DIRECTORY | (ARCHIVE [EXTRACT]))" handle_store @@ common_options @ add_options;
+  make_subcommand "add-batch" "[--jobs=N] [--max-tmp=SIZE] LIST"            handle_store @@ common_options @ add_batch_options @ [jobs_option];
+  make_subcommand "audit"     "[--jobs=N] [--json] [--resume] [--incremental [--max-age=DAYS]] [DIRECTORY]" handle_store @@ common_options @ audit_options;
   make_subcommand "copy"      "SOURCE [ TARGET ]"                          handle_store @@ common_options;
   make_subcommand "find"      "DIGEST"                                     handle_store @@ common_options;
-  make_subcommand "list"      ""                                           handle_store @@ common_options;
-  make_subcommand "manifest"  "DIRECTORY [ALGORITHM]"                      handle_store @@ common_options;
-  make_subcommand "optimise"  "[ CACHE ]"                                  handle_store @@ common_options;
-  make_subcommand "verify"    "(DIGEST | (DIRECTORY [DIGEST])"             handle_store @@ common_options;
+  make_subcommand "gc"        "[--max-size=SIZE] [--max-age=DAYS] [--force] [DIRECTORY]" handle_store @@ common_options @ gc_options @ [max_age_option];
+  make_subcommand "list"      "[--usage]"                                  handle_store @@ common_options @ store_list_options;
+  make_subcommand "manifest"  "DIRECTORY [ALGORITHM]"                      handle_store @@ common_options @ digest_cache_options;
+  make_subcommand "optimise"  "[--full] [--mode=MODE] [ CACHE ]"           handle_store @@ common_options @ optimise_options;
+  make_subcommand "verify"    "[--fast | --sample=PCT] (DIGEST | (DIRECTORY [DIGEST])" handle_store @@ common_options @ verify_options;
   make_subcommand "manage"    ""                                           Manage_cache.handle @@ common_options;
 ]
 
@@ -257,7 +306,7 @@ let subcommands: subgroup = [
   make_subcommand "remove-feed" "[INTERFACE] FEED"              Remove_feed.handle @@ common_options @ offline_options;
   make_subcommand "list-feeds"  "URI"                           List_feeds.handle @@ common_options;
   make_subcommand "man"         "NAME"                          Man.handle        @@ common_options;
-  make_subcommand "digest"      "DIRECTORY | ARCHIVE [EXTRACT]" fallback_handler  @@ common_options @ digest_options;
+  make_subcommand "digest"      "DIRECTORY | ARCHIVE [EXTRACT]" fallback_handler  @@ common_options @ digest_options @ digest_cache_options;
   make_subcommand "_show_help"  "-"                             Desktop.handle_help @@ common_options @ generic_select_options;
   make_subcommand "_desktop"    "-"                             Desktop.handle    @@ common_options;
   make_subgroup   "store"       store_subcommands;
@@ -18,6 +18,9 @@ let format_type = function
   | OsType -> "OS"
   | Message -> "STRING"
   | HashType -> "ALG"
+  | Number -> "N"
+  | LinkMode -> "MODE"
+  | Size -> "SIZE"
   | IfaceURI -> "URI"
 
 let add_store settings store =
@@ -184,6 +184,7 @@ let complete_arg config (completer:completer) pre = function
   | ["show"] -> completer#add_apps pre; completer#add_files pre
   | ["store"; "add"] -> complete_digest completer pre ~value:true
   | ["store"; "add"; _] -> completer#add_files pre
+  | ["store"; "add-batch"] -> completer#add_files pre
   | ["store"; "copy"] -> completer#add_files pre
   | ["store"; "copy"; _] -> completer#add_files pre
   | ["store"; "optimise"] -> completer#add_files pre
@@ -326,7 +327,8 @@ let complete_option_value (completer:completer) args (_, handler, values, carg)
   )
   | CpuType -> complete_from_list ["src"; "i386"; "i486"; "i586"; "i686"; "ppc"; "ppc64"; "x86_64"]
   | OsType -> complete_from_list ["Cygwin"; "Darwin"; "FreeBSD"; "Linux"; "MacOSX"; "Windows"]
-  | Message -> ()
+  | Message | Number | Size -> ()
+  | LinkMode -> complete_from_list ["auto"; "hardlink"; "reflink"]
   | HashType -> complete_from_list @@ Zeroinstall.Manifest.get_algorithm_names ()
   | IfaceURI -> (
       match args with
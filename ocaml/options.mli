@@ -55,6 +55,27 @@ type zi_option = [
   | `UseHash of string
   | `ShowManifest
   | `ShowDigest
+  | `UseDigestCache
+
+  | `FastVerify
+  | `SampleVerify of string
+
+  | `AuditJobs of string
+  | `ShowJSON
+  | `ResumeAudit
+  | `IncrementalAudit
+  | `MaxAge of string
+
+  | `FullOptimise
+  | `OptimiseMode of string
+
+  | `MaxSize of string
+  | `ForceGC
+
+  | `ShowUsage
+
+  | `LinkSource
+  | `MaxTmp of string
 
   | `MainExecutable of string
   | `Wrapper of string
@@ -79,4 +100,7 @@ type zi_arg_type =
   | CpuType | OsType
   | Message
   | HashType
+  | Number
+  | LinkMode
+  | Size
   | IfaceURI
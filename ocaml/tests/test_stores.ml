@@ -31,7 +31,10 @@ let suite = "stores">::: [
   "check-type">:: (fun () ->
     let system = (new Fake_system.fake_system None :> system) in
     Fake_system.assert_raises_safe
-      "This package looks like a zip-compressed archive, but you don't have the \"unzip\" command I need to extract it. \
-       Install the package containing it first." (lazy (Archive.check_type_ok system "application/zip"))
+      "This package looks like a Microsoft Cabinet archive, but you don't have the \"cabextract\" command I need to extract it. \
+       Install the package containing it first." (lazy (Archive.check_type_ok system "application/vnd.ms-cab-compressed"));
+    (* Zip files and Debian packages are read in-process, so no tools are needed *)
+    Archive.check_type_ok system "application/zip";
+    Archive.check_type_ok system "application/x-deb";
   );
 ]
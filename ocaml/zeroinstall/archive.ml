@@ -38,14 +38,9 @@ let check_type_ok system =
         raise_safe "This package looks like an RPM, but you don't have the rpm2cpio command \
                     I need to extract it. Install the \"rpm\" package first (this works even if \
                     you're on a non-RPM-based distribution such as Debian)."
-    | "application/x-deb" -> if missing "ar" then
-        raise_safe "This package looks like a Debian package, but you don't have the \"ar\" command \
-                     I need to extract it. Install the package containing it (sometimes called \"binutils\") \
-                     first. This works even if you're on a non-Debian-based distribution such as Red Hat)."
+    | "application/x-deb" -> ()  (* The Python slave reads the ar archive itself *)
     | "application/x-bzip-compressed-tar" -> ()	(* We"ll fall back to Python"s built-in tar.bz2 support *)
-    | "application/zip" -> if missing "unzip" then
-        raise_safe "This package looks like a zip-compressed archive, but you don't have the \"unzip\" command \
-                    I need to extract it. Install the package containing it first."
+    | "application/zip" -> ()   (* The Python slave extracts it with zipfile *)
     | "application/vnd.ms-cab-compressed" -> if missing "cabextract" then
         raise_safe "This package looks like a Microsoft Cabinet archive, but you don't have the \"cabextract\" command \
                     I need to extract it. Install the package containing it first."
@@ -116,6 +116,11 @@ let make_selection_map system stores sels =
 let get_exec_args config ?main sels args =
   let env = Env.copy_current_env config.system in
   let impls = make_selection_map config.system config.stores sels in
+  Stores.record_usage config (StringMap.fold (fun _iface (sel, path) acc ->
+    match Selections.make_selection sel, path with
+    | Selections.CacheSelection _, Some path -> path :: acc
+    | _ -> acc
+  ) impls []);
   let bindings = Binding.collect_bindings impls sels in
   let launcher_builder = get_launcher_builder config in
 
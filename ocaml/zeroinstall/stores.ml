@@ -41,6 +41,20 @@ let lookup_any system digests stores =
       let str_stores = String.concat ", " stores in
       raise (Not_stored ("Item with digests " ^ str_digests ^ " not found in stores. Searched " ^ str_stores))
 
+(** Note that these implementations were used, for "0store gc" and "0store list --usage".
+    We append to the same log as zerostore/usage.py, in a single write. Errors are logged but otherwise ignored. *)
+let record_usage config paths =
+  if paths <> [] && not config.dry_run then (
+    try
+      let dir = Support.Basedir.save_path config.system (config_site +/ config_prog) config.basedirs.Support.Basedir.cache in
+      let now = Int64.of_float config.system#time in
+      let data = paths |> List.map (fun path -> Printf.sprintf "%Ld %s\n" now (Filename.basename path)) |> String.concat "" in
+      config.system#with_open_out [Open_wronly; Open_append; Open_creat] 0o644 (dir +/ "usage-log") (fun ch ->
+        output_string ch data
+      )
+    with Safe_exception _ | Unix.Unix_error _ as ex -> log_info ~ex "Failed to update usage log"
+  )
+
 let get_default_stores basedir_config =
   let open Support.Basedir in
   List.map (fun prefix -> prefix +/ "0install.net" +/ "implementations") basedir_config.cache
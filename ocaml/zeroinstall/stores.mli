@@ -17,6 +17,9 @@ val lookup_maybe : system -> digest list -> stores -> filepath option
 val lookup_any : system -> digest list -> stores -> string
 val get_default_stores : Support.Basedir.basedirs -> stores
 
+(** Append the implementations in these directories to the usage log (unless in dry-run mode). *)
+val record_usage : General.config -> filepath list -> unit
+
 (** Scan all the stores and build a set of the available digests. This can be used
     later to quickly test whether a digest is in the cache. *)
 val get_available_digests : system -> stores -> available_digests
@@ -22,6 +22,7 @@ sys.path.insert(0, '..')
 from zeroinstall.injector import qdom, background, namespaces
 from zeroinstall.injector import iface_cache, download, distro, model, handler, reader, trust
 from zeroinstall.zerostore import NotStored, Store, Stores; Store._add_with_helper = lambda *unused, **kwargs: False
+from zeroinstall.zerostore import usage
 from zeroinstall import support, cmd
 from zeroinstall.support import basedir, tasks
 
@@ -173,6 +174,9 @@ class TestStores:
 				return '/fake_store/' + d
 		return None
 
+	def lookup_many(self, digests):
+		return dict((d, '/fake_store/' + d) for d in digests if d in self.fake_impls)
+
 	def lookup_any(self, digests):
 		path = self.lookup_maybe(digests)
 		if path:
@@ -231,6 +235,7 @@ class BaseTest(unittest.TestCase):
 		logging.getLogger().setLevel(logging.WARN)
 
 		download._downloads = {}
+		usage._log = None
 
 		self.old_path = os.environ['PATH']
 		os.environ['PATH'] = self.config_home + ':' + dpkgdir + ':' + self.old_path
@@ -236,6 +236,10 @@ class TestInstall(BaseTest):
 		out, err = self.run_0install(['digest', tmp])
 		assert out == 'sha1new=da39a3ee5e6b4b0d3255bfef95601890afd80709\n', out
 		assert not err, err
+
+		out, err = self.run_0install(['digest', '--cache', tmp])
+		assert out == 'sha1new=da39a3ee5e6b4b0d3255bfef95601890afd80709\n', out
+		assert not err, err
 		os.rmdir(tmp)
 	
 	def check_man(self, args, expected):
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from basetest import BaseTest, skipIf
-import sys, tempfile, os, shutil
+import sys, tempfile, os, shutil, time
 import unittest
 
 sys.path.insert(0, '..')
@@ -121,6 +121,251 @@ class TestManifest(BaseTest):
 			b'F 5f1ff6172591102593950d1ae6c4a78709b1c44c 1377477018 14 file']],
 			list(manifest.generate_manifest(self.tmpdir, alg='sha1new')))
 
+	def testBlockBoundaries(self):
+		import hashlib
+		path = os.path.join(self.tmpdir, 'data')
+		for size in [0, 1, 99, 100, 101, 250, 1000]:
+			data = os.urandom(size)
+			with open(path, 'wb') as stream:
+				stream.write(data)
+			expected = hashlib.sha256(data).hexdigest()
+			for block_size in [1, 100, None]:
+				self.assertEqual(expected, manifest._digest_file(hashlib.sha256(), path, block_size).hexdigest())
+
+	@skipIf(not sys.platform.startswith('linux'), "needs sparse files and getrusage in KB")
+	def testLargeFileMemory(self):
+		import resource
+		size = 2 * 1024 * 1024 * 1024
+		path = os.path.join(self.tmpdir, 'sparse')
+		with open(path, 'wb') as stream:
+			stream.seek(size - 1)
+			stream.write(b'\0')
+		os.utime(path, (10, 10))
+
+		# ru_maxrss is the peak RSS so far (in KB on Linux)
+		before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		lines = list(manifest.generate_manifest(self.tmpdir, alg = 'sha1new'))
+		after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+		self.assertEqual(['F 91d50642dd930e9542c39d36f0516d45f4e1af0d 10 %d sparse' % size], lines)
+		assert after - before < 64 * 1024, (before, after)
+
+	def testParallel(self):
+		for d in range(5):
+			subdir = os.path.join(self.tmpdir, 'dir%d' % d)
+			os.mkdir(subdir)
+			os.symlink('file0', os.path.join(subdir, 'link'))
+			for f in range(20):
+				myfile = self.write('dir%d/file%d' % (d, f), 'data %d' % (d * f) * f, 10 + f)
+				if f % 3 == 0:
+					os.chmod(myfile, 0o755)
+		for alg_name in ['sha1', 'sha1new', 'sha256new']:
+			alg = manifest.get_algorithm(alg_name)
+			serial = list(alg.generate_manifest(self.tmpdir, jobs = 1))
+			self.assertEqual(5 * 22, len(serial))
+			self.assertEqual(serial, list(alg.generate_manifest(self.tmpdir, jobs = 4)))
+
+		# Stopping early must not hang
+		lines = alg.generate_manifest(self.tmpdir, jobs = 3)
+		self.assertEqual(serial[0], next(lines))
+		lines.close()
+
+	def testDefaultJobs(self):
+		old = os.environ.get('ZEROINSTALL_MANIFEST_JOBS')
+		try:
+			os.environ['ZEROINSTALL_MANIFEST_JOBS'] = '6'
+			self.assertEqual(6, manifest.default_jobs())
+			os.environ['ZEROINSTALL_MANIFEST_JOBS'] = '0'
+			assert manifest.default_jobs() >= 1
+			del os.environ['ZEROINSTALL_MANIFEST_JOBS']
+			self.assertEqual(1, manifest.default_jobs())
+		finally:
+			if old is not None:
+				os.environ['ZEROINSTALL_MANIFEST_JOBS'] = old
+			elif 'ZEROINSTALL_MANIFEST_JOBS' in os.environ:
+				del os.environ['ZEROINSTALL_MANIFEST_JOBS']
+
+	def testMetadataCalls(self):
+		# Count the metadata system calls made per item, using the listdir/lstat
+		# fallback so that every call goes through the os module.
+		from zeroinstall import support
+		for d in range(3):
+			os.mkdir(os.path.join(self.tmpdir, 'dir%d' % d))
+			os.symlink('file0', os.path.join(self.tmpdir, 'dir%d' % d, 'link'))
+			for f in range(4):
+				self.write('dir%d/file%d' % (d, f), 'data', 10)
+		n_items = 3 * (1 + 1 + 4)
+
+		calls = {'lstat': 0, 'stat': 0, 'chmod': 0}
+		real = dict((name, getattr(os, name)) for name in calls)
+		def counter(name):
+			def wrapper(*args, **kwargs):
+				calls[name] += 1
+				return real[name](*args, **kwargs)
+			return wrapper
+		old_scandir = support._scandir
+		support._scandir = None
+		for name in calls:
+			setattr(os, name, counter(name))
+		try:
+			lines = list(manifest.get_algorithm('sha256new').generate_manifest(self.tmpdir, jobs = 1))
+			self.assertEqual(n_items, len(lines))
+			self.assertEqual(1 + n_items, calls['lstat'] + calls['stat'])
+
+			manifest.fixup_permissions(self.tmpdir)
+			assert calls['chmod'] > 0
+
+			# Nothing to change the second time
+			for name in calls: calls[name] = 0
+			manifest.fixup_permissions(self.tmpdir)
+			self.assertEqual(0, calls['chmod'])
+			self.assertEqual(1 + n_items, calls['lstat'] + calls['stat'])
+		finally:
+			support._scandir = old_scandir
+			for name in calls:
+				setattr(os, name, real[name])
+
+	def testDigestCache(self):
+		from zeroinstall.zerostore import digestcache
+		tree = os.path.join(self.tmpdir, 'tree')
+		os.mkdir(tree)
+		for f in range(4):
+			self.write('tree/file%d' % f, 'data %d' % f, 10)
+		cache_file = os.path.join(self.tmpdir, 'cache')
+		alg = manifest.get_algorithm('sha256new')
+		expected = list(alg.generate_manifest(tree))
+
+		real_digest_file = manifest._digest_file
+		hashed = []
+		def digest_file(digest, path, *args):
+			hashed.append(os.path.basename(path))
+			return real_digest_file(digest, path, *args)
+		def generate(jobs = 1, max_entries = digestcache.MAX_ENTRIES):
+			del hashed[:]
+			cache = digestcache.DigestCache(cache_file, max_entries)
+			manifest._digest_file = digest_file
+			try:
+				lines = list(alg.generate_manifest(tree, jobs = jobs, cache = cache))
+			finally:
+				manifest._digest_file = real_digest_file
+			cache.save()
+			self.assertEqual(expected, lines)
+			return sorted(hashed)
+
+		self.assertEqual(['file0', 'file1', 'file2', 'file3'], generate())
+		self.assertEqual([], generate())
+		self.assertEqual([], generate(jobs = 3))
+
+		# A changed file is hashed again
+		self.write('tree/file1', 'changed', 10)
+		expected = list(alg.generate_manifest(tree))
+		self.assertEqual(['file1'], generate())
+
+		# An in-place rewrite which restores the size and mtime is detected too (the ctime changes)
+		info = os.stat(os.path.join(tree, 'file3'))
+		time.sleep(0.01)
+		self.write('tree/file3', 'data X', 10)
+		self.assertEqual(info.st_mtime, os.stat(os.path.join(tree, 'file3')).st_mtime)
+		expected = list(alg.generate_manifest(tree))
+		self.assertEqual(['file3'], generate())
+
+		# Recently-modified files aren't cached, as they may change again without the mtime changing
+		self.write('tree/file2', 'new data')
+		expected = list(alg.generate_manifest(tree))
+		self.assertEqual(['file2'], generate())
+		self.assertEqual(['file2'], generate())
+
+		# Only the most recently used entries are kept
+		generate(max_entries = 2)
+		self.assertEqual(['file0', 'file2'], generate())
+
+		# A corrupted cache is ignored
+		with open(cache_file, 'w') as stream:
+			stream.write('Garbage')
+		self.assertEqual(['file0', 'file1', 'file2', 'file3'], generate())
+
+	def testIndex(self):
+		from zeroinstall.zerostore import manifestindex
+		impl = os.path.join(self.tmpdir, 'impl')
+		mydir = os.path.join(impl, 'MyDir')
+		os.makedirs(mydir)
+		self.write('impl/MyDir/Hello', 'Hello World', 30)
+		myexec = self.write('impl/MyDir/Run me', 'Bang!', 40)
+		os.symlink('Hello', os.path.join(mydir, 'Sym link'))
+		os.chmod(myexec, 0o700)
+		self.write('impl/top', 'Top', 10)
+		os.utime(mydir, (10, 20))
+
+		index_path = os.path.join(self.tmpdir, '.index', 'impl')
+		self.assertEqual(index_path, manifestindex.get_index_path(impl + '/'))
+		for alg_name in ['sha1', 'sha1new', 'sha256new']:
+			alg = manifest.get_algorithm(alg_name)
+			expected = list(alg.generate_manifest(impl))
+			digest = alg.getID(manifest.add_manifest_file(impl, alg))
+			manifestindex.write_index(impl)
+			assert os.path.exists(index_path)
+
+			# The index is kept outside the implementation
+			self.assertEqual(['.manifest', 'MyDir', 'top'], sorted(os.listdir(impl)))
+			manifest.verify(impl, digest)
+
+			with open(os.path.join(impl, '.manifest'), 'rb') as stream:
+				data = stream.read().decode('utf-8')
+			if alg_name == 'sha1':
+				data = data.replace('D 20 /', 'D /')	# _parse_manifest doesn't support the old format
+			parsed = manifest._parse_manifest(data)
+			with manifestindex.load(impl) as index:
+				entries = list(index)
+				self.assertEqual(len(expected), len(index))
+				self.assertEqual(11 + 5 + 3, index.total_size())
+			self.assertEqual(sorted(parsed.keys()), sorted(path for itype, digest, mtime, size, path in entries))
+			for itype, digest, mtime, size, path in entries:
+				details = parsed[path]
+				self.assertEqual(details[0], itype)
+				if itype in 'FX':
+					self.assertEqual(details[1:], [digest, str(mtime), str(size)])
+				elif itype == 'S':
+					self.assertEqual(details[1:], [digest, str(size)])
+			self.assertEqual([line[0] for line in expected], [entry[0] for entry in entries])
+
+			# A missing index is rebuilt
+			manifestindex.remove_index(impl)
+			manifestindex.remove_index(impl)		# Already gone; not an error
+			with manifestindex.load(impl) as index:
+				self.assertEqual(entries, list(index))
+			assert not os.path.exists(index_path)
+			with manifestindex.load(impl, save = True) as index:
+				self.assertEqual(entries, list(index))
+			assert os.path.exists(index_path)
+
+			# A corrupted index is ignored
+			with open(index_path, 'wb') as stream:
+				stream.write(b'0IDX' + b'\xff' * 100)
+			with manifestindex.load(impl) as index:
+				self.assertEqual(entries, list(index))
+
+			os.chmod(impl, 0o755)
+			os.unlink(os.path.join(impl, '.manifest'))
+
+		# A failed rebuild doesn't leave the old index behind
+		with open(os.path.join(impl, '.manifest'), 'w') as stream:
+			stream.write('Garbage\n')
+		try:
+			manifestindex.write_index(impl)
+			assert 0
+		except BadDigest:
+			pass
+		assert not os.path.exists(index_path)
+
+		# A file called .manifest.idx is part of the implementation like any other
+		os.unlink(os.path.join(impl, '.manifest'))
+		alg = manifest.get_algorithm('sha256new')
+		before = list(alg.generate_manifest(impl))
+		self.write('impl/.manifest.idx', 'Not an index')
+		after = list(alg.generate_manifest(impl))
+		self.assertEqual(len(before) + 1, len(after))
+		assert after[0].endswith(' 12 .manifest.idx'), after
+
 	def testParseManifest(self):
 		self.assertEqual({}, manifest._parse_manifest(''))
 		parsed = manifest._parse_manifest('F e3d5983c3dfd415af24772b48276d16122fe5a87 1172429666 2980 README\n'
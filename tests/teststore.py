@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from basetest import BaseTest, StringIO
-import sys, tempfile, os
+import sys, tempfile, os, shutil
 import unittest
 import logging
 
@@ -136,10 +136,10 @@ class TestStore(BaseTest):
 		cached = sys.stdout.getvalue().strip()
 		assert cached == cli.stores.lookup(digest)
 
-		for alg in [[], ['sha1new']]:
+		for args in [[cached], [cached, 'sha1new'], ['--cache', cached]]:
 			sys.stdout = StringIO()
 			try:
-				cli.do_manifest([cached] + alg)
+				cli.do_manifest(args)
 				assert False
 			except SystemExit as ex:
 				assert ex.code == 0
@@ -147,6 +147,12 @@ class TestStore(BaseTest):
 			assert 'MyFile' in result
 			assert result.split('\n')[-2] == digest
 
+		try:
+			cli.do_manifest(['--bad-option', cached])
+			assert False
+		except cli.UsageError:
+			pass
+
 		# Verify...
 		sys.stdout = StringIO()
 		cli.do_verify([cached, digest])
@@ -181,6 +187,292 @@ class TestStore(BaseTest):
 			sys.stdout = old_stdout
 			assert 'Cached item does NOT verify' in result
 
+	def testAddLink(self):
+		from zeroinstall.zerostore import fastcopy
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		digest = 'sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a'
+		cli.init_stores()
+		cli.stores.stores = [self.store]
+
+		try:
+			cli.do_add(['--link', digest, os.path.join(mydir, 'HelloWorld.tgz')])
+			assert False
+		except cli.UsageError:
+			pass
+
+		# Files copied through userspace are hashed as they're copied, not read again
+		real_kernel_copy = fastcopy.kernel_copy
+		real_digest_file = manifest._digest_file
+		hashed = []
+		def digest_file(digest, path, block_size = None):
+			hashed.append(path)
+			return real_digest_file(digest, path, block_size)
+		fastcopy.kernel_copy = lambda src_fd, dst_fd, allowed = None: None
+		manifest._digest_file = digest_file
+		try:
+			logger.setLevel(logging.ERROR)
+			try:
+				cli.do_add([digest.replace('7e', '7f'), sample])
+				assert False
+			except BadDigest:
+				pass
+			finally:
+				logger.setLevel(logging.WARN)
+			cli.do_add([digest, sample])
+		finally:
+			fastcopy.kernel_copy = real_kernel_copy
+			manifest._digest_file = real_digest_file
+		self.assertEqual([], hashed)
+		cached = cli.stores.lookup_any([digest])
+		manifest.verify(cached, digest)
+		assert os.stat(os.path.join(sample, 'MyFile')).st_ino != os.stat(os.path.join(cached, 'MyFile')).st_ino
+		support.ro_rmtree(cached)
+
+		# With --link, the data is only shared using reflinks, never hard-links, so changing the
+		# source later can't change the store
+		os.chmod(os.path.join(sample, 'MyFile'), 0o644)
+		os.chmod(os.path.join(sample, 'My Dir', '!a file!'), 0o444)
+		logger.setLevel(logging.ERROR)
+		try:
+			cli.do_add(['--link', digest, sample])
+		finally:
+			logger.setLevel(logging.WARN)
+		cached = cli.stores.lookup_any([digest])
+		manifest.verify(cached, digest)
+		for name, mode in [('MyFile', 0o644), ('My Dir/!a file!', 0o444), ('My Dir/!a file!.exe', 0o500)]:
+			src = os.stat(os.path.join(sample, name))
+			self.assertNotEqual(src.st_ino, os.stat(os.path.join(cached, name)).st_ino)
+			self.assertEqual(mode, src.st_mode & 0o777)
+		support.ro_rmtree(cached)
+
+		# If the file-system can't reflink, the files are copied and we get a warning
+		tried = []
+		warned = []
+		class Capture(logging.Handler):
+			def emit(self, record):
+				warned.append(record.getMessage())
+		def kernel_copy(src_fd, dst_fd, allowed = None):
+			tried.append(allowed)
+			return None
+		capture = Capture()
+		logger.addHandler(capture)
+		logger.propagate = False
+		fastcopy.kernel_copy = kernel_copy
+		try:
+			cli.do_add(['--link', digest, sample])
+		finally:
+			fastcopy.kernel_copy = real_kernel_copy
+			logger.removeHandler(capture)
+			logger.propagate = True
+		manifest.verify(cli.stores.lookup_any([digest]), digest)
+		assert tried and all(allowed == ['reflink'] for allowed in tried), tried
+		assert any("Can't reflink the files in" in msg for msg in warned), warned
+
+	def testVerifyFast(self):
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		for alg_name in ['sha1', 'sha256new']:
+			alg = manifest.get_algorithm(alg_name)
+			digest = alg.getID(manifest.add_manifest_file(sample, alg))
+			for mode in [{'fast': True}, {'sample': 0}, {'sample': 50}, {'sample': 100}]:
+				manifest.verify(sample, digest, **mode)
+
+			# Changed contents (same size and mtime) are found if the file is hashed
+			subfile = os.path.join(sample, 'My Dir', '!a file!')
+			os.chmod(subfile, 0o644)
+			with open(subfile, 'w') as stream:
+				stream.write('Some dat!.')
+			os.utime(subfile, (1, 2))
+			manifest.verify(sample, digest, sample = 0)
+			for mode in [{'fast': True}, {'sample': 100}]:
+				try:
+					manifest.verify(sample, digest, **mode)
+					assert False
+				except BadDigest as ex:
+					assert "-F 0236ef92e1e37c57f0eb161e7e2f8b6a8face705 2 10 !a file!\n+F" in ex.detail or alg_name != 'sha1', ex.detail
+					assert ' 2 10 !a file!' in ex.detail, ex.detail
+
+			with open(subfile, 'w') as stream:
+				stream.write('Some data.')
+			os.utime(subfile, (1, 2))
+			os.chmod(subfile, 0o444)
+
+			# Extra files are always found, and the first difference is reported
+			os.chmod(sample, 0o755)
+			open(os.path.join(sample, 'zzz'), 'w').close()
+			for mode in [{'fast': True}, {'sample': 0}]:
+				try:
+					manifest.verify(sample, digest, **mode)
+					assert False
+				except BadDigest as ex:
+					assert '\n+F da39a3ee5e6b4b0d3255bfef95601890afd80709 ' in ex.detail or alg_name != 'sha1', ex.detail
+					assert ' zzz\n' in ex.detail, ex.detail
+
+			# Without a matching .manifest, we fall back to a full check
+			os.unlink(os.path.join(sample, 'zzz'))
+			os.unlink(os.path.join(sample, '.manifest'))
+			for mode in [{'fast': True}, {'sample': 0}]:
+				try:
+					manifest.verify(sample, digest, **mode)
+					assert False
+				except BadDigest as ex:
+					assert ' Actual: ' + digest in ex.detail, ex.detail
+					assert 'No .manifest' in ex.detail, ex.detail
+
+		# Command-line interface
+		alg = manifest.get_algorithm('sha256new')
+		digest = alg.getID(manifest.add_manifest_file(sample, alg))
+		old_stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			cli.do_verify(['--fast', sample, digest])
+			cli.do_verify(['--sample=10', sample, digest])
+			for bad in [['--sample=101', sample], ['--sample=x', sample]]:
+				try:
+					cli.do_verify(bad)
+					assert False
+				except cli.UsageError:
+					pass
+		finally:
+			sys.stdout = old_stdout
+
+	def testAudit(self):
+		import json
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		digests = []
+		for alg_name in ['sha1new', 'sha256new']:
+			alg = manifest.get_algorithm(alg_name)
+			digest = alg.new_digest()
+			for line in alg.generate_manifest(sample):
+				digest.update((line + '\n').encode('utf-8'))
+			digest = alg.getID(digest)
+			self.store.add_dir_to_cache(digest, sample, try_helper = False)
+			digests.append(digest)
+		os.mkdir(os.path.join(self.store.dir, 'tmp-other'))
+
+		def audit(args):
+			old_stdout = sys.stdout
+			sys.stdout = StringIO()
+			try:
+				cli.do_audit(args + [self.store.dir])
+				code = 0
+			except SystemExit as ex:
+				code = ex.code
+			finally:
+				output = sys.stdout.getvalue()
+				sys.stdout = old_stdout
+			return code, output
+
+		def json_results(output):
+			return dict((result['digest'], result) for result in map(json.loads, output.strip().split('\n')))
+
+		for jobs in ['1', '2']:
+			code, output = audit(['--jobs', jobs, '--json'])
+			self.assertEqual(0, code)
+			results = json_results(output)
+			self.assertEqual(sorted(digests), sorted(results))
+			for digest in digests:
+				result = results[digest]
+				self.assertEqual('ok', result['status'])
+				self.assertEqual(os.path.join(self.store.dir, digest), result['path'])
+				self.assertEqual(5 + 10 + 10, result['bytes'])
+				assert result['seconds'] >= 0
+
+		# Corrupt one
+		corrupted = self.store.lookup(digests[1])
+		os.chmod(corrupted, 0o755)
+		open(os.path.join(corrupted, 'hacked'), 'w').close()
+		code, output = audit(['--jobs=2', '--json'])
+		self.assertEqual(1, code)
+		results = json_results(output)
+		self.assertEqual('ok', results[digests[0]]['status'])
+		self.assertEqual('failed', results[digests[1]]['status'])
+		assert 'hacked' in results[digests[1]]['detail']
+		self.assertEqual(None, results[digests[1]]['bytes'])
+
+		code, output = audit([])
+		self.assertEqual(1, code)
+		assert 'Corrupted or modified implementations: 1' in output, output
+		assert 'Skipping non-implementation directory' in output, output
+
+		# Resume an interrupted audit, which had already checked the corrupted item
+		checkpoint = cli._audit_checkpoint_path([self.store.dir])
+		assert not os.path.exists(checkpoint)
+		self.assertNotEqual(checkpoint, cli._audit_checkpoint_path([self.store.dir, self.tmp]))
+		self.assertEqual(cli._audit_checkpoint_path([self.tmp, self.store.dir]), cli._audit_checkpoint_path([self.store.dir, self.tmp]))
+		with open(checkpoint, 'w') as stream:
+			stream.write(json.dumps({'dirs': [self.store.dir]}) + '\n')
+			stream.write(json.dumps({'path': corrupted, 'digest': digests[1], 'status': 'ok', 'seconds': 0, 'bytes': 0}) + '\n')
+			stream.write('{"path": "incomplete')
+		code, output = audit(['--resume'])
+		self.assertEqual(0, code)
+		assert 'Resuming: 1 items already checked' in output, output
+		assert 'Successfully verified implementations: 2' in output, output
+		assert not os.path.exists(checkpoint)
+
+		# Nothing to resume, so start again
+		code, output = audit(['--resume'])
+		self.assertEqual(1, code)
+
+	def testAuditIncremental(self):
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		digest = 'sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a'
+		self.store.add_dir_to_cache(digest, sample, try_helper = False)
+		impl = self.store.lookup(digest)
+
+		verified = []
+		real_verify = cli.verify
+		def verify(path, required_digest):
+			verified.append(required_digest)
+			real_verify(path, required_digest)
+
+		def audit(args):
+			del verified[:]
+			old_stdout = sys.stdout
+			sys.stdout = StringIO()
+			cli.verify = verify
+			try:
+				cli.do_audit(args + [self.store.dir])
+				code = 0
+			except SystemExit as ex:
+				code = ex.code
+			finally:
+				output = sys.stdout.getvalue()
+				sys.stdout = old_stdout
+				cli.verify = real_verify
+			return code, output
+
+		self.assertEqual((0, [digest]), (audit(['--incremental'])[0], verified))
+
+		code, output = audit(['--incremental'])
+		self.assertEqual((0, []), (code, verified))
+		assert 'Unchanged since last verified: 1' in output, output
+
+		# Too old
+		self.assertEqual((0, [digest]), (audit(['--incremental', '--max-age=0'])[0], verified))
+
+		# A full audit checks everything
+		self.assertEqual((0, [digest]), (audit([])[0], verified))
+
+		# Modified (even though the size and mtime are the same)
+		subfile = os.path.join(impl, 'My Dir', '!a file!')
+		os.chmod(os.path.dirname(subfile), 0o755)
+		os.chmod(subfile, 0o644)
+		with open(subfile, 'w') as stream:
+			stream.write('Some dat!.')
+		os.utime(subfile, (1, 2))
+		os.chmod(subfile, 0o444)
+		os.chmod(os.path.dirname(subfile), 0o555)
+		self.assertEqual((1, [digest]), (audit(['--incremental'])[0], verified))
+		self.assertEqual((1, [digest]), (audit(['--incremental'])[0], verified))
+
 	def testList(self):
 		cli.init_stores()
 
@@ -204,7 +496,12 @@ class TestStore(BaseTest):
 
 		cli.do_add([digest, os.path.join(mydir, 'HelloWorld.tgz')])
 		cli.do_add([digest, os.path.join(mydir, 'HelloWorld.tgz')])
-		cli.stores.lookup(digest)
+		path = cli.stores.lookup(digest)
+
+		# The index is written next to the implementation, not inside it
+		from zeroinstall.zerostore import manifestindex
+		assert os.path.isfile(os.path.join(os.path.dirname(path), manifestindex.INDEX_DIR, digest))
+		assert not os.path.exists(os.path.join(path, '.manifest.idx'))
 
 	def testAddArchiveExtract(self):
 		cli.init_stores()
@@ -219,6 +516,76 @@ class TestStore(BaseTest):
 		cli.do_add([digest, os.path.join(mydir, 'HelloWorld.tgz'), 'HelloWorld'])
 		cli.stores.lookup(digest)
 
+	def testAddBatch(self):
+		from zeroinstall.zerostore import batch
+		whole = 'sha1new=290eb133e146635fe37713fd58174324a16d595f'
+		sub = 'sha1new=491678c37f77fadafbaae66b13d48d237773a68f'
+		shutil.copy(os.path.join(mydir, 'HelloWorld.tgz'), os.path.join(self.tmp, 'Hello World.tgz'))
+		list_path = os.path.join(self.tmp, 'archives.list')
+		with open(list_path, 'w') as stream:
+			stream.write('# Test archives\n'
+				     '%s "Hello World.tgz"\n'
+				     '\n'
+				     '%s "Hello World.tgz" HelloWorld application/x-compressed-tar\n'
+				     '%s "Hello World.tgz" - # Again\n'
+				     'sha1new=0000000000000000000000000000000000000000 "Hello World.tgz"\n'
+				     'sha1new=1111111111111111111111111111111111111111 missing.tgz\n' % (whole, sub, whole))
+
+		items = batch.read_list(open(list_path), self.tmp)
+		self.assertEqual(5, len(items))
+		self.assertEqual(os.path.join(self.tmp, 'Hello World.tgz'), items[0].archive)
+		self.assertEqual((None, None), (items[0].extract, items[0].type))
+		self.assertEqual(('HelloWorld', 'application/x-compressed-tar'), (items[1].extract, items[1].type))
+		self.assertEqual(None, items[2].extract)
+
+		for bad in ['sha1new=123\n', 'foo archive.tgz\n', '"unterminated\n']:
+			try:
+				batch.read_list(StringIO(bad), self.tmp)
+				assert False, bad
+			except SafeException as ex:
+				assert 'line 1' in str(ex).lower(), ex
+
+		for jobs in [1, 2]:
+			cli.stores = None
+			cli.init_stores()
+			cli.stores.stores = [Store(os.path.join(self.tmp, 'store-%d' % jobs))]
+			old_stdout, old_stderr = sys.stdout, sys.stderr
+			sys.stdout = StringIO()
+			sys.stderr = StringIO()
+			logger.setLevel(logging.ERROR)
+			try:
+				cli.do_add_batch(['--jobs=%d' % jobs, '--max-tmp=1', list_path])
+				assert False
+			except SystemExit as ex:
+				self.assertEqual(1, ex.code)
+				out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+			finally:
+				sys.stdout, sys.stderr = old_stdout, old_stderr
+				logger.setLevel(logging.WARN)
+			self.assertEqual('Added 2, already stored 1, failed 2\n', out)
+			assert 'Failed to add sha1new=0000000000000000000000000000000000000000' in err, err
+			assert 'missing.tgz' in err, err
+			cli.stores.lookup_any([whole])
+			cli.stores.lookup_any([sub])
+
+		# A worker which dies is reported as a failure, rather than waited for forever
+		real_add_item = batch._add_item
+		def add_item(stores, item):
+			if item.archive.endswith('missing.tgz'):
+				os._exit(1)
+			return real_add_item(stores, item)
+		batch._add_item = add_item
+		try:
+			cli.stores.stores = [Store(os.path.join(self.tmp, 'store-dead'))]
+			results = list(batch.add_batch(cli.stores, items, jobs = 2, max_tmp = 1))
+		finally:
+			batch._add_item = real_add_item
+		self.assertEqual(5, len(results))
+		dead, = [result for result in results if result['archive'].endswith('missing.tgz')]
+		self.assertEqual('failed', dead['status'])
+		assert 'exited unexpectedly' in dead['error'], dead
+		self.assertEqual(['added', 'added', 'failed', 'failed', 'present'], sorted(result['status'] for result in results))
+
 	def testOptimise(self):
 		sample = os.path.join(self.tmp, 'sample')
 		os.mkdir(sample)
@@ -255,7 +622,8 @@ class TestStore(BaseTest):
 			got = sys.stdout.getvalue()
 		finally:
 			sys.stdout = old_stdout
-		assert 'Space freed up : 15 bytes' in got
+		assert 'Space freed up : 15 bytes' in got, got
+		assert 'Scanned size   : 85 bytes' in got, got
 
 		old_stdout = sys.stdout
 		sys.stdout = StringIO()
@@ -265,10 +633,640 @@ class TestStore(BaseTest):
 		finally:
 			sys.stdout = old_stdout
 		assert 'No duplicates found; no changes made.' in got
+		assert 'Skipping 2 implementations already optimised (use --full to include them)' in got, got
+		assert 'Scanned size   : 0 bytes' in got, got
 
 		assert same_inode('My Dir/!a file!')
 		assert not same_inode('My Dir/!a file!.exe')
-	
+
+	def testOptimiseIncremental(self):
+		from zeroinstall.zerostore import optimise, manifestindex
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		self.store.add_dir_to_cache('sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a',
+					   sample,
+					   try_helper = False)
+		impl_a = self.store.lookup('sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a')
+
+		loaded = []
+		real_load = manifestindex.load
+		def load(impl_dir, save = False):
+			loaded.append(os.path.basename(impl_dir))
+			return real_load(impl_dir, save)
+
+		def run(full = False):
+			del loaded[:]
+			old_stdout = sys.stdout
+			sys.stdout = StringIO()
+			try:
+				return optimise.optimise(self.store.dir, full = full)
+			finally:
+				sys.stdout = old_stdout
+
+		manifestindex.load = load
+		try:
+			uniq, dup, already, man_size = run()
+			assert dup == 0
+			self.assertEqual(['sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a'], loaded)
+
+			# Nothing new
+			self.assertEqual((0, 0, 0, 0), run())
+			self.assertEqual([], loaded)
+
+			# Only the new implementation is read, but it is still linked to the old one
+			subfile = os.path.join(sample, 'My Dir', '!a file!.exe')
+			mtime = os.stat(subfile).st_mtime
+			os.chmod(subfile, 0o755)
+			with open(subfile, 'w') as stream:
+				stream.write('Extra!\n')
+			os.utime(subfile, (mtime, mtime))
+			self.store.add_dir_to_cache('sha1new=40861a33dba4e7c26d37505bd9693511808c0c35',
+						   sample,
+						   try_helper = False)
+			impl_b = self.store.lookup('sha1new=40861a33dba4e7c26d37505bd9693511808c0c35')
+
+			uniq, dup, already, man_size = run()
+			self.assertEqual(15, dup)
+			self.assertEqual(['sha1new=40861a33dba4e7c26d37505bd9693511808c0c35'], loaded)
+			a_info = os.lstat(os.path.join(impl_a, 'My Dir', '!a file!'))
+			b_info = os.lstat(os.path.join(impl_b, 'My Dir', '!a file!'))
+			self.assertEqual(a_info.st_ino, b_info.st_ino)
+
+			# --full reads everything again
+			uniq, dup, already, man_size = run(full = True)
+			self.assertEqual(0, dup)
+			self.assertEqual(15, already)
+			self.assertEqual(2, len(loaded))
+
+			# Removed implementations are forgotten
+			support.ro_rmtree(impl_a)
+			run()
+			self.assertEqual([], loaded)
+			index = optimise.DedupIndex(self.store.dir)
+			try:
+				self.assertEqual(['sha1new=40861a33dba4e7c26d37505bd9693511808c0c35'], list(index.get_impls()))
+				self.assertEqual((0,), index.db.execute("SELECT COUNT(*) FROM files WHERE impl = ?",
+						('sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a',)).fetchone())
+			finally:
+				index.close()
+		finally:
+			manifestindex.load = real_load
+
+	def make_synthetic_impls(self, n_impls, mtime = lambda i: 1000):
+		"""Create n_impls implementations in the store with the same files (4 directories of 25
+		files each), but not linked. Returns the total size of the files in each one."""
+		sha256new = manifest.get_algorithm('sha256new')
+		for i in range(n_impls):
+			impl = os.path.join(self.store.dir, 'sha256new_%d' % i)
+			for d in range(4):
+				subdir = os.path.join(impl, 'dir%d' % d)
+				os.makedirs(subdir)
+				for f in range(25):
+					path = os.path.join(subdir, 'file%d' % f)
+					with open(path, 'w') as stream:
+						stream.write('data %d %d\n' % (d, f) * (f + 1))
+					os.utime(path, (mtime(i), mtime(i)))
+				os.chmod(subdir, 0o555)
+			manifest.add_manifest_file(impl, sha256new)
+		return sum(len('data %d %d\n' % (d, f)) * (f + 1) for d in range(4) for f in range(25))
+
+	def testOptimiseMany(self):
+		# A synthetic cache with many copies of the same files. Set $OPTIMISE_BENCHMARK to
+		# the number of implementations to create to use this as a benchmark.
+		import time
+		from zeroinstall.zerostore import optimise
+		n_impls = int(os.environ.get('OPTIMISE_BENCHMARK', 10))
+		file_sizes = self.make_synthetic_impls(n_impls)
+
+		chmodded = []
+		real_chmod = os.chmod
+		def chmod(path, mode):
+			chmodded.append(path)
+			real_chmod(path, mode)
+		os.chmod = chmod
+		old_stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			start = time.time()
+			uniq, dup, already, man_size = optimise.optimise(self.store.dir, jobs = 4)
+			logging.info("Optimised %d implementations in %.2f s", n_impls, time.time() - start)
+		finally:
+			sys.stdout = old_stdout
+			os.chmod = real_chmod
+
+		self.assertEqual(file_sizes, uniq)
+		self.assertEqual(file_sizes * (n_impls - 1), dup)
+		self.assertEqual(0, already)
+
+		# Each directory is only made writable (and restored) once
+		self.assertEqual(2 * 4 * (n_impls - 1), len(chmodded))
+		self.assertEqual(len(chmodded), 2 * len(set(chmodded)))
+
+		first = os.stat(os.path.join(self.store.dir, 'sha256new_0', 'dir3', 'file7'))
+		last = os.stat(os.path.join(self.store.dir, 'sha256new_%d' % (n_impls - 1), 'dir3', 'file7'))
+		self.assertEqual(first.st_ino, last.st_ino)
+		self.assertEqual(n_impls, first.st_nlink)
+		self.assertEqual(0o555, os.stat(os.path.join(self.store.dir, 'sha256new_1', 'dir3')).st_mode & 0o777)
+
+	def testOptimiseReflink(self):
+		import fcntl, struct, array
+		from zeroinstall.zerostore import optimise, fastcopy
+		file_sizes = self.make_synthetic_impls(3, mtime = lambda i: 1000 + i)
+
+		# Pretend the file-system supports FIDEDUPERANGE, deduping at most 16 bytes per call
+		deduped = []
+		real_ioctl = fcntl.ioctl
+		def ioctl(fd, request, arg, mutate = False):
+			if request != fastcopy._FIDEDUPERANGE:
+				return real_ioctl(fd, request, arg, mutate)
+			offset, length, count, r1, r2, dst_fd, dst_offset, done, status, r3 = struct.unpack_from('=QQHHIqQQiI', arg)
+			assert count == 1 and offset == dst_offset
+			length = min(length, 16)
+			def read(fd):
+				os.lseek(fd, offset, 0)
+				return os.read(fd, length)
+			if read(fd) == read(dst_fd):
+				deduped.append(os.fstat(dst_fd).st_ino)
+				status = 0
+			else:
+				length, status = 0, 1
+			arg[:] = array.array('B', struct.pack('=QQHHIqQQiI', offset, length, count, 0, 0, dst_fd, dst_offset, length, status, 0))
+			return 0
+
+		output = []
+		def run(mode, full = False):
+			old_stdout = sys.stdout
+			sys.stdout = StringIO()
+			try:
+				return optimise.optimise(self.store.dir, mode = mode, full = full), sys.stdout.getvalue()
+			finally:
+				output[:] = [sys.stdout.getvalue()]
+				sys.stdout = old_stdout
+
+		# Nothing can be hard-linked, as the mtimes differ
+		(uniq, dup, already, man_size), out = run('hardlink')
+		self.assertEqual(0, dup)
+
+		fcntl.ioctl = ioctl
+		try:
+			(uniq, dup, already, man_size), out = run('auto')
+			assert 'Using reflink mode' in out, out
+		finally:
+			fcntl.ioctl = real_ioctl
+		self.assertEqual(file_sizes, uniq)
+		self.assertEqual(file_sizes * 2, dup)
+		self.assertEqual(0, already)
+
+		# The files are still separate, with their own mtimes
+		path = os.path.join('dir3', 'file7')
+		infos = [os.stat(os.path.join(self.store.dir, 'sha256new_%d' % i, path)) for i in range(3)]
+		self.assertEqual([1000, 1001, 1002], [int(info.st_mtime) for info in infos])
+		self.assertEqual(3, len(set(info.st_ino for info in infos)))
+		self.assertEqual(1, infos[1].st_nlink)
+		assert infos[1].st_ino in deduped
+		assert infos[0].st_ino not in deduped
+
+		# An explicit reflink mode fails if the file-system can't do it
+		if not optimise._reflink_supported(self.store.dir):
+			try:
+				run('reflink', full = True)
+				assert 0
+			except SafeException as ex:
+				assert '--mode=hardlink' in str(ex), ex
+			assert 'Reading manifests...' in output[0], output
+			assert 'Using reflink mode' not in output[0], output
+
+	def testPool(self):
+		from zeroinstall.zerostore import pool
+		os.mkdir(self.store.dir + '.pool')
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		self.store.add_dir_to_cache('sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a', sample, try_helper = False)
+		impl_a = self.store.lookup('sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a')
+
+		def pool_files(pool_dir):
+			return sorted(name for dirpath, dirnames, filenames in os.walk(pool_dir) for name in filenames)
+		self.assertEqual(3, len(pool_files(self.store.dir + '.pool')))
+		self.assertEqual(2, os.stat(os.path.join(impl_a, 'MyFile')).st_nlink)
+
+		# Unchanged files in a new implementation come from the pool
+		subfile = os.path.join(sample, 'My Dir', '!a file!.exe')
+		mtime = os.stat(subfile).st_mtime
+		os.chmod(subfile, 0o755)
+		with open(subfile, 'w') as stream:
+			stream.write('Extra!\n')
+		os.utime(subfile, (mtime, mtime))
+		self.store.add_dir_to_cache('sha1new=40861a33dba4e7c26d37505bd9693511808c0c35', sample, try_helper = False)
+		impl_b = self.store.lookup('sha1new=40861a33dba4e7c26d37505bd9693511808c0c35')
+		self.assertEqual(4, len(pool_files(self.store.dir + '.pool')))
+
+		def same_inode(name):
+			return os.lstat(os.path.join(impl_a, name)).st_ino == os.lstat(os.path.join(impl_b, name)).st_ino
+		assert same_inode('MyFile')
+		assert same_inode('My Dir/!a file!')
+		assert not same_inode('My Dir/!a file!.exe')
+		manifest.verify(impl_b)
+
+		# copy_tree_with_verify doesn't read files it can take from the pool
+		target = os.path.join(self.tmp, 'implementations')
+		os.mkdir(target)
+		os.mkdir(target + '.pool')
+		for impl in [impl_a, impl_b]:
+			with open(os.path.join(impl, '.manifest'), 'rb') as stream:
+				manifest_data = stream.read()
+			real_copy_with_verify = manifest.copy_with_verify
+			copied = []
+			def copy_with_verify(src, *args):
+				copied.append(os.path.basename(src))
+				return real_copy_with_verify(src, *args)
+			manifest.copy_with_verify = copy_with_verify
+			try:
+				manifest.copy_tree_with_verify(impl, target, manifest_data, os.path.basename(impl))
+			finally:
+				manifest.copy_with_verify = real_copy_with_verify
+		self.assertEqual(['!a file!.exe'], copied)
+		copy_b = os.path.join(target, os.path.basename(impl_b))
+		manifest.verify(copy_b)
+		self.assertEqual(3, os.stat(os.path.join(copy_b, 'MyFile')).st_nlink)
+
+		# Files no longer used are removed from the pool
+		support.ro_rmtree(copy_b)
+		self.assertEqual(len('Extra!\n'), pool.for_store(target).purge())
+		support.ro_rmtree(os.path.join(target, os.path.basename(impl_a)))
+		self.assertEqual(5 + 10 + 10, pool.for_store(target).purge())
+		self.assertEqual([], pool_files(target + '.pool'))
+
+		# A pool file which has been modified isn't used
+		object_pool = pool.for_store(target)
+		impl_a_manifest = os.path.join(impl_a, '.manifest')
+		with open(impl_a_manifest, 'rb') as stream:
+			manifest_data = stream.read()
+		manifest.copy_tree_with_verify(impl_a, target, manifest_data, os.path.basename(impl_a))
+		support.ro_rmtree(os.path.join(target, os.path.basename(impl_a)))
+		alg = manifest.get_algorithm('sha1new')
+		with open(os.path.join(impl_a, 'MyFile'), 'rb') as stream:
+			digest = alg.new_digest()
+			digest.update(stream.read())
+		pool_path = object_pool.get_path(alg, digest.hexdigest())
+		info = os.stat(pool_path)
+		os.chmod(pool_path, 0o644)
+		with open(pool_path, 'r+b') as stream:
+			stream.write(b'X')
+		os.chmod(pool_path, info.st_mode)
+		os.utime(pool_path, (info.st_mtime, info.st_mtime))
+		logger.setLevel(logging.ERROR)
+		try:
+			manifest.copy_tree_with_verify(impl_a, target, manifest_data, os.path.basename(impl_a))
+		finally:
+			logger.setLevel(logging.WARN)
+		copy_a = os.path.join(target, os.path.basename(impl_a))
+		manifest.verify(copy_a)
+		# The bad pool file was replaced by the good copy
+		self.assertEqual(os.stat(pool_path).st_ino, os.stat(os.path.join(copy_a, 'MyFile')).st_ino)
+
+	def testLookupMany(self):
+		from zeroinstall.zerostore import Stores
+		other = Store(os.path.join(self.tmp, 'other'))
+		stores = Stores()
+		stores.stores = [self.store, other, Store(os.path.join(self.tmp, 'missing'))]
+		os.mkdir(other.dir)
+		os.mkdir(os.path.join(self.store.dir, 'sha256new_A'))
+		os.mkdir(os.path.join(other.dir, 'sha256new_A'))
+		os.mkdir(os.path.join(other.dir, 'sha256new_B'))
+		for store in stores.stores[:2]:
+			os.utime(store.dir, (1000, 1000))
+
+		self.assertEqual({'sha256new_A': os.path.join(self.store.dir, 'sha256new_A'),
+				  'sha256new_B': os.path.join(other.dir, 'sha256new_B')},
+				stores.lookup_many(['sha256new_A', 'sha256new_B', 'sha256new_C']))
+		self.assertEqual(os.path.join(other.dir, 'sha256new_B'), stores.lookup_maybe(['sha256new_C', 'sha256new_B']))
+		self.assertEqual(None, stores.lookup_maybe(['sha256new_C']))
+		try:
+			stores.lookup_many(['sha256new_A', 'sha256new_../C'])
+			assert 0
+		except BadDigest:
+			pass
+
+		# Looking up a single item is just a check for its directory
+		uncached = Store(other.dir)
+		real_listdir, real_stat = os.listdir, os.stat
+		checked = []
+		def listdir(path):
+			assert 0, path
+		def stat(path):
+			checked.append(path)
+			return real_stat(path)
+		os.listdir, os.stat = listdir, stat
+		try:
+			self.assertEqual(os.path.join(other.dir, 'sha256new_B'), uncached.lookup('sha256new_B'))
+			self.assertEqual({}, uncached.lookup_many(['sha256new_C']))
+		finally:
+			os.listdir, os.stat = real_listdir, real_stat
+		self.assertEqual([os.path.join(other.dir, 'sha256new_B'), os.path.join(other.dir, 'sha256new_C')], checked)
+		self.assertEqual(None, uncached._listing)
+
+		# The listings are cached, so looking for missing items needs just a stat of each store
+		stats = []
+		real_stat = os.stat
+		def stat(path):
+			stats.append(path)
+			return real_stat(path)
+		real_listdir = os.listdir
+		def listdir(path):
+			assert 0, path
+		os.stat = stat
+		os.listdir = listdir
+		try:
+			missing = ['sha256new_%d' % i for i in range(100)]
+			self.assertEqual({}, stores.lookup_many(missing))
+			self.assertEqual(None, stores.lookup_maybe(missing))
+		finally:
+			os.stat = real_stat
+			os.listdir = real_listdir
+		self.assertEqual([store.dir for store in stores.stores] * 2, stats)
+
+		# Changing the store invalidates the cache
+		os.mkdir(os.path.join(other.dir, 'sha256new_C'))
+		self.assertEqual(os.path.join(other.dir, 'sha256new_C'), stores.lookup_maybe(['sha256new_C']))
+
+	def testGC(self):
+		import time
+		from zeroinstall.zerostore import evict, manifestindex
+		from zeroinstall.support import basedir
+		size = self.make_synthetic_impls(5)
+		impls = ['sha256new_%d' % i for i in range(5)]
+		now = time.time()
+		day = 24 * 60 * 60
+		for i, impl in enumerate(impls):
+			t = now - (i * 10 + 1) * day
+			os.utime(os.path.join(self.store.dir, impl), (t, t))
+		size += os.path.getsize(os.path.join(self.store.dir, impls[0], '.manifest'))
+		with open(os.path.join(basedir.save_config_path('0install.net', 'injector'), 'pinned-implementations'), 'w') as stream:
+			stream.write('# Keep this\nsha256new_4\n')
+
+		self.assertEqual(10 * 1024 ** 3, evict.parse_size('10G'))
+		self.assertEqual(1536 * 1024, evict.parse_size('1.5 MiB'))
+		self.assertEqual(100, evict.parse_size('100'))
+		self.assertRaises(SafeException, lambda: evict.parse_size('10X'))
+		self.assertRaises(cli.UsageError, lambda: cli.do_gc([]))
+		cli.init_stores()
+		cli.stores.stores = [self.store]
+
+		errors = []
+		def gc(*args, **kwargs):
+			old_stdout, old_stderr = sys.stdout, sys.stderr
+			sys.stdout = StringIO()
+			sys.stderr = StringIO()
+			try:
+				cli.do_gc(list(args) + [kwargs.get('store_dir', self.store.dir)])
+				return sys.stdout.getvalue()
+			finally:
+				errors[:] = [sys.stderr.getvalue()]
+				sys.stdout, sys.stderr = old_stdout, old_stderr
+		def stored():
+			return sorted(name for name in os.listdir(self.store.dir) if not name.startswith('.'))
+		def indexed():
+			return sorted(os.listdir(os.path.join(self.store.dir, manifestindex.INDEX_DIR)))
+		for impl in impls:
+			manifestindex.write_index(os.path.join(self.store.dir, impl))
+
+		# Pinned items are never removed
+		out = gc('--max-age=15', '--dry-run')
+		assert 'Removing sha256new_2 (' in out, out
+		assert 'Removing sha256new_3 (' in out, out
+		assert '[dry-run] would free' in out, out
+		self.assertEqual(impls, stored())
+		assert '5 of 5 implementations have no record in the usage log' in errors[0], errors
+		assert 'not your own cache' not in errors[0], errors
+
+		# Other users' use of a shared cache isn't logged, so it needs --force
+		shared = os.path.join(self.tmp, 'shared')
+		os.mkdir(shared)
+		os.mkdir(os.path.join(shared, 'sha256new_S'))
+		try:
+			gc('--max-age=0', store_dir = shared)
+			assert 0
+		except SafeException as ex:
+			assert 'not your own cache' in str(ex), ex
+		assert os.path.isdir(os.path.join(shared, 'sha256new_S'))
+		out = gc('--max-age=0', '--dry-run', store_dir = shared)
+		assert 'Removing sha256new_S (' in out, out
+		assert 'not your own cache' in errors[0], errors
+		gc('--max-age=0', '--force', store_dir = shared)
+		assert not os.path.exists(os.path.join(shared, 'sha256new_S'))
+		assert 'not your own cache' in errors[0], errors
+
+		real_empty_trash = evict.empty_trash
+		evict.empty_trash = lambda store_dir, background = False: real_empty_trash(store_dir)
+		try:
+			gc('--max-age=15')
+			self.assertEqual(impls[:2] + impls[4:], stored())
+			self.assertEqual(stored(), indexed())
+			assert not os.path.exists(os.path.join(self.store.dir, evict.TRASH_NAME))
+
+			# Least-recently used first
+			gc('--max-size=%d' % (size * 2))
+			self.assertEqual(impls[:1] + impls[4:], stored())
+
+			# Leftovers from an interrupted run are removed
+			os.makedirs(os.path.join(self.store.dir, evict.TRASH_NAME, 'sha256new_9'))
+			gc('--max-size=1G')
+			self.assertEqual(impls[:1] + impls[4:], stored())
+			assert not os.path.exists(os.path.join(self.store.dir, evict.TRASH_NAME))
+
+			# Trash claimed by a deleter which has exited is removed, but not if it's still running
+			child = os.fork()
+			if child == 0:
+				os._exit(0)
+			os.waitpid(child, 0)
+			dead = os.path.join(self.store.dir, '%s-%d' % (evict.TRASH_NAME, child))
+			live = os.path.join(self.store.dir, '%s-%d' % (evict.TRASH_NAME, os.getppid()))
+			os.makedirs(os.path.join(dead, 'sha256new_8'))
+			os.makedirs(os.path.join(live, 'sha256new_7'))
+			gc('--max-size=1G')
+			assert not os.path.exists(dead)
+			assert os.path.exists(os.path.join(live, 'sha256new_7'))
+			os.rmdir(os.path.join(live, 'sha256new_7'))
+			os.rmdir(live)
+			self.assertEqual([], [name for name in os.listdir(self.store.dir) if name.startswith(evict.TRASH_NAME)])
+		finally:
+			evict.empty_trash = real_empty_trash
+
+		# An item which has already gone is skipped
+		logger.setLevel(logging.ERROR)
+		try:
+			missing = evict.Item('sha256new_6', os.path.join(self.store.dir, 'sha256new_6'), 0, 0, False)
+			self.assertEqual([], evict.move_to_trash(self.store.dir, [missing]))
+		finally:
+			logger.setLevel(logging.WARN)
+
+	def testUsageLog(self):
+		import time
+		from zeroinstall.zerostore import usage, Stores
+		log = usage.UsageLog(os.path.join(self.tmp, 'usage-log'))
+		self.assertEqual({}, log.load())
+		log.record(['sha256new_A', 'sha256new_B'], when = 1000)
+		self.assertEqual({'sha256new_A': 1000, 'sha256new_B': 1000}, log.load())
+		assert not os.path.exists(log.path)
+		log.flush()
+		log.record(['sha256new_A'], when = 2000)
+		log.flush()
+		with open(log.path, 'a') as stream:
+			stream.write('3000 sha256new_')		# Truncated
+		self.assertEqual({'sha256new_A': 2000, 'sha256new_B': 1000}, usage.UsageLog(log.path).load())
+
+		log.compact()
+		with open(log.path) as stream:
+			self.assertEqual('2000 sha256new_A\n1000 sha256new_B\n', stream.read())
+		log.forget(['sha256new_A'])
+		self.assertEqual({'sha256new_B': 1000}, log.load())
+
+		# Large logs get compacted automatically
+		old_compact_size = usage._COMPACT_SIZE
+		usage._COMPACT_SIZE = 100
+		try:
+			for i in range(10):
+				log.record(['sha256new_B'], when = 1000 + i)
+				log.flush()
+		finally:
+			usage._COMPACT_SIZE = old_compact_size
+		with open(log.path) as stream:
+			self.assertEqual('1009 sha256new_B\n', stream.read())
+
+		# Finding an implementation isn't a use
+		os.mkdir(os.path.join(self.store.dir, 'sha256new_A'))
+		stores = Stores()
+		stores.stores = [self.store]
+		stores.lookup_any(['sha256new_A'])
+		self.assertEqual({}, usage.get_log().load())
+
+		# Uses are recorded when the process exits
+		usage.record(['sha256new_A'])
+		last_used = usage.get_log().load()
+		self.assertEqual(['sha256new_A'], list(last_used))
+		assert time.time() - last_used['sha256new_A'] < 60
+		usage.get_log().flush()
+		self.assertEqual({'sha256new_A': int(last_used['sha256new_A'])}, usage.UsageLog().load())
+
+	def testListUsage(self):
+		from zeroinstall.zerostore import usage
+		size = self.make_synthetic_impls(3)
+		size += os.path.getsize(os.path.join(self.store.dir, 'sha256new_0', '.manifest'))
+		for i in range(3):
+			os.utime(os.path.join(self.store.dir, 'sha256new_%d' % i), (1000, 1000))
+		usage.get_log().record(['sha256new_1'], when = 2000)
+		usage.get_log().record(['sha256new_2'], when = 1500)
+
+		cli.init_stores()
+		cli.stores.stores = [self.store]
+		old_stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			cli.do_list(['--usage'])
+			result = sys.stdout.getvalue()
+		finally:
+			sys.stdout = old_stdout
+		lines = result.split('\n')
+		assert 'User store' in lines[0], result
+		# Unused first, then least-recently-used
+		self.assertEqual(['sha256new_0', 'sha256new_2', 'sha256new_1'], [line.split()[-1] for line in lines[1:4]])
+		assert 'unused' in lines[1], result
+		assert support.pretty_size(size) in lines[1], result
+		assert support.pretty_size(size * 3) in lines[4], result
+
+		# gc prefers the usage log to the directory times
+		old_stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			cli.do_gc(['--max-size=%d' % (size * 2), '--dry-run', self.store.dir])
+			result = sys.stdout.getvalue()
+		finally:
+			sys.stdout = old_stdout
+		assert 'Removing sha256new_0 ' in result, result
+		assert 'sha256new_2' not in result, result
+
+	def testConcurrentAdd(self):
+		import threading, time
+		from zeroinstall.zerostore import locks
+		sample = os.path.join(self.tmp, 'sample')
+		os.mkdir(sample)
+		self.populate_sample(sample)
+		digest = 'sha1new=7e3eb25a072988f164bae24d33af69c1814eb99a'
+		lock_path = os.path.join(self.store.dir, locks.LOCKS_NAME, digest)
+
+		tmp_dirs = []
+		real_get_tmp_dir_for = self.store.get_tmp_dir_for
+		def get_tmp_dir_for(required_digest):
+			tmp = real_get_tmp_dir_for(required_digest)
+			tmp_dirs.append(tmp)
+			return tmp
+		self.store.get_tmp_dir_for = get_tmp_dir_for
+
+		# Another importer holds the lock, so we wait for it and then use its copy
+		lock = locks.DigestLock(self.store.dir, digest)
+		assert lock.acquire()
+		errors = []
+		def add():
+			try:
+				self.store.add_dir_to_cache(digest, sample)
+			except Exception as ex:
+				errors.append(ex)
+		thread = threading.Thread(target = add)
+		thread.start()
+		time.sleep(0.2)
+		assert thread.is_alive()
+		self.assertEqual([], tmp_dirs)
+
+		tmp = real_get_tmp_dir_for(digest)
+		os.rmdir(tmp)
+		shutil.copytree(sample, tmp, symlinks = True)
+		self.store.check_manifest_and_rename(digest, tmp)
+		lock.release()
+		thread.join()
+		self.assertEqual([], errors)
+		self.assertEqual([], tmp_dirs)
+		assert not os.path.exists(lock_path)
+
+		# A crashed importer leaves its temporary directory; the next one removes it
+		other = 'sha1new=0000000000000000000000000000000000000000'
+		lock = locks.DigestLock(self.store.dir, other)
+		assert lock.acquire()
+		crashed_tmp = real_get_tmp_dir_for(other)
+		lock.set_tmp(crashed_tmp)
+		os.close(lock._fd)
+
+		logger.setLevel(logging.ERROR)
+		try:
+			self.store.add_dir_to_cache(other, sample)
+			assert False
+		except BadDigest:
+			pass
+		finally:
+			logger.setLevel(logging.WARN)
+		assert not os.path.exists(crashed_tmp)
+		self.assertEqual(1, len(tmp_dirs))
+		assert not os.path.exists(tmp_dirs[0])
+		assert not os.path.exists(os.path.join(self.store.dir, locks.LOCKS_NAME, other))
+
+		# A dry run doesn't create any lock files
+		shutil.rmtree(os.path.join(self.store.dir, locks.LOCKS_NAME))
+		dry_digest = 'sha1new=40861a33dba4e7c26d37505bd9693511808c0c35'
+		subfile = os.path.join(sample, 'My Dir', '!a file!.exe')
+		mtime = os.stat(subfile).st_mtime
+		os.chmod(subfile, 0o755)
+		with open(subfile, 'w') as stream:
+			stream.write('Extra!\n')
+		os.utime(subfile, (mtime, mtime))
+		self.store.add_dir_to_cache(dry_digest, sample, dry_run = True)
+		with open(os.path.join(mydir, 'HelloWorld.tgz'), 'rb') as stream:
+			self.store.add_archive_to_cache('sha1new=290eb133e146635fe37713fd58174324a16d595f', stream,
+					'HelloWorld.tgz', dry_run = True)
+		self.assertEqual(set([dry_digest, 'sha1new=290eb133e146635fe37713fd58174324a16d595f']), self.store.dry_run_names)
+		assert not os.path.exists(os.path.join(self.store.dir, locks.LOCKS_NAME))
+		assert not os.path.exists(os.path.join(self.store.dir, dry_digest))
+
 	def testCopy(self):
 		sha1 = manifest.get_algorithm('sha1')
 		sha1new = manifest.get_algorithm('sha1new')
@@ -330,5 +1328,89 @@ class TestStore(BaseTest):
 		finally:
 			support.ro_rmtree(copy)
 
+	def testCopySinglePass(self):
+		sha256new = manifest.get_algorithm('sha256new')
+		source = os.path.join(self.tmp, 'source')
+		os.mkdir(source)
+		self.populate_sample(source)
+		digest = sha256new.getID(manifest.add_manifest_file(source, sha256new))
+		with open(os.path.join(source, '.manifest'), 'rb') as stream:
+			manifest_data = stream.read()
+
+		target = os.path.join(self.tmp, 'target')
+		os.mkdir(target)
+
+		# Each file is only read once, while copying (or just after, if the kernel copied it)
+		real_digest_file = manifest._digest_file
+		hashed = []
+		def digest_file(digest, path, *args):
+			hashed.append(path)
+			return real_digest_file(digest, path, *args)
+		manifest._digest_file = digest_file
+		try:
+			manifest.copy_tree_with_verify(source, target, manifest_data, digest)
+		finally:
+			manifest._digest_file = real_digest_file
+		assert not [path for path in hashed if path.startswith(source)], hashed
+		assert len(hashed) == len(set(hashed)), hashed
+		manifest.verify(os.path.join(target, digest))
+
+		# Changing a file (but not its size or mtime) is detected
+		support.ro_rmtree(os.path.join(target, digest))
+		subfile = os.path.join(source, 'My Dir', '!a file!')
+		os.chmod(subfile, 0o644)
+		with open(subfile, 'w') as stream:
+			stream.write('Some dat!.')
+		os.utime(subfile, (1, 2))
+		try:
+			manifest.copy_tree_with_verify(source, target, manifest_data, digest)
+			assert False
+		except BadDigest as ex:
+			assert 'tampered' in str(ex)
+		self.assertEqual([], os.listdir(target))
+
+	def testFastCopy(self):
+		from zeroinstall.zerostore import fastcopy
+		src = os.path.join(self.tmp, 'src')
+		data = os.urandom(3 * fastcopy.BLOCK_SIZE + 7)
+		with open(src, 'wb') as stream:
+			stream.write(data)
+
+		stats = fastcopy.CopyStats()
+		for i, allowed in enumerate([None, [], ['sendfile']]):
+			dst = os.path.join(self.tmp, 'dst%d' % i)
+			method = fastcopy.copy_file(src, dst, mode = 0o600, stats = stats, allowed = allowed)
+			if allowed == []:
+				self.assertEqual('userspace', method)
+			else:
+				assert method in fastcopy.methods + ('userspace',), method
+			with open(dst, 'rb') as stream:
+				assert stream.read() == data
+			self.assertEqual(0o600, os.stat(dst).st_mode & 0o777)
+
+		self.assertEqual(3, sum(stats.files.values()))
+		self.assertEqual(3 * len(data), sum(stats.bytes.values()))
+
+		# Never overwrites an existing file
+		try:
+			fastcopy.copy_file(src, dst)
+			assert False
+		except OSError:
+			pass
+
+		# A kernel method which reports success but copies too little is treated as a failure
+		def short_copy(src_fd, dst_fd):
+			os.write(dst_fd, os.read(src_fd, 10))
+		real_methods = fastcopy._kernel_methods
+		fastcopy._kernel_methods = [('short', short_copy)]
+		try:
+			dst = os.path.join(self.tmp, 'short')
+			self.assertEqual('userspace', fastcopy.copy_file(src, dst, allowed = ['short']))
+			with open(dst, 'rb') as stream:
+				assert stream.read() == data
+		finally:
+			fastcopy._kernel_methods = real_methods
+			fastcopy._unsupported.clear()
+
 if __name__ == '__main__':
 	unittest.main()
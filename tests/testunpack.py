@@ -7,7 +7,7 @@ import sys, tempfile, os
 import unittest, logging
 
 sys.path.insert(0, '..')
-from zeroinstall.zerostore import unpack, manifest, Store, BadDigest
+from zeroinstall.zerostore import unpack, archive, manifest, Store, BadDigest
 from zeroinstall import SafeException, support
 from zeroinstall.support import find_in_path
 
@@ -123,6 +123,73 @@ class AbstractTestUnpack():
 			unpack.unpack_archive('ftp://foo/file.deb', stream, self.tmpdir)
 		self.assert_manifest('sha1new=2c725156ec3832b7980a3de2270b3d8d85d4e3ea')
 	
+	def with_prefix(self, archive_name):
+		stream = tempfile.TemporaryFile()
+		stream.write(b'PK\x05\x06 and !<arch> are not archives')
+		with open(archive_name, 'rb') as archive_stream:
+			stream.write(archive_stream.read())
+		return stream
+
+	def testDebOffset(self):
+		with self.with_prefix('dummy_1-1_all.deb') as stream:
+			unpack.unpack_archive('ftp://foo/file.deb', stream, self.tmpdir, start_offset = 33)
+		self.assert_manifest('sha1new=2c725156ec3832b7980a3de2270b3d8d85d4e3ea')
+
+	def testZipOffset(self):
+		with self.with_prefix('HelloWorld.zip') as stream:
+			unpack.unpack_archive('ftp://foo/file.zip', stream, self.tmpdir, start_offset = 33)
+		self.assert_manifest('sha1=3ce644dc725f1d21cfcf02562c76f375944b266a')
+
+	def testNotDeb(self):
+		with open('HelloWorld.tgz', 'rb') as stream:
+			try:
+				unpack.unpack_archive('ftp://foo/file.deb', stream, self.tmpdir)
+				assert False
+			except SafeException as ex:
+				assert 'Not an ar archive' in str(ex), ex
+
+	def testParallelDecompressor(self):
+		bindir = os.path.join(self.tmpdir, 'bin')
+		used = os.path.join(self.tmpdir, 'used')
+		os.mkdir(bindir)
+		for name, script in [('pigz', 'gzip "$@"'), ('broken', 'exit 1')]:
+			with open(os.path.join(bindir, name), 'w') as stream:
+				stream.write('#!/bin/sh\necho "$@" >> %s\n%s\n' % (used, script))
+			os.chmod(os.path.join(bindir, name), 0o755)
+
+		def unpack_hello(env):
+			if os.path.exists(used): os.unlink(used)
+			unpacked = os.path.join(self.tmpdir, 'unpacked')
+			os.mkdir(unpacked)
+			try:
+				os.environ['ZEROINSTALL_DECOMPRESSORS'] = env
+				with open('HelloWorld.tgz', 'rb') as stream:
+					unpack.unpack_archive('ftp://foo/file.tgz', stream, unpacked)
+				self.assertEqual(['main'], os.listdir(os.path.join(unpacked, 'HelloWorld')))
+			finally:
+				support.ro_rmtree(unpacked)
+			return os.path.exists(used)
+
+		old_path = os.environ['PATH']
+		old_min_size = unpack._PARALLEL_MIN_SIZE
+		try:
+			os.environ['PATH'] = bindir + os.pathsep + old_path
+			unpack._PARALLEL_MIN_SIZE = 0
+			assert unpack_hello('')
+			assert not unpack_hello('none')
+			assert not unpack_hello('bzip2=pbzip2, gzip=none')
+			try:
+				unpack_hello('gzip=broken -q')
+				assert False
+			except SafeException as ex:
+				assert 'Failed to extract' in str(ex), ex
+			with open(used) as stream:
+				self.assertEqual('-q -d', stream.read().strip()[:5])
+		finally:
+			os.environ['PATH'] = old_path
+			del os.environ['ZEROINSTALL_DECOMPRESSORS']
+			unpack._PARALLEL_MIN_SIZE = old_min_size
+
 	def testGem(self):
 		with open('hello-0.1.gem', 'rb') as stream:
 			unpack.unpack_archive('ftp://foo/file.gem', stream, self.tmpdir)
@@ -171,12 +238,159 @@ class TestUnpackPython(AbstractTestUnpack, BaseTest):
 		AbstractTestUnpack.setUp(self)
 		unpack._tar_version = 'Solaris tar'
 		assert not unpack._gnu_tar()
+		assert unpack._in_process
+
+	def make_tar(self, *members):
+		import tarfile, io
+		data = io.BytesIO()
+		tar = tarfile.open(mode = 'w', fileobj = data)
+		for info, contents in members:
+			if contents is not None:
+				info.size = len(contents)
+				tar.addfile(info, io.BytesIO(contents))
+			else:
+				tar.addfile(info)
+		tar.close()
+		data.seek(0)
+		return data
+
+	def tar_info(self, name, type = None, mode = 0o644, linkname = ''):
+		import tarfile
+		info = tarfile.TarInfo(name)
+		if type is not None:
+			info.type = type
+		info.mode = mode
+		info.mtime = 1000
+		info.linkname = linkname
+		return info
+
+	def testEscapingPaths(self):
+		import tarfile
+		for name in ['../evil', 'ok/../../evil', '/tmp/evil']:
+			stream = self.make_tar((self.tar_info(name), b'bad'))
+			try:
+				unpack.unpack_archive('ftp://foo/file.tar', stream, self.tmpdir)
+				assert False
+			except SafeException as ex:
+				assert 'Illegal path' in str(ex), ex
+
+		# Writing through a symlink
+		stream = self.make_tar((self.tar_info('link', tarfile.SYMTYPE, linkname = '..'), None),
+				       (self.tar_info('link/evil'), b'bad'))
+		try:
+			unpack.unpack_archive('ftp://foo/file.tar', stream, self.tmpdir)
+			assert False
+		except SafeException as ex:
+			assert 'not a directory' in str(ex), ex
+		assert not os.path.exists(os.path.join(os.path.dirname(self.tmpdir), 'evil'))
+
+		# Hard-linking to something outside the archive
+		stream = self.make_tar((self.tar_info('passwd', tarfile.LNKTYPE, linkname = 'etc/passwd'), None))
+		try:
+			unpack.unpack_archive('ftp://foo/file.tar', stream, self.tmpdir)
+			assert False
+		except SafeException as ex:
+			assert 'hard link' in str(ex), ex
+
+		stream = self.make_tar((self.tar_info('dev', tarfile.CHRTYPE), None))
+		try:
+			unpack.unpack_archive('ftp://foo/file.tar', stream, self.tmpdir)
+			assert False
+		except SafeException as ex:
+			assert 'device' in str(ex), ex
+
+	def testModes(self):
+		import tarfile
+		stream = self.make_tar((self.tar_info('./dir', tarfile.DIRTYPE, mode = 0o1777), None),
+				       (self.tar_info('dir/suid', mode = 0o4711), b'#!/bin/sh\n'),
+				       (self.tar_info('dir/private', mode = 0o600), b'data'),
+				       (self.tar_info('dir/copy', tarfile.LNKTYPE, linkname = './dir/private'), None),
+				       (self.tar_info('dir/private', mode = 0o644), b'replaced'))
+		unpack.unpack_archive('ftp://foo/file.tar', stream, self.tmpdir)
+
+		def mode(name):
+			return os.stat(os.path.join(self.tmpdir, name)).st_mode & 0o7777
+		self.assertEqual(0o755, mode('dir'))
+		self.assertEqual(0o755, mode('dir/suid'))
+		self.assertEqual(0o644, mode('dir/private'))
+		self.assertEqual(1000, os.stat(os.path.join(self.tmpdir, 'dir')).st_mtime)
+		with open(os.path.join(self.tmpdir, 'dir', 'private'), 'rb') as stream:
+			self.assertEqual(b'replaced', stream.read())
+		with open(os.path.join(self.tmpdir, 'dir', 'copy'), 'rb') as stream:
+			self.assertEqual(b'data', stream.read())
+
+	def testHashWhileExtracting(self):
+		alg = manifest.get_algorithm('sha1new')
+		digests = {}
+		with open('HelloWorld.tgz', 'rb') as stream:
+			unpack.unpack_archive('ftp://foo/file.tgz', stream, self.tmpdir, alg = alg, digests = digests)
+		main = os.path.join(self.tmpdir, 'HelloWorld', 'main')
+		self.assertEqual([main], list(digests))
+		self.assertEqual(manifest._digest_file(alg.new_digest(), main).hexdigest(), digests[main])
+
+		# Adding to a store doesn't read the files back
+		store = Store(os.path.join(self.tmpdir, 'store'))
+		os.mkdir(store.dir)
+		old_digest_file = manifest._digest_file
+		try:
+			def fail(digest, path):
+				raise Exception("Read " + path)
+			manifest._digest_file = fail
+			with open('HelloWorld.tgz', 'rb') as stream:
+				store.add_archive_to_cache('sha1new=290eb133e146635fe37713fd58174324a16d595f', stream, 'http://foo/foo.tgz')
+		finally:
+			manifest._digest_file = old_digest_file
+		assert store.lookup('sha1new=290eb133e146635fe37713fd58174324a16d595f')
+
+	def testManifestWithoutUnpacking(self):
+		import tarfile
+		alg = manifest.get_algorithm('sha256new')
+		tricky = self.make_tar((self.tar_info('top/dir/file', mode = 0o600), b'old'),
+				       (self.tar_info('top/link', tarfile.LNKTYPE, linkname = 'top/dir/file'), None),
+				       (self.tar_info('top/dir/file', mode = 0o755), b'new'),
+				       (self.tar_info('top/sym', tarfile.SYMTYPE, linkname = 'dir/file'), None),
+				       (self.tar_info('top/.manifest'), b'ignored'),
+				       (self.tar_info('top/empty', tarfile.DIRTYPE), None)).getvalue()
+		with open(os.path.join(self.tmpdir, 'tricky.tar'), 'wb') as stream:
+			stream.write(tricky)
+		archives = [('HelloWorld.tgz', None), ('HelloWorld.tgz', 'HelloWorld'),
+			    ('HelloWorld.tar.bz2', None), ('HelloWorld.zip', None),
+			    (os.path.join(self.tmpdir, 'tricky.tar'), 'top')]
+		if sys.getfilesystemencoding().lower() == "utf-8":
+			archives.append(('unicode.tar.gz', None))
+		for archive_name, extract in archives:
+			with open(archive_name, 'rb') as stream:
+				lines = unpack.generate_manifest(archive_name, stream, alg, extract)
+			unpacked = os.path.join(self.tmpdir, 'unpacked')
+			os.mkdir(unpacked)
+			with open(archive_name, 'rb') as stream:
+				unpack.unpack_archive(archive_name, stream, unpacked, extract)
+			manifest.fixup_permissions(unpacked)
+			self.assertEqual(list(alg.generate_manifest(os.path.join(unpacked, extract or ''))), lines)
+			support.ro_rmtree(unpacked)
+
+		# Archives which must be unpacked first
+		with open('HelloWorld.tgz', 'rb') as stream:
+			self.assertEqual(None, unpack.generate_manifest('HelloWorld.tgz', stream, manifest.get_algorithm('sha1')))
+		with open('dummy_1-1_all.deb', 'rb') as stream:
+			self.assertEqual(None, unpack.generate_manifest('dummy_1-1_all.deb', stream, alg))
+
+	@skipIf(not archive.can_read('lzma'), "Python has no lzma module")
+	def testLzma(self):
+		with open('HelloWorld.tar.lzma', 'rb') as stream:
+			unpack.unpack_archive('ftp://foo/file.tar.lzma', stream, self.tmpdir)
+		self.assert_manifest('sha1new=290eb133e146635fe37713fd58174324a16d595f')
 
 class TestUnpackGNU(AbstractTestUnpack, BaseTest):
 	def setUp(self):
 		AbstractTestUnpack.setUp(self)
 		unpack._tar_version = None
 		assert unpack._gnu_tar()
+		unpack._in_process = False
+
+	def tearDown(self):
+		unpack._in_process = True
+		AbstractTestUnpack.tearDown(self)
 
 	# Only available with GNU tar
 	def testLzma(self):
@@ -10,7 +10,7 @@ from __future__ import print_function
 import os, tempfile
 
 from zeroinstall import SafeException, _
-from zeroinstall.zerostore import manifest, unpack
+from zeroinstall.zerostore import manifest, unpack, digestcache
 from zeroinstall.cmd import UsageError
 from zeroinstall import support
 
@@ -20,6 +20,7 @@ def add_options(parser):
 	parser.add_option("", "--algorithm", help=_("the hash function to use"), metavar="HASH")
 	parser.add_option("-m", "--manifest", help=_("print the manifest"), action='store_true')
 	parser.add_option("-d", "--digest", help=_("print the digest"), action='store_true')
+	parser.add_option("", "--cache", help=_("reuse digests of unchanged files from previous runs"), action='store_true')
 
 def handle(config, options, args):
 	"""@type args: [str]"""
@@ -38,22 +39,40 @@ def handle(config, options, args):
 	show_manifest = bool(options.manifest)
 	show_digest = bool(options.digest) or not show_manifest
 
-	def do_manifest(d):
-		if extract is not None:
-			d = os.path.join(d, extract)
+	def show(lines):
 		digest = alg.new_digest()
-		for line in alg.generate_manifest(d):
+		for line in lines:
 			if show_manifest:
 				print(line)
 			digest.update((line + '\n').encode('utf-8'))
 		if show_digest:
 			print(alg.getID(digest))
 
+	def do_manifest(d, cache = None):
+		if extract is not None:
+			d = os.path.join(d, extract)
+		show(alg.generate_manifest(d, cache = cache))
+
 	if os.path.isdir(source):
 		if extract is not None:
 			raise SafeException("Can't use extract with a directory")
-		do_manifest(source)
+		# Unpacked archives are always new, so the cache is only useful for directories
+		if options.cache:
+			cache = digestcache.DigestCache()
+			try:
+				do_manifest(source, cache)
+			finally:
+				cache.save()
+		else:
+			do_manifest(source)
 	else:
+		# Tar and zip archives can usually be read directly, without unpacking them
+		with open(source, 'rb') as data:
+			lines = unpack.generate_manifest(source, data, alg, extract)
+		if lines is not None:
+			show(lines)
+			return
+
 		data = None
 		tmpdir = tempfile.mkdtemp()
 		try:
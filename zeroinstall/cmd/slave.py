@@ -317,11 +317,10 @@ def assert_manifest(required, tmpdir):
 	assert sha1 == required
 
 	# Check permissions are sensible
-	for root, dirs, files in os.walk(tmpdir):
-		for f in files + dirs:
-			full = os.path.join(root, f)
-			if os.path.islink(full): continue
-			full_mode = os.stat(full).st_mode
+	for root, entries in support.walk_entries(tmpdir):
+		for entry in entries:
+			if entry.is_symlink(): continue
+			full_mode = entry.stat(follow_symlinks = False).st_mode
 			assert 0o444 == full_mode & 0o666	# Must be r-?r-?r-?
 
 @tasks.async
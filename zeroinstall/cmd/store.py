@@ -45,13 +45,18 @@ def main(argv):
 		cli.init_stores()
 
 		pattern = args[0].lower()
-		matches = [c for c in cli.commands if c.__name__[3:].startswith(pattern)]
+		def name(command):
+			return command.__name__[3:].replace('_', '-')
+		matches = [c for c in cli.commands if name(c).startswith(pattern)]
+		exact = [c for c in matches if name(c) == pattern]
+		if exact:
+			matches = exact		# e.g. "add" isn't ambiguous just because there's "add-batch"
 		if len(matches) == 0:
 			parser.print_help()
 			sys.exit(1)
 		if len(matches) > 1:
 			raise SafeException("What do you mean by '%s'?\n%s" %
-				(pattern, '\n'.join(['- ' + x.__name__[3:] for x in matches])))
+				(pattern, '\n'.join(['- ' + name(x) for x in matches])))
 		matches[0](args[1:])
 	except KeyboardInterrupt as ex:
 		print("Interrupted", file=sys.stderr)
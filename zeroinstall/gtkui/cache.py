@@ -9,7 +9,7 @@ import os, sys
 import gtk
 
 from zeroinstall.injector import namespaces, model
-from zeroinstall.zerostore import BadDigest, manifest
+from zeroinstall.zerostore import BadDigest, manifest, manifestindex
 from zeroinstall import support
 from zeroinstall.support import basedir, tasks
 from zeroinstall.gtkui import help_box, gtkutils
@@ -176,10 +176,8 @@ def get_size(path):
 	man = os.path.join(path, '.manifest')
 	if os.path.exists(man):
 		size = os.path.getsize(man)
-		with open(man, 'rt') as stream:
-			for line in stream:
-				if line[:1] in "XF":
-					size += int(line.split(' ', 4)[3])
+		with manifestindex.load(path) as index:
+			size += index.total_size()
 	else:
 		size = 0
 		for root, dirs, files in os.walk(path):
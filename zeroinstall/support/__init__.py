@@ -97,6 +97,79 @@ def ro_rmtree(root):
 				os.chmod(main, 0o700)
 		shutil.rmtree(root)
 
+try:
+	from os import scandir as _scandir
+except ImportError:
+	try:
+		from scandir import scandir as _scandir		# Backport for Python 2
+	except ImportError:
+		_scandir = None
+
+class _DirEntry(object):
+	"""A minimal os.DirEntry, used when scandir isn't available."""
+	__slots__ = ['name', 'path', '_info']
+
+	def __init__(self, dir, name):
+		self.name = name
+		self.path = os.path.join(dir, name)
+		self._info = None
+
+	def stat(self, follow_symlinks = True):
+		if follow_symlinks:
+			return os.stat(self.path)
+		if self._info is None:
+			self._info = os.lstat(self.path)
+		return self._info
+
+	def _is(self, test, follow_symlinks):
+		try:
+			return test(self.stat(follow_symlinks).st_mode)
+		except OSError:
+			return False
+
+	def is_dir(self, follow_symlinks = True):
+		import stat
+		return self._is(stat.S_ISDIR, follow_symlinks)
+
+	def is_file(self, follow_symlinks = True):
+		import stat
+		return self._is(stat.S_ISREG, follow_symlinks)
+
+	def is_symlink(self):
+		import stat
+		return self._is(stat.S_ISLNK, False)
+
+def scan_dir(path):
+	"""List the contents of a directory, sorted by name.
+	The entries behave like os.DirEntry objects: the file type is usually known without
+	an extra system call, and the result of stat(follow_symlinks = False) is cached.
+	@type path: str
+	@rtype: [os.DirEntry]
+	@since: 2.5"""
+	if _scandir is None:
+		entries = [_DirEntry(path, name) for name in os.listdir(path)]
+	else:
+		it = _scandir(path)
+		try:
+			entries = list(it)
+		finally:
+			if hasattr(it, 'close'):
+				it.close()
+	entries.sort(key = lambda entry: entry.name)
+	return entries
+
+def walk_entries(root):
+	"""Like os.walk, but using L{scan_dir}. Yields (dirpath, entries) for root and then each
+	directory below it, top-down and in sorted order. Symlinks are not followed.
+	@type root: str
+	@since: 2.5"""
+	entries = scan_dir(root)
+	yield root, entries
+	for entry in entries:
+		if entry.is_dir(follow_symlinks = False):
+			for x in walk_entries(entry.path):
+				yield x
+
 def raise_with_traceback(ex, tb):
 	"""Raise an exception in a way that works on Python 2 and Python 3
 	@type ex: BaseException"""
@@ -23,10 +23,23 @@ class NotStored(SafeException):
 class NonwritableStore(SafeException):
 	"""Attempt to add to a non-writable store directory."""
 
-def _copytree2(src, dst):
+# A directory modified within this many seconds of us listing it may be changed again without its
+# mtime changing (on file-systems with coarse timestamps), so we don't cache the listing.
+_RACY_SECONDS = 2
+
+def _copytree2(src, dst, stats = None, link = False, alg = None, digests = None):
 	"""@type src: str
-	@type dst: str"""
+	@type dst: str
+	@type stats: L{fastcopy.CopyStats} | None
+	@param link: share the files' data using reflinks where possible, and never copy it any other
+	way in the kernel (files which can't be reflinked are copied through userspace)
+	@type link: bool
+	@param alg: if given, files which have to be copied through userspace are hashed as they're copied
+	@type alg: L{manifest.Algorithm} | None
+	@param digests: the hex digests of the new files hashed using alg are stored here, indexed by path
+	@type digests: {str: str} | None"""
 	import shutil
+	from zeroinstall.zerostore import fastcopy
 	names = os.listdir(src)
 	assert os.path.isdir(dst)
 	for name in names:
@@ -38,10 +51,19 @@ def _copytree2(src, dst):
 		elif os.path.isdir(srcname):
 			os.mkdir(dstname)
 			mtime = int(os.lstat(srcname).st_mtime)
-			_copytree2(srcname, dstname)
+			_copytree2(srcname, dstname, stats, link, alg, digests)
 			os.utime(dstname, (mtime, mtime))
 		else:
-			shutil.copy2(srcname, dstname)
+			# With link, the data is only shared using a reflink. That's copy-on-write, so unlike
+			# a hard-link, nothing done to the source file later can change the copy in the store.
+			allowed = ['reflink'] if link else None
+			if alg is not None:
+				digest = alg.new_digest()
+				if fastcopy.copy_file(srcname, dstname, stats = stats, allowed = allowed, digest = digest) == 'userspace':
+					digests[dstname] = digest.hexdigest()
+			else:
+				fastcopy.copy_file(srcname, dstname, stats = stats, allowed = allowed)
+			shutil.copystat(srcname, dstname)
 
 def _validate_pair(value):
 	"""@type value: str"""
@@ -95,10 +117,36 @@ class Store(object):
 		@type public: bool"""
 		self.dir = dir
 		self.dry_run_names = set()
+		self._listing = None
+		self._listing_mtime = None
 	
 	def __str__(self):
 		return _("Store '%s'") % self.dir
-	
+
+	def _get_listing(self):
+		"""Get the names in the store directory. The listing is cached until the directory's mtime
+		changes, so checking for an item that isn't stored doesn't need a stat for each one.
+		@return: the names, or None if the directory can't be listed
+		@rtype: frozenset | None"""
+		try:
+			info = os.stat(self.dir)
+		except OSError:
+			return frozenset()		# Not created yet
+		if self._listing is not None and self._listing_mtime == info.st_mtime:
+			return self._listing
+		try:
+			listing = frozenset(os.listdir(self.dir))
+		except OSError as ex:
+			logger.info(_("Can't list store %(dir)s: %(error)s"), {'dir': self.dir, 'error': ex})
+			return None
+		import time
+		if time.time() - info.st_mtime > _RACY_SECONDS:
+			self._listing = listing
+			self._listing_mtime = info.st_mtime
+		else:
+			self._listing = None
+		return listing
+
 	def lookup(self, digest):
 		"""@type digest: str
 		@rtype: str"""
@@ -107,7 +155,47 @@ class Store(object):
 		if os.path.isdir(dir) or digest in self.dry_run_names:
 			return dir
 		return None
+
+	def lookup_many(self, digests):
+		"""Find several items in this store at once, reading the store directory at most once.
+		A single item is just checked for directly, which is quicker than listing a large store.
+		@type digests: [str]
+		@return: the path of each item found, indexed by digest
+		@rtype: {str: str}
+		@since: 2.5"""
+		if len(digests) == 1:
+			digest, = digests
+			path = self.lookup(digest)
+			return {digest: path} if path else {}
+		listing = self._get_listing()
+		found = {}
+		for digest in digests:
+			alg, value = parse_algorithm_digest_pair(digest)
+			dir = os.path.join(self.dir, digest)
+			if digest in self.dry_run_names:
+				found[digest] = dir
+			elif listing is not None and digest not in listing:
+				pass
+			elif os.path.isdir(dir):
+				found[digest] = dir
+		return found
 	
+	def get_pool(self):
+		"""Get the store's pool of shared files, if it has one.
+		@rtype: L{pool.ObjectPool} | None
+		@since: 2.5"""
+		from . import pool
+		return pool.for_store(self.dir)
+
+	def _lock(self, required_digest, dry_run = False):
+		"""Lock the digest, so that other processes wait for us to add it rather than adding it too.
+		A dry run doesn't lock, as that would create the lock file.
+		@type required_digest: str
+		@type dry_run: bool
+		@rtype: L{locks.DigestLock}"""
+		from . import locks
+		return locks.DigestLock(self.dir, required_digest, dry_run = dry_run)
+
 	def get_tmp_dir_for(self, required_digest):
 		"""Create a temporary directory in the directory where we would store an implementation
 		with the given digest. This is used to setup a new implementation before being renamed if
@@ -126,7 +214,9 @@ class Store(object):
 			raise NonwritableStore(str(ex))
 	
 	def add_archive_to_cache(self, required_digest, data, url, extract = None, type = None, start_offset = 0, try_helper = False, dry_run = False):
-		"""@type required_digest: str
+		"""Unpack an archive into the cache. Where the archive is extracted in-process (see
+		L{unpack}), files are hashed as they are written, so they don't have to be read back.
+		@type required_digest: str
 		@type data: file
 		@type url: str
 		@type extract: str | None
@@ -140,23 +230,37 @@ class Store(object):
 			logger.info(_("Not adding %s as it already exists!"), required_digest)
 			return
 
-		tmp = self.get_tmp_dir_for(required_digest)
-		try:
-			unpack.unpack_archive(url, data, tmp, extract, type = type, start_offset = start_offset)
-		except:
-			import shutil
-			shutil.rmtree(tmp)
-			raise
+		with self._lock(required_digest, dry_run = dry_run) as lock:
+			if self.lookup(required_digest):
+				logger.info(_("%s was added by another process while we waited"), required_digest)
+				return
 
-		try:
-			self.check_manifest_and_rename(required_digest, tmp, extract, try_helper = try_helper, dry_run = dry_run)
-		except Exception:
-			#warn(_("Leaving extracted directory as %s"), tmp)
-			support.ro_rmtree(tmp)
-			raise
+			from . import manifest
+			alg = manifest.splitID(required_digest)[0]
+			if isinstance(alg, manifest.OldSHA1):
+				alg = None		# (its manifests don't support known digests)
+			digests = {}
+
+			tmp = self.get_tmp_dir_for(required_digest)
+			lock.set_tmp(tmp)
+			try:
+				unpack.unpack_archive(url, data, tmp, extract, type = type, start_offset = start_offset, alg = alg, digests = digests)
+			except:
+				import shutil
+				shutil.rmtree(tmp)
+				raise
+
+			try:
+				self.check_manifest_and_rename(required_digest, tmp, extract, try_helper = try_helper, dry_run = dry_run, digests = digests)
+			except Exception:
+				#warn(_("Leaving extracted directory as %s"), tmp)
+				support.ro_rmtree(tmp)
+				raise
 	
-	def add_dir_to_cache(self, required_digest, path, try_helper = False, dry_run = False):
+	def add_dir_to_cache(self, required_digest, path, try_helper = False, dry_run = False, link = False):
 		"""Copy the contents of path to the cache.
+		Files which have to be copied through userspace are hashed as they're copied, so the data
+		is only read once.
 		@param required_digest: the expected digest
 		@type required_digest: str
 		@param path: the root of the tree to copy
@@ -164,20 +268,42 @@ class Store(object):
 		@param try_helper: attempt to use privileged helper before user cache (since 0.26)
 		@type try_helper: bool
 		@type dry_run: bool
+		@param link: share the files' data with path using reflinks (copy-on-write), so that adding a
+		large tree on the same file-system takes no extra space or time. A warning is logged if the
+		file-system doesn't support this, and the files are copied instead. Hard-links are never
+		used, since changing a linked file later would corrupt the cache (since 2.5).
+		@type link: bool
 		@raise BadDigest: if the contents don't match the given digest."""
 		if self.lookup(required_digest):
 			logger.info(_("Not adding %s as it already exists!"), required_digest)
 			return
 
-		tmp = self.get_tmp_dir_for(required_digest)
-		try:
-			_copytree2(path, tmp)
-			self.check_manifest_and_rename(required_digest, tmp, try_helper = try_helper, dry_run = dry_run)
-		except:
-			logger.warning(_("Error importing directory."))
-			logger.warning(_("Deleting %s"), tmp)
-			support.ro_rmtree(tmp)
-			raise
+		with self._lock(required_digest, dry_run = dry_run) as lock:
+			if self.lookup(required_digest):
+				logger.info(_("%s was added by another process while we waited"), required_digest)
+				return
+
+			from . import manifest
+			alg = manifest.splitID(required_digest)[0]
+			if isinstance(alg, manifest.OldSHA1):
+				alg = None		# (its manifests don't support known digests)
+			digests = {}
+
+			tmp = self.get_tmp_dir_for(required_digest)
+			lock.set_tmp(tmp)
+			try:
+				from zeroinstall.zerostore import fastcopy
+				stats = fastcopy.CopyStats()
+				_copytree2(path, tmp, stats, link = link, alg = alg, digests = digests)
+				stats.log(path)
+				if link and not stats.files.get('reflink') and any(stats.bytes.values()):
+					logger.warning(_("Can't reflink the files in %s (the file-system may not support it); copied them instead"), path)
+				self.check_manifest_and_rename(required_digest, tmp, try_helper = try_helper, dry_run = dry_run, digests = digests)
+			except:
+				logger.warning(_("Error importing directory."))
+				logger.warning(_("Deleting %s"), tmp)
+				support.ro_rmtree(tmp)
+				raise
 
 	def _add_with_helper(self, required_digest, path, dry_run):
 		"""Use 0store-secure-add to copy 'path' to the system store.
@@ -222,7 +348,7 @@ class Store(object):
 		logger.info(_("Added succcessfully."))
 		return True
 
-	def check_manifest_and_rename(self, required_digest, tmp, extract = None, try_helper = False, dry_run = False):
+	def check_manifest_and_rename(self, required_digest, tmp, extract = None, try_helper = False, dry_run = False, digests = None):
 		"""Check that tmp[/extract] has the required_digest.
 		On success, rename the checked directory to the digest, and
 		make the whole tree read-only.
@@ -233,6 +359,8 @@ class Store(object):
 		@type try_helper: bool
 		@param dry_run: just print what we would do to stdout (and delete tmp)
 		@type dry_run: bool
+		@param digests: digests of files in tmp which we computed while writing them (see L{manifest.Algorithm.generate_manifest})
+		@type digests: {str: str} | None
 		@raise BadDigest: if the input directory doesn't match the given digest"""
 		if extract:
 			extracted = os.path.join(tmp, extract)
@@ -246,7 +374,7 @@ class Store(object):
 		manifest.fixup_permissions(extracted)
 
 		alg, required_value = manifest.splitID(required_digest)
-		actual_digest = alg.getID(manifest.add_manifest_file(extracted, alg))
+		actual_digest = alg.getID(manifest.add_manifest_file(extracted, alg, digests = digests))
 		if actual_digest != required_digest:
 			raise BadDigest(_('Incorrect manifest -- archive is corrupted.\n'
 					'Required digest: %(required_digest)s\n'
@@ -271,6 +399,11 @@ class Store(object):
 			support.ro_rmtree(tmp)
 			return
 		else:
+			pool = self.get_pool()
+			if pool is not None and not isinstance(alg, manifest.OldSHA1):
+				pool.share_tree(extracted, alg)
+				logger.info(_("Shared %(shared)d files with the pool and added %(added)d"), {'shared': pool.shared, 'added': pool.added})
+
 			# If we just want a subdirectory then the rename will change
 			# extracted/.. and so we'll need write permission on 'extracted'
 
@@ -278,6 +411,12 @@ class Store(object):
 			os.rename(extracted, final_name)
 			os.chmod(final_name, 0o555)
 
+			from zeroinstall.zerostore import manifestindex
+			try:
+				manifestindex.write_index(final_name)
+			except EnvironmentError as ex:
+				logger.warning(_("Failed to write manifest index for '%(dir)s': %(error)s"), {'dir': final_name, 'error': ex})
+
 		if extract:
 			os.rmdir(tmp)
 
@@ -341,22 +480,39 @@ class Stores(object):
 		@rtype: str | None
 		@since: 0.53"""
 		assert digests
+		found = self.lookup_many(digests)
 		for digest in digests:
-			assert digest
-			_validate_pair(digest)
-			for store in self.stores:
-				path = store.lookup(digest)
-				if path:
-					return path
+			if digest in found:
+				return found[digest]
 		return None
 
-	def add_dir_to_cache(self, required_digest, dir, dry_run = False):
+	def lookup_many(self, digests):
+		"""Search for many items at once (e.g. every digest in a set of selections), reading each
+		store's directory at most once. If an item is in several stores, the first one is used.
+		@type digests: [str]
+		@return: the path of each item found, indexed by digest
+		@rtype: {str: str}
+		@since: 2.5"""
+		for digest in digests:
+			assert digest
+			_validate_pair(digest)
+		found = {}
+		missing = set(digests)
+		for store in self.stores:
+			if not missing: break
+			found_here = store.lookup_many(missing)
+			found.update(found_here)
+			missing.difference_update(found_here)
+		return found
+
+	def add_dir_to_cache(self, required_digest, dir, dry_run = False, link = False):
 		"""Add to the best writable cache.
 		@type required_digest: str
 		@type dir: str
 		@type dry_run: bool
+		@type link: bool
 		@see: L{Store.add_dir_to_cache}"""
-		self._write_store(lambda store, **kwargs: store.add_dir_to_cache(required_digest, dir, dry_run = dry_run, **kwargs))
+		self._write_store(lambda store, **kwargs: store.add_dir_to_cache(required_digest, dir, dry_run = dry_run, link = link, **kwargs))
 
 	def add_archive_to_cache(self, required_digest, data, url, extract = None, type = None, start_offset = 0, dry_run = False):
 		"""Add to the best writable cache.
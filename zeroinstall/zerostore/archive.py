@@ -0,0 +1,478 @@
+"""Reading tar and zip archives in-process.
+
+Most archives we fetch are small, and running tar or unzip for each one costs more than the
+unpacking itself. This module reads tar archives (optionally compressed with gzip, bzip2 or, if
+Python has the lzma module, xz and lzma) and zip archives using Python's own modules, and
+extracts them with the same rules as the external tools get (see L{extract_members}).
+
+Archives are read as a sequence of L{Member}s. Member names are checked as they are read: an
+archive containing an absolute path or a ".." component is rejected.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, SafeException
+import os, sys, stat, errno, shutil
+import tarfile, zipfile, zlib
+
+try:
+	import lzma
+except ImportError:
+	lzma = None		# Python 2
+
+# The tarfile modes for each type of compression
+_tar_modes = {None: 'r|', 'gzip': 'r|gz', 'bzip2': 'r|bz2'}
+if lzma is not None:
+	_tar_modes['xz'] = _tar_modes['lzma'] = 'r|xz'		# (lzma detects which format it is)
+
+# Exceptions meaning the archive itself is bad
+_read_errors = (tarfile.TarError, zipfile.BadZipfile, zlib.error, EOFError) + ((lzma.LZMAError,) if lzma else ())
+
+if sys.version_info[0] > 2:
+	def _fs_name(b):
+		return b.decode(sys.getfilesystemencoding(), 'surrogateescape')
+else:
+	def _fs_name(b):
+		return b
+
+def can_read(decompress):
+	"""Check whether we can read tar archives with this compression in-process.
+	@param decompress: the compression (as for L{unpack.extract_tar})
+	@type decompress: str | None
+	@rtype: bool"""
+	if decompress not in _tar_modes:
+		return False
+	if decompress == 'bzip2':
+		try:
+			import bz2
+		except ImportError:
+			return False
+	return True
+
+class Member(object):
+	"""An entry in an archive.
+	@ivar name: the entry's path within the archive, as a relative path with no ".." components ("/"-separated)
+	@type name: str
+	@ivar kind: 'file', 'dir', 'symlink', 'link' (a hard link) or 'special' (a device or FIFO)
+	@type kind: str
+	@ivar executable: whether any execute bit is set (for files)
+	@type executable: bool
+	@ivar mtime: the modification time
+	@type mtime: int
+	@ivar size: the size of the file's contents
+	@type size: int
+	@ivar target: the target of a symlink, or the name of the member a hard link refers to
+	@type target: str | None
+	@since: 2.5"""
+
+	__slots__ = ['name', 'kind', 'executable', 'mtime', 'size', 'target', '_open']
+
+	def __init__(self, name, kind, executable = False, mtime = 0, size = 0, target = None, open = None):
+		self.name = name
+		self.kind = kind
+		self.executable = executable
+		self.mtime = mtime
+		self.size = size
+		self.target = target
+		self._open = open
+
+	def open(self):
+		"""Get a stream for reading a file's contents. For tar archives, this must be done before
+		moving on to the next member.
+		@rtype: file"""
+		return self._open()
+
+	def __repr__(self):
+		return "<Member %s %s>" % (self.kind, self.name)
+
+class FileSlice(object):
+	"""A read-only view of part of a seekable file, which can be used as a file in its own right
+	(e.g. to read an archive embedded in another file without copying it out first).
+	@since: 2.5"""
+
+	def __init__(self, stream, start, size = None):
+		"""@type stream: file
+		@param start: the position in stream of the start of the slice
+		@type start: int
+		@param size: the size of the slice (default: to the end of stream)
+		@type size: int | None"""
+		self._stream = stream
+		self._start = start
+		self._size = size
+		self._pos = 0
+
+	def _get_size(self):
+		if self._size is None:
+			self._stream.seek(0, 2)
+			return self._stream.tell() - self._start
+		return self._size
+
+	def seek(self, offset, whence = 0):
+		if whence == 1:
+			offset += self._pos
+		elif whence == 2:
+			offset += self._get_size()
+		if offset < 0:
+			raise IOError(errno.EINVAL, "Negative seek position %d" % offset)
+		self._pos = offset
+		return offset
+
+	def tell(self):
+		return self._pos
+
+	def seekable(self):
+		return True
+
+	def read(self, n = -1):
+		if self._size is not None:
+			remaining = max(0, self._size - self._pos)
+			if n is None or n < 0 or n > remaining:
+				n = remaining
+		self._stream.seek(self._start + self._pos)
+		data = self._stream.read(-1 if n is None else n)
+		self._pos += len(data)
+		return data
+
+	def close(self):
+		pass
+
+def ar_members(stream):
+	"""List the members of an ar archive (such as a Debian package), starting at the stream's
+	current position.
+	@type stream: file
+	@return: the name, position in stream and size of each member
+	@rtype: [(str, int, int)]
+	@raise SafeException: if this isn't an ar archive"""
+	start = stream.tell()
+	if stream.read(8) != b'!<arch>\n':
+		raise SafeException(_("Not an ar archive (bad magic number)"))
+	members = []
+	while True:
+		header = stream.read(60)
+		if not header: break
+		offset = stream.tell()
+		try:
+			if len(header) != 60 or header[58:60] != b'`\n':
+				raise ValueError("bad header")
+			name = header[:16].decode('ascii', 'replace').rstrip(' ')
+			size = int(header[48:58])
+			name_len = int(name[3:]) if name.startswith('#1/') else 0
+		except ValueError:
+			raise SafeException(_("Corrupted ar archive (bad header at offset %d)") % (offset - len(header) - start))
+		if name_len:
+			# BSD-style: the name follows the header
+			name = stream.read(name_len).decode('ascii', 'replace').rstrip('\0')
+			offset += name_len
+			size -= name_len
+		elif name.endswith('/') and name not in ('/', '//'):
+			name = name[:-1]		# GNU-style terminator
+		members.append((name, offset, size))
+		stream.seek(offset + size + ((offset + size - start) & 1))	# (members are 2-byte aligned)
+	return members
+
+def _check_name(name):
+	"""Normalise a name from an archive, rejecting any that would be extracted outside the destination.
+	@return: the name, or None for the top-level directory"""
+	parts = [part for part in name.split('/') if part not in ('', '.')]
+	if name.startswith('/') or '..' in parts:
+		raise SafeException(_("Illegal path '%s' in archive (absolute paths and '..' are not allowed)") % name)
+	return '/'.join(parts) or None
+
+def tar_members(stream, decompress):
+	"""Read the members of a tar archive from the stream's current position (the stream is read
+	sequentially, so it needn't be seekable).
+	@type stream: file
+	@param decompress: the compression (see L{can_read})
+	@type decompress: str | None
+	@rtype: iterator of L{Member}"""
+	# Python 2.5.1 crashes if name is None; see Python bug #1706850
+	tar = tarfile.open(name = '', mode = _tar_modes[decompress], fileobj = stream)
+	try:
+		for tarinfo in tar:
+			name = _check_name(tarinfo.name)
+			if name is None: continue
+			if tarinfo.isreg():
+				yield Member(name, 'file', bool(tarinfo.mode & 0o111), tarinfo.mtime, tarinfo.size,
+						open = lambda tarinfo = tarinfo: tar.extractfile(tarinfo))
+			elif tarinfo.isdir():
+				yield Member(name, 'dir', mtime = tarinfo.mtime)
+			elif tarinfo.issym():
+				yield Member(name, 'symlink', mtime = tarinfo.mtime, target = tarinfo.linkname)
+			elif tarinfo.islnk():
+				yield Member(name, 'link', mtime = tarinfo.mtime, target = _check_name(tarinfo.linkname))
+			else:
+				yield Member(name, 'special')
+	finally:
+		tar.close()
+
+def _zip_mtime(info):
+	# Prefer the "extended timestamp" extra field (UTC), as unzip does
+	extra = info.extra
+	import struct
+	while len(extra) >= 4:
+		tag, length = struct.unpack('<HH', extra[:4])
+		if tag == 0x5455 and length >= 5 and ord(extra[4:5]) & 1:
+			return struct.unpack('<i', extra[5:9])[0]
+		extra = extra[4 + length:]
+	# Otherwise, it's a local time with no zone, which we (like unzip with TZ=GMT) take as UTC
+	import calendar
+	return calendar.timegm(tuple(info.date_time) + (0, 0, 0))
+
+def zip_members(stream, start_offset = 0):
+	"""Read the members of a zip archive.
+	@type stream: file
+	@param start_offset: where the archive starts in the stream
+	@type start_offset: int
+	@rtype: iterator of L{Member}"""
+	archive = zipfile.ZipFile(FileSlice(stream, start_offset) if start_offset else stream)
+	try:
+		for info in archive.infolist():
+			name = _check_name(info.filename)
+			if name is None: continue
+			mode = (info.external_attr >> 16) if info.create_system == 3 else 0		# (Unix permissions, if any)
+			mtime = _zip_mtime(info)
+			if info.filename.endswith('/'):
+				yield Member(name, 'dir', mtime = mtime)
+			elif stat.S_ISLNK(mode):
+				yield Member(name, 'symlink', mtime = mtime, target = _fs_name(archive.read(info)))
+			elif mode == 0 or stat.S_ISREG(mode):
+				yield Member(name, 'file', bool(mode & 0o111), mtime, info.file_size,
+						open = lambda info = info: archive.open(info))
+			else:
+				yield Member(name, 'special')
+	finally:
+		archive.close()
+
+def _copy(src, dst, digest):
+	while True:
+		data = src.read(256 * 1024)
+		if not data: break
+		dst.write(data)
+		digest.update(data)
+
+def extract_members(members, destdir, extract = None, alg = None, digests = None):
+	"""Extract archive members into destdir. As with the external tools (run with
+	--no-same-owner and --no-same-permissions):
+	 - Everything is owned by the current user, and modes are set from the umask (with execute
+	   permission only for executable files); setuid, setgid and sticky bits are never set.
+	 - Nothing is written outside destdir, even through a symlink extracted earlier.
+	 - Later members replace earlier ones with the same name.
+	 - Files and directories get their modification times from the archive.
+	Hard links must refer to an earlier file in the archive. Devices and FIFOs are rejected.
+	If alg is given, each file is hashed as it is written, so that the manifest can be generated
+	without reading the files back (see L{manifest.Algorithm.generate_manifest}).
+	@type members: iterator of L{Member}
+	@type destdir: str
+	@param extract: only extract this top-level directory
+	@type extract: str | None
+	@param alg: the algorithm to hash the files with
+	@type alg: L{manifest.Algorithm} | None
+	@param digests: the hex digests of the files are stored here, indexed by path
+	@type digests: {str: str} | None
+	@raise SafeException: if the archive is bad or contains something we won't extract"""
+	from zeroinstall.zerostore.unpack import _u
+	known_dirs = set()		# Directories we created or checked (relative names)
+	files = set()			# Regular files we extracted, which may be hard-linked to
+	dir_mtimes = {}
+	extracted_anything = False
+
+	def check_parents(name):
+		parts = name.split('/')[:-1]
+		for i in range(len(parts)):
+			parent = '/'.join(parts[:i + 1])
+			if parent in known_dirs: continue
+			path = os.path.join(destdir, parent)
+			try:
+				info = os.lstat(path)
+			except OSError as ex:
+				if ex.errno != errno.ENOENT: raise
+				os.mkdir(path)
+			else:
+				if not stat.S_ISDIR(info.st_mode):
+					raise SafeException(_("Archive entry '%(name)s' is inside '%(parent)s', which is not a directory") % {'name': name, 'parent': parent})
+			known_dirs.add(parent)
+
+	try:
+		for member in members:
+			name = member.name
+			if extract is not None:
+				uname = _u(name)
+				if not (uname == extract or uname.startswith(extract + '/')):
+					continue
+			extracted_anything = True
+
+			if member.kind == 'special':
+				raise SafeException(_("Archive entry '%s' is a device or FIFO, which is not allowed") % name)
+
+			check_parents(name)
+			path = os.path.join(destdir, name)
+
+			# Remove anything that's already there (unless we're just extracting the directory again)
+			try:
+				info = os.lstat(path)
+			except OSError as ex:
+				if ex.errno != errno.ENOENT: raise
+			else:
+				if stat.S_ISDIR(info.st_mode):
+					if member.kind != 'dir':
+						raise SafeException(_("Archive entry '%s' would replace a directory") % name)
+				else:
+					os.unlink(path)
+					files.discard(name)
+					if digests is not None:
+						digests.pop(path, None)
+
+			if member.kind == 'dir':
+				if name not in known_dirs:
+					if not os.path.isdir(path):
+						os.mkdir(path)
+					known_dirs.add(name)
+				dir_mtimes[name] = member.mtime
+			elif member.kind == 'file':
+				fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+						0o777 if member.executable else 0o666)	# (the umask applies)
+				with os.fdopen(fd, 'wb') as dst:
+					src = member.open()
+					try:
+						if alg is None:
+							shutil.copyfileobj(src, dst, 256 * 1024)
+						else:
+							digest = alg.new_digest()
+							_copy(src, dst, digest)
+							digests[path] = digest.hexdigest()
+					finally:
+						src.close()
+				os.utime(path, (member.mtime, member.mtime))
+				files.add(name)
+			elif member.kind == 'symlink':
+				os.symlink(member.target, path)
+			elif member.kind == 'link':
+				if member.target not in files:
+					raise SafeException(_("Archive entry '%(name)s' is a hard link to '%(target)s', which is not an earlier file in the archive") %
+							{'name': name, 'target': member.target})
+				target_path = os.path.join(destdir, member.target)
+				os.link(target_path, path)
+				files.add(name)
+				if digests is not None and target_path in digests:
+					digests[path] = digests[target_path]
+			else:
+				raise Exception("Unknown member kind %s" % member.kind)
+	except _read_errors as ex:
+		raise SafeException(_("Failed to extract archive: %s") % ex)
+
+	# Set directory times last, as adding their contents changes them (deepest first)
+	for name in sorted(dir_mtimes, reverse = True):
+		mtime = dir_mtimes[name]
+		os.utime(os.path.join(destdir, name), (mtime, mtime))
+
+	if extract and not extracted_anything:
+		raise SafeException(_('Unable to find specified file = %s in archive') % extract)
+
+def generate_manifest(members, alg, extract = None):
+	"""Generate the manifest of the tree that L{extract_members} would create, without writing
+	anything to disk. The same checks are made as for extracting, and the manifest lines are the
+	ones alg.generate_manifest would produce for the tree (after L{manifest.fixup_permissions}).
+	@type members: iterator of L{Member}
+	@param alg: the algorithm (not the old "sha1" one, whose manifests depend on the directories' mtimes)
+	@type alg: L{manifest.Algorithm}
+	@param extract: generate the manifest of just this top-level directory
+	@type extract: str | None
+	@return: the manifest lines
+	@rtype: [str]
+	@raise SafeException: if the archive is bad or contains something we wouldn't extract"""
+	from zeroinstall.zerostore.unpack import _u
+	from zeroinstall.zerostore import manifest, BadDigest
+	assert not isinstance(alg, manifest.OldSHA1)
+
+	# A directory is a dict of its entries. Everything else is a (type, digest, rest) tuple,
+	# where "rest" is the end of the manifest line except for the name.
+	root = {}
+	files = {}		# Regular files, which may be hard-linked to
+	extracted_anything = False
+
+	def get_parent(name):
+		parts = name.split('/')
+		d = root
+		for i, part in enumerate(parts[:-1]):
+			d = d.setdefault(part, {})
+			if not isinstance(d, dict):
+				raise SafeException(_("Archive entry '%(name)s' is inside '%(parent)s', which is not a directory") % {'name': name, 'parent': '/'.join(parts[:i + 1])})
+		return d, parts[-1]
+
+	try:
+		for member in members:
+			name = _u(member.name)
+			if extract is not None and not (name == extract or name.startswith(extract + '/')):
+				continue
+			extracted_anything = True
+
+			if member.kind == 'special':
+				raise SafeException(_("Archive entry '%s' is a device or FIFO, which is not allowed") % name)
+
+			parent, leaf = get_parent(name)
+			if isinstance(parent.get(leaf, None), dict):
+				if member.kind != 'dir':
+					raise SafeException(_("Archive entry '%s' would replace a directory") % name)
+				continue
+			files.pop(name, None)
+
+			if member.kind == 'dir':
+				parent[leaf] = {}
+			elif member.kind == 'file':
+				digest = alg.new_digest()
+				src = member.open()
+				try:
+					while True:
+						data = src.read(256 * 1024)
+						if not data: break
+						digest.update(data)
+				finally:
+					src.close()
+				parent[leaf] = files[name] = ('X' if member.executable else 'F', digest.hexdigest(),
+								"%s %s" % (int(member.mtime), member.size))
+			elif member.kind == 'symlink':
+				target = member.target
+				if not isinstance(target, bytes):
+					target = target.encode('utf-8')
+				parent[leaf] = ('S', alg.new_digest(target).hexdigest(), str(len(target)))
+			elif member.kind == 'link':
+				target = _u(member.target)
+				if target not in files:
+					raise SafeException(_("Archive entry '%(name)s' is a hard link to '%(target)s', which is not an earlier file in the archive") %
+							{'name': name, 'target': target})
+				parent[leaf] = files[name] = files[target]		# (the same inode, so the same mtime and mode too)
+			else:
+				raise Exception("Unknown member kind %s" % member.kind)
+	except _read_errors as ex:
+		raise SafeException(_("Failed to extract archive: %s") % ex)
+
+	if extract:
+		if not extracted_anything:
+			raise SafeException(_('Unable to find specified file = %s in archive') % extract)
+		root = root.get(extract, None)
+		if not isinstance(root, dict):
+			raise SafeException(_('Directory %s not found in archive') % extract)
+
+	# (this follows manifest.HashLibAlgorithm._walk)
+	lines = []
+	def add_dir(sub, d):
+		if '\n' in sub: raise BadDigest(_("Newline in filename '%s'") % sub)
+		if sub != '/':
+			lines.append("D %s" % sub)
+		dirs = []
+		for leaf in sorted(d):
+			entry = d[leaf]
+			if isinstance(entry, dict):
+				dirs.append(leaf)
+				continue
+			type, digest, rest = entry
+			if type != 'S':
+				if leaf == '.manifest': continue
+			lines.append("%s %s %s %s" % (type, digest, rest, leaf))
+		if not sub.endswith('/'):
+			sub += '/'
+		for leaf in dirs:
+			add_dir(sub + leaf, d[leaf])
+	add_dir(_u('/'), root)
+	return lines
@@ -0,0 +1,128 @@
+"""Remembering which implementations have been verified, for incremental audits.
+
+A full audit reads every file in every implementation. Most of them haven't changed since the
+last audit, so we record a fingerprint of each implementation's metadata (the inode, size,
+mode, mtime and ctime of everything in it) when it verifies successfully. Later audits only need
+to re-hash implementations whose fingerprint has changed, or which haven't been checked for a
+while.
+
+Note that the fingerprint can't detect changes made by someone able to reset ctimes (e.g. by
+changing the system clock), so a full audit is still needed if the machine itself is suspect.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger, support
+from zeroinstall.support import basedir, portable_rename
+from zeroinstall.injector import namespaces
+import os, time, hashlib
+
+_FORMAT = 1
+
+def _ns(info, name):
+	value = getattr(info, name + '_ns', None)
+	if value is None:
+		value = int(getattr(info, name) * 1000000000)		# Python 2
+	return value
+
+def fingerprint(path):
+	"""Summarise the metadata of everything in the tree rooted at path, without reading any files.
+	Any change to the contents of a file changes its mtime and ctime, and therefore the fingerprint.
+	@type path: str
+	@rtype: str"""
+	digest = hashlib.sha256()
+	def add(rel_path, info):
+		digest.update(("%s\0%d %d %d %d %d\n" % (rel_path, info.st_ino, info.st_mode, info.st_size,
+				_ns(info, 'st_mtime'), _ns(info, 'st_ctime'))).encode('utf-8'))
+	add('', os.lstat(path))
+	prefix = len(os.path.join(path, ''))
+	for dirpath, entries in support.walk_entries(path):
+		for entry in entries:
+			add(entry.path[prefix:], entry.stat(follow_symlinks = False))
+	return digest.hexdigest()
+
+class AuditState(object):
+	"""The implementations which verified successfully, with when and with what fingerprint.
+	Changes are only written to disk by L{save}.
+	@since: 2.5"""
+
+	def __init__(self, path = None):
+		"""@param path: the database file (default: ~/.cache/0install.net/injector/audit-state)
+		@type path: str | None"""
+		if path is None:
+			path = os.path.join(basedir.save_cache_path(namespaces.config_site, namespaces.config_prog), 'audit-state')
+		self.path = path
+		self._entries = {}		# Path -> (verified at, fingerprint)
+		self._dirty = False
+		try:
+			self._load()
+		except Exception as ex:
+			logger.warning(_("Failed to load audit state %(path)s (%(error)s). Ignoring it."), {'path': path, 'error': ex})
+			self._entries = {}
+
+	def _load(self):
+		if not os.path.exists(self.path): return
+		with open(self.path, 'rb') as stream:
+			header = stream.readline()
+			if header != ('format=%d\n' % _FORMAT).encode('ascii'):
+				raise Exception(_("Unknown format %s") % repr(header.strip()))
+			for line in stream:
+				verified_at, fp, impl = line.decode('utf-8').rstrip('\n').split(' ', 2)
+				self._entries[impl] = (float(verified_at), fp)
+
+	def is_unchanged(self, impl, fp, max_age):
+		"""Check whether impl verified successfully within the last max_age seconds and still
+		has the same fingerprint.
+		@param impl: the path of the implementation
+		@type impl: str
+		@param fp: its current fingerprint (see L{fingerprint})
+		@type fp: str
+		@type max_age: float
+		@rtype: bool"""
+		entry = self._entries.get(impl, None)
+		if entry is None:
+			return False
+		verified_at, old_fp = entry
+		return old_fp == fp and time.time() - verified_at < max_age
+
+	def get_verified_at(self, impl):
+		"""@type impl: str
+		@return: when impl was last verified, if it was successful
+		@rtype: float | None"""
+		entry = self._entries.get(impl, None)
+		return entry and entry[0]
+
+	def record(self, impl, fp, verified_at):
+		"""Note that impl verified successfully.
+		@param impl: the path of the implementation
+		@type impl: str
+		@param fp: its fingerprint, taken before verifying it
+		@type fp: str
+		@param verified_at: when the verification started (as returned by time.time())
+		@type verified_at: float"""
+		self._entries[impl] = (verified_at, fp)
+		self._dirty = True
+
+	def forget(self, impl):
+		"""Note that impl failed to verify (or no longer exists).
+		@type impl: str"""
+		if self._entries.pop(impl, None) is not None:
+			self._dirty = True
+
+	def save(self):
+		"""Write the state back to disk, if it has changed."""
+		if not self._dirty: return
+		import tempfile
+		tmp = tempfile.NamedTemporaryFile(mode = 'wb', dir = os.path.dirname(self.path), delete = False)
+		try:
+			tmp.write(('format=%d\n' % _FORMAT).encode('ascii'))
+			for impl, (verified_at, fp) in sorted(self._entries.items()):
+				tmp.write(("%.3f %s %s\n" % (verified_at, fp, impl)).encode('utf-8'))
+			tmp.close()
+			portable_rename(tmp.name, self.path)
+		except:
+			tmp.close()
+			os.unlink(tmp.name)
+			raise
+		self._dirty = False
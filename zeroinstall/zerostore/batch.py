@@ -0,0 +1,222 @@
+"""Adding many archives to the stores at once ("0store add-batch").
+
+Mirroring or pre-seeding a cache means adding thousands of archives. Doing them one at a time
+leaves most of the machine idle: decompression, hashing and renaming each wait for the previous
+step. Here, the archives are given to a pool of worker processes, so that one is being unpacked
+while another is being hashed, and so on.
+
+Each archive is unpacked into a temporary directory in the store before being checked, so the
+number of archives in progress is also limited by an estimate of the temporary disk space they
+need (see L{add_batch}).
+
+The list of archives is a text file with one line per archive::
+
+  DIGEST ARCHIVE [EXTRACT [MIME-TYPE]]
+
+Fields are separated by spaces and may be quoted as for a shell. Use "-" for no EXTRACT. Relative
+paths are relative to the list file's directory. Blank lines and lines starting with "#" are
+ignored.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger, SafeException
+import os
+
+# Guess at how much bigger an archive's contents are than the archive
+_EXPANSION = 4
+
+class BatchItem(object):
+	"""An archive to add.
+	@ivar digest: the required digest
+	@type digest: str
+	@ivar archive: the path of the archive
+	@type archive: str
+	@ivar extract: the subdirectory to extract, if any
+	@type extract: str | None
+	@ivar type: the MIME type of the archive (None to guess from the file name)
+	@type type: str | None
+	@since: 2.5"""
+
+	__slots__ = ['digest', 'archive', 'extract', 'type']
+
+	def __init__(self, digest, archive, extract = None, type = None):
+		self.digest = digest
+		self.archive = archive
+		self.extract = extract
+		self.type = type
+
+	def __repr__(self):
+		return "<BatchItem %s from %s>" % (self.digest, self.archive)
+
+def read_list(stream, base_dir):
+	"""Parse a list of archives (see the module documentation).
+	@type stream: file
+	@param base_dir: relative paths are relative to this
+	@type base_dir: str
+	@rtype: [L{BatchItem}]
+	@raise SafeException: if the list is malformed"""
+	import shlex
+	from zeroinstall.zerostore import parse_algorithm_digest_pair, BadDigest
+	items = []
+	for n, line in enumerate(stream, 1):
+		try:
+			fields = shlex.split(line, comments = True)
+		except ValueError as ex:
+			raise SafeException(_("Error on line %(line)d of the list: %(error)s") % {'line': n, 'error': ex})
+		if not fields: continue
+		if len(fields) < 2 or len(fields) > 4:
+			raise SafeException(_("Line %(line)d of the list should be 'DIGEST ARCHIVE [EXTRACT [MIME-TYPE]]', not %(got)s") %
+					{'line': n, 'got': repr(line.strip())})
+		try:
+			parse_algorithm_digest_pair(fields[0])
+		except BadDigest as ex:
+			raise SafeException(_("Error on line %(line)d of the list: %(error)s") % {'line': n, 'error': ex})
+		extract = fields[2] if len(fields) > 2 and fields[2] != '-' else None
+		mime_type = fields[3] if len(fields) > 3 else None
+		items.append(BatchItem(fields[0], os.path.join(base_dir, fields[1]), extract, mime_type))
+	return items
+
+# How often (in seconds) add_batch checks for worker processes which have died
+_POLL_INTERVAL = 1
+
+# In a worker process, the stores to add to and where to report which process is adding each
+# item. These are set by _init_worker when the process starts.
+_stores = None
+_started = None
+
+def _init_worker(stores, started):
+	global _stores, _started
+	_stores = stores
+	_started = started
+
+def _run_item(n, item):
+	"""Add item number n in a worker process, after telling add_batch which process is doing it."""
+	_started.put((n, os.getpid()))
+	return _add_item(_stores, item)
+
+def _failed(item, error):
+	return {'digest': item.digest, 'archive': item.archive, 'status': 'failed', 'error': error}
+
+def _add_item(stores, item):
+	"""Add one archive for L{add_batch}.
+	@type stores: L{Stores}
+	@type item: L{BatchItem}
+	@return: the result
+	@rtype: {str: object}"""
+	import time
+	from zeroinstall.zerostore import unpack
+	result = {'digest': item.digest, 'archive': item.archive}
+	start = time.time()
+	try:
+		if stores.lookup_many([item.digest]):
+			result['status'] = 'present'
+		else:
+			mime_type = item.type or unpack.type_from_url(item.archive)
+			if not mime_type:
+				raise SafeException(_("Unknown extension in '%s' - can't guess MIME type") % item.archive)
+			unpack.check_type_ok(mime_type)
+			with open(item.archive, 'rb') as stream:
+				stores.add_archive_to_cache(item.digest, stream, item.archive, item.extract, type = mime_type)
+			result['status'] = 'added'
+	except (SafeException, EnvironmentError) as ex:
+		result['status'] = 'failed'
+		result['error'] = str(ex)
+	except Exception as ex:
+		logger.info("Failed to add %s", item.archive, exc_info = True)
+		result['status'] = 'failed'
+		result['error'] = '%s: %s' % (type(ex).__name__, ex)
+	result['seconds'] = round(time.time() - start, 3)
+	return result
+
+def _estimate_tmp(item):
+	try:
+		return os.path.getsize(item.archive) * _EXPANSION
+	except OSError:
+		return 0		# We'll report the error when we try to add it
+
+def add_batch(stores, items, jobs = 1, max_tmp = None):
+	"""Add many archives to the stores, using up to 'jobs' worker processes.
+	An archive isn't started while the ones in progress are estimated to need more than max_tmp
+	bytes of temporary space (unless nothing else is in progress). Failures (including a worker
+	process dying) are reported in the results, and don't stop the other archives being added.
+	@type stores: L{Stores}
+	@type items: [L{BatchItem}]
+	@type jobs: int
+	@param max_tmp: the limit on temporary disk usage (estimated from the archives' sizes)
+	@type max_tmp: int | None
+	@return: a result for each item, as each finishes (a dict with 'digest', 'archive', 'status', and 'error' if it failed)
+	@rtype: iterator"""
+	if jobs <= 1 or len(items) <= 1:
+		for item in items:
+			yield _add_item(stores, item)
+		return
+
+	import multiprocessing, collections
+	try:
+		import queue
+	except ImportError:
+		import Queue as queue		# Python 2
+	try:
+		SimpleQueue = multiprocessing.SimpleQueue
+	except AttributeError:
+		from multiprocessing.queues import SimpleQueue		# Python 2
+
+	pending = collections.deque(enumerate(items))
+	done = queue.Queue()		# (the pool calls our callback from another thread)
+	started = SimpleQueue()		# (written directly to the pipe, so it isn't lost if the worker dies)
+	in_flight = {}			# Item number -> (AsyncResult, BatchItem, estimated tmp space)
+	workers = {}			# Item number -> PID of the worker adding it
+	tmp_used = 0
+	pool = multiprocessing.Pool(min(jobs, len(items)), initializer = _init_worker, initargs = (stores, started))
+	try:
+		while pending or in_flight:
+			# Start as many as we can, keeping a few queued so the workers never wait for us
+			while pending and len(in_flight) < jobs * 2:
+				cost = _estimate_tmp(pending[0][1])
+				if in_flight and max_tmp is not None and tmp_used + cost > max_tmp:
+					break
+				n, item = pending.popleft()
+				async_result = pool.apply_async(_run_item, (n, item), callback = lambda result: done.put(None))
+				in_flight[n] = (async_result, item, cost)
+				tmp_used += cost
+
+			# Wait until something finishes, but check on the workers from time to time in case one died
+			try:
+				done.get(timeout = _POLL_INTERVAL)
+			except queue.Empty:
+				pass
+
+			while not started.empty():
+				n, pid = started.get()
+				workers[n] = pid
+			alive = None
+
+			for n in sorted(in_flight):
+				async_result, item, cost = in_flight[n]
+				if not async_result.ready():
+					if n not in workers:
+						continue		# Not started yet
+					if alive is None:
+						alive = set(child.pid for child in multiprocessing.active_children())
+					if workers[n] in alive:
+						continue
+					# The pool doesn't tell us about a worker which exits while adding an
+					# item, so its result would never arrive (unless it's still on its way)
+					async_result.wait(_POLL_INTERVAL)
+				if async_result.ready():
+					try:
+						result = async_result.get()
+					except Exception as ex:
+						result = _failed(item, '%s: %s' % (type(ex).__name__, ex))
+				else:
+					result = _failed(item, _("The worker process adding it exited unexpectedly"))
+				del in_flight[n]
+				workers.pop(n, None)
+				tmp_used -= cost
+				yield result
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
@@ -21,8 +21,24 @@ def init_stores():
 
 class UsageError(SafeException): pass
 
+def _parse_options(args, *options):
+	"""Parse the options given to a sub-command. Each option is a tuple of the arguments
+	to pass to OptionParser.add_option (with the keyword arguments as a final dict).
+	@type args: [str]
+	@return: the parsed options and the remaining arguments"""
+	from optparse import OptionParser
+	class Parser(OptionParser):
+		def error(self, msg):
+			raise UsageError(msg)
+	parser = Parser(add_help_option = False)
+	for option in options:
+		parser.add_option(*option[:-1], **option[-1])
+	return parser.parse_args(args)
+
 def do_manifest(args):
-	"""manifest DIRECTORY [ALGORITHM]"""
+	"""manifest [--cache] DIRECTORY [ALGORITHM]"""
+	options, args = _parse_options(args,
+			("--cache", {'action': 'store_true'}))
 	if len(args) < 1 or len(args) > 2: raise UsageError(_("Wrong number of arguments"))
 	if len(args) == 2:
 		alg = get_algorithm(args[1])
@@ -33,10 +49,19 @@ def do_manifest(args):
 			alg, unused = manifest.splitID(name)
 		except zerostore.BadDigest:
 			alg = get_algorithm('sha1new')
+	if options.cache:
+		from zeroinstall.zerostore import digestcache
+		cache = digestcache.DigestCache()
+	else:
+		cache = None
 	digest = alg.new_digest()
-	for line in alg.generate_manifest(args[0]):
-		print(line)
-		digest.update((line + '\n').encode('utf-8'))
+	try:
+		for line in alg.generate_manifest(args[0], cache = cache):
+			print(line)
+			digest.update((line + '\n').encode('utf-8'))
+	finally:
+		if cache is not None:
+			cache.save()
 	print(alg.getID(digest))
 	sys.exit(0)
 
@@ -52,16 +77,74 @@ def do_find(args):
 		print(ex, file=sys.stderr)
 	sys.exit(1)
 
+def do_gc(args):
+	"""gc [--max-size=SIZE] [--max-age=DAYS] [--dry-run] [--force] [DIRECTORY]"""
+	options, args = _parse_options(args,
+			("--max-size", {'metavar': 'SIZE'}),
+			("--max-age", {'type': 'float', 'metavar': 'DAYS'}),
+			("--dry-run", {'action': 'store_true'}),
+			("--force", {'action': 'store_true'}))
+	if options.max_size is None and options.max_age is None:
+		raise UsageError(_("Give a limit using --max-size and/or --max-age"))
+	if len(args) > 1: raise UsageError(_("Wrong number of arguments"))
+
+	import time
+	from zeroinstall.zerostore import evict, usage
+	max_size = None if options.max_size is None else evict.parse_size(options.max_size)
+	max_age = None if options.max_age is None else options.max_age * 24 * 60 * 60
+	store_dir = args[0] if args else stores.stores[0].dir
+	if not os.path.isdir(store_dir):
+		raise SafeException(_("No such directory '%s'") % store_dir)
+
+	# The usage log only records our own runs, so in a shared cache other users' implementations look unused
+	if os.path.realpath(store_dir) != os.path.realpath(stores.stores[0].dir):
+		if not (options.force or options.dry_run):
+			raise SafeException(_("'%s' is not your own cache. Your usage log doesn't record what other users "
+				"run from it, so gc might remove implementations they still need. Use --force to do it anyway.") % store_dir)
+		print(_("Warning: '%s' is not your own cache; only your own use of its implementations is known") % store_dir, file=sys.stderr)
+
+	if not options.dry_run:
+		evict.empty_trash(store_dir)		# Left over from an interrupted run
+
+	log = usage.get_log()
+	last_used = log.load()
+	items = evict.scan(store_dir, evict.get_pinned(), last_used)
+	unlogged = len([item for item in items if item.digest not in last_used])
+	if unlogged * 2 > len(items):
+		print(_("Warning: %(unlogged)d of %(total)d implementations have no record in the usage log, "
+			"so their age is taken from when they were added") % {'unlogged': unlogged, 'total': len(items)}, file=sys.stderr)
+	victims = evict.select(items, max_size, max_age)
+	for item in victims:
+		print(_("Removing %(digest)s (%(size)s, last used %(date)s)") % {
+			'digest': item.digest,
+			'size': support.pretty_size(item.size),
+			'date': time.strftime('%Y-%m-%d', time.localtime(item.last_used))})
+
+	if options.dry_run:
+		print(_("[dry-run] would free %s") % support.pretty_size(sum(item.size for item in victims)))
+		return
+
+	removed = evict.move_to_trash(store_dir, victims)
+	log.forget([item.digest for item in removed])
+	evict.empty_trash(store_dir, background = True)
+	freed = sum(item.size for item in removed)
+	print(_("Freed %(freed)s (%(remaining)s still in the cache)") % {
+		'freed': support.pretty_size(freed),
+		'remaining': support.pretty_size(sum(item.size for item in items) - freed)})
+
 def do_add(args):
-	"""add DIGEST (DIRECTORY | (ARCHIVE [EXTRACT]))"""
+	"""add [--link] DIGEST (DIRECTORY | (ARCHIVE [EXTRACT]))"""
 	from zeroinstall.zerostore import unpack
+	options, args = _parse_options(args,
+			("--link", {'action': 'store_true'}))
 	if len(args) < 2: raise UsageError(_("Missing arguments"))
 	digest = args[0]
 	if os.path.isdir(args[1]):
 		if len(args) > 2: raise UsageError(_("Too many arguments"))
-		stores.add_dir_to_cache(digest, args[1])
+		stores.add_dir_to_cache(digest, args[1], link = options.link)
 	elif os.path.isfile(args[1]):
 		if len(args) > 3: raise UsageError(_("Too many arguments"))
+		if options.link: raise UsageError(_("--link can only be used when adding a directory"))
 		if len(args) > 2:
 			extract = args[2]
 		else:
@@ -82,13 +165,45 @@ def do_add(args):
 				raise UsageError(str(ex))	# E.g. permission denied
 		raise UsageError(_("No such file or directory '%s'") % args[1])
 
+def do_add_batch(args):
+	"""add-batch [--jobs=N] [--max-tmp=SIZE] LIST"""
+	from zeroinstall.zerostore import batch, evict
+	import multiprocessing
+	options, args = _parse_options(args,
+			("--jobs", {'type': 'int', 'metavar': 'N'}),
+			("--max-tmp", {'default': '2G', 'metavar': 'SIZE'}))
+	if len(args) != 1: raise UsageError(_("Wrong number of arguments"))
+	jobs = options.jobs or multiprocessing.cpu_count()
+	if jobs < 1:
+		raise UsageError(_("--jobs must be at least 1"))
+	max_tmp = evict.parse_size(options.max_tmp)
+
+	if args[0] == '-':
+		items = batch.read_list(sys.stdin, os.getcwd())
+	else:
+		with open(args[0], 'rt') as stream:
+			items = batch.read_list(stream, os.path.dirname(os.path.abspath(args[0])))
+
+	counts = {'added': 0, 'present': 0, 'failed': 0}
+	for result in batch.add_batch(stores, items, jobs = jobs, max_tmp = max_tmp):
+		counts[result['status']] += 1
+		if result['status'] == 'failed':
+			print(_("Failed to add %(digest)s from %(archive)s: %(error)s") % result, file=sys.stderr)
+	print(_("Added %(added)d, already stored %(present)d, failed %(failed)d") % counts)
+	if counts['failed']:
+		sys.exit(1)
+
 def do_optimise(args):
-	"""optimise [ CACHE ]"""
+	"""optimise [--full] [--mode=hardlink|reflink|auto] [ CACHE ]"""
+	from . import optimise
+	options, args = _parse_options(args,
+			("--full", {'action': 'store_true'}),
+			("--mode", {'type': 'choice', 'choices': optimise.MODES, 'default': 'hardlink'}))
 	if len(args) == 1:
 		cache_dir = args[0]
 	else:
 		cache_dir = stores.stores[0].dir
-	
+
 	cache_dir = os.path.realpath(cache_dir)
 
 	import stat
@@ -103,9 +218,9 @@ def do_optimise(args):
 
 	print(_("Optimising"), cache_dir)
 
-	from . import optimise
-	uniq_size, dup_size, already_linked, man_size = optimise.optimise(cache_dir)
-	print(_("Original size  : %(size)s (excluding the %(manifest_size)s of manifests)") % {'size': support.pretty_size(uniq_size + dup_size), 'manifest_size': support.pretty_size(man_size)})
+	uniq_size, dup_size, already_linked, man_size = optimise.optimise(cache_dir, full = options.full, mode = options.mode)
+	# Implementations optimised by earlier runs are skipped, so these only cover the new ones
+	print(_("Scanned size   : %(size)s (excluding the %(manifest_size)s of manifests)") % {'size': support.pretty_size(uniq_size + dup_size), 'manifest_size': support.pretty_size(man_size)})
 	print(_("Already saved  : %s") % support.pretty_size(already_linked))
 	if dup_size == 0:
 		print(_("No duplicates found; no changes made."))
@@ -113,10 +228,20 @@ def do_optimise(args):
 		print(_("Optimised size : %s") % support.pretty_size(uniq_size))
 		perc = (100 * float(dup_size)) / (uniq_size + dup_size)
 		print(_("Space freed up : %(size)s (%(percentage).2f%%)") % {'size': support.pretty_size(dup_size), 'percentage': perc})
+
+	from . import pool
+	object_pool = pool.for_store(cache_dir)
+	if object_pool is not None:
+		print(_("Unused files removed from pool: %s") % support.pretty_size(object_pool.purge()))
 	print(_("Optimisation complete."))
 
 def do_verify(args):
-	"""verify (DIGEST | (DIRECTORY [DIGEST])"""
+	"""verify [--fast | --sample=PCT] (DIGEST | (DIRECTORY [DIGEST])"""
+	options, args = _parse_options(args,
+			("--fast", {'action': 'store_true'}),
+			("--sample", {'type': 'float', 'metavar': 'PCT'}))
+	if options.sample is not None and not 0 <= options.sample <= 100:
+		raise UsageError(_("--sample must be a percentage between 0 and 100"))
 	if len(args) == 2:
 		required_digest = args[1]
 		root = args[0]
@@ -128,7 +253,7 @@ def do_verify(args):
 
 	print(_("Verifying"), root)
 	try:
-		verify(root, required_digest)
+		verify(root, required_digest, fast = options.fast, sample = options.sample)
 		print(_("OK"))
 	except zerostore.BadDigest as ex:
 		print(str(ex))
@@ -137,70 +262,265 @@ def do_verify(args):
 			print(ex.detail)
 			sys.exit(1)
 
+def _audit_item(item):
+	"""Verify one implementation for L{do_audit}. This may run in a worker process.
+	@param item: the path and the required digest
+	@type item: (str, str)
+	@return: the result, suitable for JSON output
+	@rtype: {str: object}"""
+	import time
+	path, required_digest = item
+	result = {'path': path, 'digest': required_digest}
+	start = time.time()
+	try:
+		verify(path, required_digest)
+		result['status'] = 'ok'
+	except zerostore.BadDigest as ex:
+		result['status'] = 'failed'
+		result['error'] = str(ex)
+		result['detail'] = ex.detail
+	except (SafeException, EnvironmentError) as ex:
+		result['status'] = 'failed'
+		result['error'] = str(ex)
+	result['seconds'] = round(time.time() - start, 3)
+	# A successful verify read every file, so this is the number of bytes hashed.
+	# We don't know how far a failed one got.
+	result['bytes'] = None
+	if result['status'] == 'ok':
+		try:
+			from zeroinstall.zerostore import manifestindex
+			with manifestindex.load(path) as index:
+				result['bytes'] = index.total_size()
+		except Exception:
+			pass
+	return result
+
+def _audit_checkpoint_path(dirs):
+	"""Each set of directories gets its own checkpoint, so that concurrent audits of
+	different stores don't overwrite each other's.
+	@type dirs: [str]
+	@rtype: str"""
+	import hashlib
+	from zeroinstall.support import basedir
+	from zeroinstall.injector import namespaces
+	key = hashlib.sha256('\n'.join(sorted(dirs)).encode('utf-8')).hexdigest()[:16]
+	return os.path.join(basedir.save_cache_path(namespaces.config_site, namespaces.config_prog), 'audit-checkpoint-' + key)
+
+def _load_audit_checkpoint(checkpoint, dirs):
+	"""Read the results saved by an interrupted audit of the same directories.
+	@type checkpoint: str
+	@type dirs: [str]
+	@return: the results, indexed by path
+	@rtype: {str: {str: object}}"""
+	import json
+	results = {}
+	if not os.path.exists(checkpoint):
+		return results
+	try:
+		with open(checkpoint, 'rt') as stream:
+			header = json.loads(stream.readline())
+			if sorted(header.get('dirs') or []) != sorted(dirs):
+				print(_("Checkpoint is for a different set of directories; starting again"), file=sys.stderr)
+				return {}
+			for line in stream:
+				try:
+					result = json.loads(line)
+				except ValueError:
+					break		# Incomplete final line
+				results[result['path']] = result
+	except (EnvironmentError, ValueError) as ex:
+		print(_("Can't resume from checkpoint (%s); starting again") % ex, file=sys.stderr)
+		return {}
+	return results
+
 def do_audit(args):
-	"""audit [DIRECTORY]"""
+	"""audit [--jobs=N] [--json] [--resume] [--incremental [--max-age=DAYS]] [DIRECTORY]"""
+	import json, time
+	options, args = _parse_options(args,
+			("--jobs", {'type': 'int', 'default': 1, 'metavar': 'N'}),
+			("--json", {'action': 'store_true'}),
+			("--resume", {'action': 'store_true'}),
+			("--incremental", {'action': 'store_true'}),
+			("--max-age", {'type': 'float', 'default': 30, 'metavar': 'DAYS'}))
+	if options.jobs < 1:
+		raise UsageError(_("--jobs must be at least 1"))
+	if options.max_age < 0:
+		raise UsageError(_("--max-age can't be negative"))
+	def report(msg = '', end = '\n'):
+		if not options.json:
+			print(msg, end = end)
+
 	if len(args) == 0:
 		audit_stores = stores.stores
 	else:
 		audit_stores = [zerostore.Store(x) for x in args]
 
-	audit_ls = []
-	total = 0
+	todo = []
 	for a in audit_stores:
 		if os.path.isdir(a.dir):
-			items = sorted(os.listdir(a.dir))
-			audit_ls.append((a.dir, items))
-			total += len(items)
+			report(_("Scanning %s") % a.dir)
+			for required_digest in sorted(os.listdir(a.dir)):
+				if required_digest.startswith('.'):
+					continue		# Our .locks, .trash and .index directories
+				path = os.path.join(a.dir, required_digest)
+				try:
+					(alg, digest) = zerostore.parse_algorithm_digest_pair(required_digest)
+				except zerostore.BadDigest:
+					report(_("Skipping non-implementation directory %s") % path)
+					continue
+				todo.append((path, required_digest))
 		elif len(args):
 			raise SafeException(_("No such directory '%s'") % a.dir)
+	total = len(todo)
 
-	verified = 0
-	failures = []
-	i = 0
-	for root, impls in audit_ls:
-		print(_("Scanning %s") % root)
-		for required_digest in impls:
-			path = os.path.join(root, required_digest)
-			try:
-				(alg, digest) = zerostore.parse_algorithm_digest_pair(required_digest)
-			except zerostore.BadDigest:
-				print(_("Skipping non-implementation directory %s") % path)
-				continue
-			i += 1
+	# Record each result as we go, so that an interrupted audit can be resumed
+	dirs = [a.dir for a in audit_stores]
+	checkpoint = _audit_checkpoint_path(dirs)
+	done = _load_audit_checkpoint(checkpoint, dirs) if options.resume else {}
+	if done:
+		report(_("Resuming: %d items already checked") % len([path for path, digest in todo if path in done]))
+		checkpoint_stream = open(checkpoint, 'at')
+	else:
+		if options.resume:
+			report(_("Nothing to resume; starting a new audit"))
+		checkpoint_stream = open(checkpoint, 'wt')
+		checkpoint_stream.write(json.dumps({'dirs': dirs}) + '\n')
+		checkpoint_stream.flush()
+
+	results = [done[path] for path, digest in todo if path in done]
+	remaining = [item for item in todo if item[0] not in done]
+
+	# Skip items which haven't changed since they last verified OK, unless that was too long ago
+	if options.incremental:
+		from zeroinstall.zerostore import auditstate
+		state = auditstate.AuditState()
+		max_age = options.max_age * 24 * 60 * 60
+		fingerprints = {}
+		changed = []
+		for path, required_digest in remaining:
 			try:
-				msg = _("[%(done)d / %(total)d] Verifying %(digest)s") % {'done': i, 'total': total, 'digest': required_digest}
-				print(msg, end='')
+				fingerprints[path] = (auditstate.fingerprint(path), time.time())
+			except EnvironmentError:
+				pass		# verify will report the problem
+			else:
+				if state.is_unchanged(path, fingerprints[path][0], max_age):
+					results.append({'path': path, 'digest': required_digest, 'status': 'unchanged',
+							'verified_at': state.get_verified_at(path)})
+					continue
+			changed.append((path, required_digest))
+		if len(changed) < len(remaining):
+			report(_("Skipping %d items which haven't changed since they were last verified") % (len(remaining) - len(changed)))
+		remaining = changed
+	else:
+		state = None
+
+	failures = [result['path'] for result in results if result['status'] == 'failed']
+	if options.json:
+		for result in results:
+			print(json.dumps(result))
+
+	progress = ['']
+	def show_progress(msg):
+		progress[0] = msg
+		report(msg, end = '')
+		sys.stdout.flush()
+
+	if options.jobs > 1 and len(remaining) > 1:
+		import multiprocessing
+		pool = multiprocessing.Pool(min(options.jobs, len(remaining)))
+		new_results = pool.imap_unordered(_audit_item, remaining)
+	else:
+		pool = None
+		def check_each():
+			for item in remaining:
+				show_progress(_("[%(done)d / %(total)d] Verifying %(digest)s") % {'done': len(results) + 1, 'total': total, 'digest': item[1]})
+				yield _audit_item(item)
+		new_results = check_each()
+
+	try:
+		for result in new_results:
+			results.append(result)
+			checkpoint_stream.write(json.dumps(result) + '\n')
+			checkpoint_stream.flush()
+			if pool is not None:
+				show_progress(_("[%(done)d / %(total)d] Verified %(digest)s") % {'done': len(results), 'total': total, 'digest': result['digest']})
+			if options.json:
+				print(json.dumps(result))
 				sys.stdout.flush()
-				verify(path, required_digest)
-				print("\r" + (" " * len(msg)) + "\r", end='')
-				verified += 1
-			except zerostore.BadDigest as ex:
-				print()
-				failures.append(path)
-				print(str(ex))
-				if ex.detail:
-					print()
-					print(ex.detail)
+			if state is not None:
+				if result['status'] == 'ok' and result['path'] in fingerprints:
+					fp, fp_time = fingerprints[result['path']]
+					state.record(result['path'], fp, fp_time)
+				else:
+					state.forget(result['path'])
+			if result['status'] == 'ok':
+				report("\r" + (" " * len(progress[0])) + "\r", end='')
+			else:
+				failures.append(result['path'])
+				report()
+				report(result['error'])
+				if result.get('detail'):
+					report()
+					report(result['detail'])
+	finally:
+		checkpoint_stream.close()
+		if pool is not None:
+			pool.terminate()
+		if state is not None:
+			state.save()
+
+	# Finished (even if some items failed), so there's nothing to resume
+	os.unlink(checkpoint)
+
 	if failures:
-		print('\n' + _("List of corrupted or modified implementations:"))
+		report('\n' + _("List of corrupted or modified implementations:"))
 		for x in failures:
-			print(x)
-		print()
-	print(_("Checked %d items") % i)
-	print(_("Successfully verified implementations: %d") % verified)
-	print(_("Corrupted or modified implementations: %d") % len(failures))
+			report(x)
+		report()
+	unchanged = len([result for result in results if result['status'] == 'unchanged'])
+	report(_("Checked %d items") % total)
+	if unchanged:
+		report(_("Unchanged since last verified: %d") % unchanged)
+	report(_("Successfully verified implementations: %d") % (len(results) - len(failures) - unchanged))
+	report(_("Corrupted or modified implementations: %d") % len(failures))
 	if failures:
 		sys.exit(1)
 
 def do_list(args):
-	"""list"""
+	"""list [--usage]"""
+	options, args = _parse_options(args,
+			("--usage", {'action': 'store_true'}))
 	if args: raise UsageError(_("List takes no arguments"))
+	if options.usage:
+		from zeroinstall.zerostore import usage
+		last_used = usage.get_log().load()
 	print(_("User store (writable) : %s") % stores.stores[0].dir)
+	if options.usage:
+		_list_usage(stores.stores[0].dir, last_used)
 	for s in stores.stores[1:]:
 		print(_("System store          : %s") % s.dir)
+		if options.usage:
+			_list_usage(s.dir, last_used)
 	if len(stores.stores) < 2:
 		print(_("No system stores."))
 
+def _list_usage(store_dir, last_used):
+	"""Print the size and last use of each implementation in a store, least recently used first.
+	Implementations with no record in the usage log are listed first, as "unused"."""
+	import time
+	from zeroinstall.zerostore import evict
+	if not os.path.isdir(store_dir): return
+	items = evict.scan(store_dir, set(), last_used)
+	for item in sorted(items, key = lambda item: (item.digest in last_used, item.last_used)):
+		if item.digest in last_used:
+			date = time.strftime('%Y-%m-%d', time.localtime(item.last_used))
+		else:
+			date = _('unused')
+		print("  %-10s %10s  %s" % (date, support.pretty_size(item.size), item.digest))
+	print(_("  Total: %(size)s in %(n)d implementations") % {
+		'size': support.pretty_size(sum(item.size for item in items)),
+		'n': len(items)})
+
 def get_stored(dir_or_digest):
 	"""@type dir_or_digest: str
 	@rtype: str"""
@@ -236,4 +556,4 @@ def do_copy(args):
 
 	copy_tree_with_verify(source, target, manifest_data, required_digest)
 
-commands = [do_add, do_audit, do_copy, do_find, do_list, do_manifest, do_optimise, do_verify]
+commands = [do_add, do_add_batch, do_audit, do_copy, do_find, do_gc, do_list, do_manifest, do_optimise, do_verify]
@@ -0,0 +1,135 @@
+"""A persistent cache of the digests of regular files.
+
+Calculating the manifest of a large directory tree means reading every file in it. When the same
+tree is processed repeatedly (e.g. "0install digest" on a developer's working copy), most of the
+files haven't changed since last time. This cache remembers the digest of each file we hash,
+indexed by its device, inode, size, modification time and change time, so that unchanged files
+can be skipped. The change time can't be set by tools that preserve modification times (e.g.
+"cp -p" or "touch -r"), so files rewritten in-place by them are still detected.
+
+The cache is only an optimisation for trusted local trees, and is only used when asked for
+(e.g. "0install digest --cache"). It must never be used when checking implementations (e.g.
+adding to or verifying a store).
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger
+from zeroinstall.support import basedir, portable_rename
+from zeroinstall.injector import namespaces
+import os, threading, collections
+
+#: The maximum number of digests to remember. When the cache is full, the least recently used ones are dropped.
+MAX_ENTRIES = 100000
+
+# A file modified within this many seconds of us hashing it may be changed again without its
+# mtime changing (on file-systems with coarse timestamps), so we don't cache its digest.
+RACY_SECONDS = 2
+
+_FORMAT = 2
+
+def _time_ns(info, name):
+	value = getattr(info, 'st_%s_ns' % name, None)
+	if value is None:
+		value = int(getattr(info, 'st_' + name) * 1000000000)		# Python 2
+	return value
+
+class DigestCache(object):
+	"""Maps (hash function, device, inode, size, mtime, ctime) to the hex digest of a file's contents.
+	Entries are loaded when the cache is created and only written back by L{save}.
+	It is safe to use the cache from several threads at once.
+	@ivar path: the file holding the cache
+	@type path: str
+	@ivar max_entries: the number of entries to keep when saving
+	@type max_entries: int
+	@since: 2.5"""
+
+	def __init__(self, path = None, max_entries = MAX_ENTRIES):
+		"""@param path: the cache file (default: ~/.cache/0install.net/injector/digests)
+		@type path: str | None
+		@type max_entries: int"""
+		if path is None:
+			path = os.path.join(basedir.save_cache_path(namespaces.config_site, namespaces.config_prog), 'digests')
+		self.path = path
+		self.max_entries = max_entries
+		self._entries = collections.OrderedDict()	# Least recently used first
+		self._lock = threading.Lock()
+		self._dirty = False
+		try:
+			self._load()
+		except Exception as ex:
+			logger.info(_("Failed to load digest cache %(path)s (%(error)s). Ignoring it."), {'path': path, 'error': ex})
+			self._entries.clear()
+
+	def _load(self):
+		if not os.path.exists(self.path): return
+		entries = self._entries
+		with open(self.path, 'rt') as stream:
+			header = stream.readline()
+			if header != 'format=%d\n' % _FORMAT:
+				raise Exception(_("Unknown format %s") % repr(header.strip()))
+			for line in stream:
+				key, digest = line.rsplit(' ', 1)
+				entries[key] = digest.rstrip('\n')
+
+	def _key(self, hash_name, info):
+		return "%s %d %d %d %d %d" % (hash_name, info.st_dev, info.st_ino, info.st_size, _time_ns(info, 'mtime'), _time_ns(info, 'ctime'))
+
+	def lookup(self, hash_name, info):
+		"""Get the cached digest of a file, if known.
+		@param hash_name: the name of the hash function (e.g. "sha256")
+		@type hash_name: str
+		@param info: the result of stat'ing the file
+		@return: the hex digest, or None if not cached
+		@rtype: str | None"""
+		key = self._key(hash_name, info)
+		with self._lock:
+			digest = self._entries.pop(key, None)
+			if digest is not None:
+				self._entries[key] = digest		# Mark as most recently used
+				self._dirty = True
+			return digest
+
+	def add(self, hash_name, info, digest, started):
+		"""Record the digest of a file.
+		@param hash_name: the name of the hash function (e.g. "sha256")
+		@type hash_name: str
+		@param info: the result of stat'ing the file before reading it
+		@param digest: the hex digest of its contents
+		@type digest: str
+		@param started: when we started reading the file (as returned by time.time())
+		@type started: float"""
+		if info.st_mtime > started - RACY_SECONDS:
+			return		# Could still be changing
+		key = self._key(hash_name, info)
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = digest
+			self._dirty = True
+
+	def save(self):
+		"""Write the cache back to disk, if it has changed, keeping only the most recently used
+		L{max_entries} entries. Failures are logged, but otherwise ignored."""
+		with self._lock:
+			if not self._dirty: return
+			entries = self._entries
+			while len(entries) > self.max_entries:
+				entries.popitem(last = False)
+			try:
+				import tempfile
+				tmp = tempfile.NamedTemporaryFile(mode = 'wt', dir = os.path.dirname(self.path), delete = False)
+				try:
+					tmp.write('format=%d\n' % _FORMAT)
+					for key, digest in entries.items():
+						tmp.write('%s %s\n' % (key, digest))
+					tmp.close()
+					portable_rename(tmp.name, self.path)
+				except:
+					tmp.close()
+					os.unlink(tmp.name)
+					raise
+			except Exception as ex:
+				logger.warning(_("Failed to save digest cache %(path)s: %(error)s"), {'path': self.path, 'error': ex})
+			else:
+				self._dirty = False
@@ -0,0 +1,263 @@
+"""Removing old implementations from a store ("0store gc").
+
+Implementations are never removed automatically, so a store keeps growing as new versions are
+downloaded. This module chooses which implementations to remove to bring a store within a size
+limit and/or to remove those which haven't been used for a while, least-recently-used first.
+
+When each implementation was last used is taken from the usage log (see L{usage}). For
+implementations with no record there, we only know when they were added.
+
+Implementations can be pinned (never removed) by listing their digests, one per line, in a
+0install.net/injector/pinned-implementations file in any of the XDG config directories.
+
+Removal is crash-safe: each implementation is first renamed into a trash directory inside the
+store (so it disappears from the store atomically), and the trash is then deleted. Anything left
+in the trash by an interrupted run is deleted by the next one.
+
+The process deleting the trash first claims it by renaming it into a directory named after its
+process ID, so several runs can empty the trash at the same time without deleting the same files.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger, support, SafeException
+from zeroinstall.support import basedir
+import os, errno
+
+#: The name of the trash directory inside each store (not a valid digest, so never looked up)
+TRASH_NAME = '.trash'
+
+_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(value):
+	"""Parse a size such as "500M" or "10GB" (the units are powers of 1024, as for L{support.pretty_size}).
+	@type value: str
+	@rtype: int
+	@raise SafeException: if it can't be parsed"""
+	import re
+	m = re.match(r'^\s*([0-9]+(?:\.[0-9]*)?)\s*([KMGT]?)(?:i?B)?\s*$', value, re.IGNORECASE)
+	if not m:
+		raise SafeException(_("Invalid size '%s' (should be e.g. '500M' or '10G')") % value)
+	return int(float(m.group(1)) * _units[m.group(2).upper()])
+
+def get_pinned():
+	"""Get the digests of the implementations which must never be removed.
+	@rtype: {str}"""
+	pinned = set()
+	for path in basedir.load_config_paths('0install.net', 'injector', 'pinned-implementations'):
+		with open(path, 'rt') as stream:
+			for line in stream:
+				line = line.strip()
+				if line and not line.startswith('#'):
+					pinned.add(line)
+	return pinned
+
+def get_size(path):
+	"""The total size of the files in an implementation (including its manifest).
+	@type path: str
+	@rtype: int"""
+	from zeroinstall.zerostore import manifestindex, BadDigest
+	try:
+		with manifestindex.load(path) as index:
+			return index.total_size() + os.path.getsize(os.path.join(path, '.manifest'))
+	except (EnvironmentError, BadDigest) as ex:
+		logger.info(_("Can't read manifest for %(path)s: %(error)s"), {'path': path, 'error': ex})
+		size = 0
+		for root, dirs, files in os.walk(path):
+			for name in files:
+				size += os.lstat(os.path.join(root, name)).st_size
+		return size
+
+def get_last_used(path, logged = None):
+	"""Get when an implementation was last used. This is the time in the usage log, if any (see
+	L{usage}), or else its directory's modification time (i.e. when it was added). Access times
+	aren't used, as they're not updated on file-systems mounted with "noatime" and are updated
+	by things that don't use the implementation (e.g. backups or "0store audit").
+	@type path: str
+	@param logged: the time from the usage log
+	@type logged: float | None
+	@rtype: float"""
+	mtime = os.stat(path).st_mtime
+	if logged is not None:
+		return max(logged, mtime)
+	return mtime
+
+class Item(object):
+	"""An implementation in a store.
+	@ivar digest: the name of its directory
+	@type digest: str
+	@ivar path: the full path of its directory
+	@type path: str
+	@ivar size: the total size of its files
+	@type size: int
+	@ivar last_used: when it was last used (see L{get_last_used})
+	@type last_used: float
+	@ivar pinned: whether it must not be removed
+	@type pinned: bool
+	@since: 2.5"""
+
+	__slots__ = ['digest', 'path', 'size', 'last_used', 'pinned']
+
+	def __init__(self, digest, path, size, last_used, pinned):
+		self.digest = digest
+		self.path = path
+		self.size = size
+		self.last_used = last_used
+		self.pinned = pinned
+
+def scan(store_dir, pinned, last_used = None):
+	"""List the implementations in a store.
+	@type store_dir: str
+	@param pinned: the digests of implementations which must be kept
+	@type pinned: {str}
+	@param last_used: the times from the usage log (see L{usage.UsageLog.load})
+	@type last_used: {str: float} | None
+	@rtype: [L{Item}]"""
+	last_used = last_used or {}
+	from zeroinstall.zerostore import parse_algorithm_digest_pair, BadDigest
+	items = []
+	for name in os.listdir(store_dir):
+		try:
+			parse_algorithm_digest_pair(name)
+		except BadDigest:
+			continue		# Temporary directory, etc
+		path = os.path.join(store_dir, name)
+		items.append(Item(name, path, get_size(path), get_last_used(path, last_used.get(name, None)), name in pinned))
+	return items
+
+def select(items, max_size = None, max_age = None, now = None):
+	"""Choose which implementations to remove: any not used within the last max_age seconds,
+	and then the least recently used ones until the total size is no more than max_size.
+	Pinned items are never chosen.
+	@type items: [L{Item}]
+	@param max_size: the maximum total size of the items to keep, in bytes
+	@type max_size: int | None
+	@param max_age: remove items not used for this many seconds
+	@type max_age: float | None
+	@param now: the current time (default: time.time())
+	@type now: float | None
+	@return: the items to remove, least recently used first
+	@rtype: [L{Item}]"""
+	if now is None:
+		import time
+		now = time.time()
+	total = sum(item.size for item in items)
+	victims = []
+	for item in sorted((item for item in items if not item.pinned), key = lambda item: item.last_used):
+		too_old = max_age is not None and now - item.last_used > max_age
+		too_big = max_size is not None and total > max_size
+		if not (too_old or too_big):
+			break		# Everything else was used more recently
+		victims.append(item)
+		total -= item.size
+	return victims
+
+def move_to_trash(store_dir, items):
+	"""Move implementations into the store's trash directory. After this, they are no longer
+	in the store, but still use disk space until L{empty_trash} is called.
+	Items which can't be moved are logged and skipped.
+	@type store_dir: str
+	@type items: [L{Item}]
+	@return: the items moved
+	@rtype: [L{Item}]"""
+	from zeroinstall.zerostore import manifestindex
+	trash = os.path.join(store_dir, TRASH_NAME)
+	if not os.path.isdir(trash):
+		os.mkdir(trash, 0o700)
+	moved = []
+	for item in items:
+		old_mode = None
+		try:
+			old_mode = os.stat(item.path).st_mode
+			os.chmod(item.path, 0o755)		# Need write permission to change its parent
+			os.rename(item.path, os.path.join(trash, item.digest))
+		except OSError as ex:
+			logger.warning(_("Failed to remove %(path)s: %(error)s"), {'path': item.path, 'error': ex})
+			if old_mode is not None and os.path.isdir(item.path):
+				os.chmod(item.path, old_mode)
+			continue
+		try:
+			manifestindex.remove_index(item.path)
+		except OSError as ex:
+			logger.info(_("Failed to remove manifest index for %(path)s: %(error)s"), {'path': item.path, 'error': ex})
+		moved.append(item)
+	return moved
+
+def _is_running(pid):
+	"""@type pid: int
+	@rtype: bool"""
+	if not hasattr(os, 'fork'):
+		return False		# We never empty the trash in the background on this platform
+	try:
+		os.kill(pid, 0)
+	except OSError as ex:
+		return ex.errno != errno.ESRCH
+	return True
+
+def _get_trashes(store_dir):
+	"""Get the names of the trash directories which need deleting: the trash itself, and any
+	claimed by processes which no longer exist (see L{empty_trash}).
+	@type store_dir: str
+	@rtype: [str]"""
+	trashes = []
+	for name in os.listdir(store_dir):
+		if name == TRASH_NAME:
+			trashes.append(name)
+		elif name.startswith(TRASH_NAME + '-'):
+			try:
+				pid = int(name[len(TRASH_NAME) + 1:])
+			except ValueError:
+				continue
+			if not _is_running(pid):
+				trashes.append(name)
+	return trashes
+
+def empty_trash(store_dir, background = False):
+	"""Delete everything in the store's trash directory. Then, since the files may have been
+	the last users of some files in the store's pool (see L{pool}), purge the pool too.
+	The trash is first claimed by renaming it into a new directory named after the deleting
+	process, which is then deleted. Another process emptying the trash at the same time
+	therefore won't try to delete the same files. Trash claimed by a process which was
+	interrupted is claimed again and deleted too.
+	@type store_dir: str
+	@param background: do it in a new process, and return without waiting for it
+	@type background: bool"""
+	trash = os.path.join(store_dir, TRASH_NAME)
+	if not _get_trashes(store_dir):
+		return
+
+	def delete():
+		from zeroinstall.zerostore import pool
+		mine = '%s-%d' % (trash, os.getpid())
+		if os.path.lexists(mine):
+			support.ro_rmtree(mine)		# Left by an earlier process with the same ID
+		os.mkdir(mine, 0o700)
+		for name in _get_trashes(store_dir):
+			try:
+				os.rename(os.path.join(store_dir, name), os.path.join(mine, name))
+			except OSError as ex:
+				if ex.errno != errno.ENOENT:
+					raise
+				# Someone else claimed it first
+		support.ro_rmtree(mine)
+		object_pool = pool.for_store(store_dir)
+		if object_pool is not None:
+			object_pool.purge()
+
+	if not (background and hasattr(os, 'fork')):
+		delete()
+		return
+
+	# Double-fork, so the deleting process isn't our child
+	child = os.fork()
+	if child == 0:
+		try:
+			if os.fork() == 0:
+				try:
+					delete()
+				except Exception as ex:
+					logger.warning(_("Failed to empty trash %(path)s: %(error)s"), {'path': trash, 'error': ex})
+		finally:
+			os._exit(0)
+	os.waitpid(child, 0)
@@ -0,0 +1,209 @@
+"""Copying files using the fastest method the kernel and file-system support.
+
+We try, in order:
+ - reflink: share the source's extents (btrfs, XFS, etc; no data is copied at all)
+ - copy_file_range: copy inside the kernel (can also use server-side copy on NFS)
+ - sendfile: copy inside the kernel, but without any file-system help
+ - userspace: read and write the data ourselves
+
+The kernel methods are only available on some platforms and Python versions.
+When one fails because it isn't supported, we don't try it again for that pair of devices.
+Some file-systems report success without copying everything (e.g. copy_file_range returns 0
+for some FUSE or overlay files, or across file-systems on older kernels), so a method only
+counts as working if the copy ends up the same size as the source.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger, support
+import os, sys, errno
+
+BLOCK_SIZE = 1024 * 1024
+
+# _IOW(0x94, 9, int) from <linux/fs.h>
+_FICLONE = 0x40049409
+
+# _IOWR(0x94, 54, struct file_dedupe_range) from <linux/fs.h>
+_FIDEDUPERANGE = 0xc0189436
+_FILE_DEDUPE_RANGE_DIFFERS = 1
+
+# Errors which just mean that a method can't be used with these files
+_unsupported_errors = set(getattr(errno, name) for name in
+		['EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EXDEV', 'EINVAL', 'ENOSYS', 'EBADF', 'ETXTBSY']
+		if hasattr(errno, name))
+
+# (method, src_dev, dst_dev) combinations known not to work
+_unsupported = set()
+
+def _reflink(src_fd, dst_fd):
+	import fcntl
+	fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd):
+	while True:
+		sent = os.copy_file_range(src_fd, dst_fd, BLOCK_SIZE * 16)
+		if not sent: break
+
+def _sendfile(src_fd, dst_fd):
+	offset = 0
+	while True:
+		sent = os.sendfile(dst_fd, src_fd, offset, BLOCK_SIZE * 16)
+		if not sent: break
+		offset += sent
+
+def _userspace(src_fd, dst_fd, digest = None):
+	buf = bytearray(BLOCK_SIZE)
+	view = memoryview(buf)
+	with os.fdopen(os.dup(src_fd), 'rb') as src:
+		while True:
+			got = src.readinto(buf)
+			if not got: break
+			data = view[:got]
+			if digest is not None:
+				digest.update(data)
+			while data:
+				written = os.write(dst_fd, data)
+				assert written >= 0
+				data = data[written:]
+
+_kernel_methods = []
+if sys.platform.startswith('linux'):
+	_kernel_methods.append(('reflink', _reflink))
+if hasattr(os, 'copy_file_range'):
+	_kernel_methods.append(('copy_file_range', _copy_file_range))
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+	_kernel_methods.append(('sendfile', _sendfile))
+
+#: The names of the kernel methods available on this system, in the order we try them.
+#: The 'userspace' method is always available as a final fallback.
+methods = tuple(name for name, fn in _kernel_methods)
+
+def dedupe(src_fd, dst_fd, length):
+	"""Make dst_fd share the file-system extents of src_fd, if their contents are identical.
+	The kernel compares the data itself, and nothing is changed if the files differ. Unlike a
+	hard-link, the two files keep their own inodes (and so their own permissions and times).
+	This needs a file-system supporting FIDEDUPERANGE (e.g. btrfs or XFS), and Linux 4.5 or later.
+	@param length: the number of bytes to dedupe (normally the size of both files)
+	@type length: int
+	@return: False if the contents differ
+	@rtype: bool
+	@raise OSError: (or IOError on Python 2) if deduping isn't supported"""
+	import fcntl, struct, array
+	offset = 0
+	while offset < length:
+		# struct file_dedupe_range, with a single struct file_dedupe_range_info
+		arg = array.array('B', struct.pack('=QQHHIqQQiI', offset, length - offset, 1, 0, 0, dst_fd, offset, 0, 0, 0))
+		fcntl.ioctl(src_fd, _FIDEDUPERANGE, arg, True)
+		deduped, status = struct.unpack_from('=Qi', arg, 40)
+		if status < 0:
+			raise OSError(-status, os.strerror(-status))
+		if status == _FILE_DEDUPE_RANGE_DIFFERS:
+			return False
+		if deduped == 0:
+			raise OSError(errno.EINVAL, _("No progress deduping file"))
+		offset += deduped
+	return True
+
+class CopyStats(object):
+	"""Counts how much data was copied using each method.
+	@ivar bytes: the number of bytes copied with each method
+	@type bytes: {str: int}
+	@ivar files: the number of files copied with each method
+	@type files: {str: int}"""
+
+	__slots__ = ['bytes', 'files']
+
+	def __init__(self):
+		self.bytes = {}
+		self.files = {}
+
+	def add(self, method, size):
+		"""@type method: str
+		@type size: int"""
+		self.bytes[method] = self.bytes.get(method, 0) + size
+		self.files[method] = self.files.get(method, 0) + 1
+
+	def log(self, what):
+		"""Log a summary at level INFO.
+		@param what: description of the operation (e.g. the target directory)
+		@type what: str"""
+		if not self.files:
+			return
+		summary = ', '.join(_("%(method)s: %(files)d files, %(size)s") %
+				{'method': method, 'files': self.files[method], 'size': support.pretty_size(self.bytes[method])}
+				for method in sorted(self.files))
+		logger.info(_("Copied %(what)s (%(summary)s)"), {'what': what, 'summary': summary})
+
+def kernel_copy(src_fd, dst_fd, allowed = None):
+	"""Try to copy the contents of src_fd to the empty file dst_fd without reading the data
+	into userspace. On failure, dst_fd is left empty and both offsets are reset to zero.
+	Empty files aren't copied this way, since the source may be a special file whose real size
+	isn't known (e.g. in /proc).
+	@param allowed: the methods to try (default: all available, see L{methods})
+	@type allowed: [str] | None
+	@return: the name of the method used, or None if none of them worked
+	@rtype: str | None"""
+	src_info = os.fstat(src_fd)
+	if not src_info.st_size:
+		return None
+	src_dev = src_info.st_dev
+	dst_dev = os.fstat(dst_fd).st_dev
+	for name, fn in _kernel_methods:
+		if allowed is not None and name not in allowed:
+			continue
+		key = (name, src_dev, dst_dev)
+		if key in _unsupported:
+			continue
+		try:
+			fn(src_fd, dst_fd)
+			copied = os.fstat(dst_fd).st_size
+			if copied == src_info.st_size:
+				return name
+			_unsupported.add(key)
+			logger.debug(_("Copying using %(method)s gave %(copied)d bytes, not %(size)d"),
+					{'method': name, 'copied': copied, 'size': src_info.st_size})
+		except (OSError, IOError) as ex:
+			if ex.errno in _unsupported_errors:
+				_unsupported.add(key)
+			logger.debug(_("Can't copy using %(method)s: %(error)s"), {'method': name, 'error': ex})
+		os.ftruncate(dst_fd, 0)
+		os.lseek(dst_fd, 0, 0)
+		os.lseek(src_fd, 0, 0)
+	return None
+
+def copy_file(src, dst, mode = 0o644, stats = None, allowed = None, digest = None):
+	"""Copy the contents of file src to a new file dst (which must not exist),
+	using the fastest method available. dst is created with a mode of 'mode & umask'.
+	@type src: str
+	@type dst: str
+	@type mode: int
+	@param stats: if given, record the method used here
+	@type stats: L{CopyStats} | None
+	@param allowed: the kernel methods to try (default: all available, see L{methods})
+	@type allowed: [str] | None
+	@param digest: if given, the caller wants to hash the file too. Only reflinks are tried, since
+	they don't copy any data; otherwise, the data is fed into digest as it's copied through userspace
+	(so that it's only read once), and the method returned is 'userspace'.
+	@return: the method used
+	@rtype: str"""
+	if digest is not None:
+		allowed = [name for name in (methods if allowed is None else allowed) if name == 'reflink']
+	binary = getattr(os, 'O_BINARY', 0)
+	src_fd = os.open(src, os.O_RDONLY | binary)
+	try:
+		dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | binary, mode)
+		try:
+			method = kernel_copy(src_fd, dst_fd, allowed)
+			if method is None:
+				method = 'userspace'
+				_userspace(src_fd, dst_fd, digest)
+			size = os.fstat(dst_fd).st_size
+		finally:
+			os.close(dst_fd)
+	finally:
+		os.close(src_fd)
+	logger.debug(_("Copied %(src)s using %(method)s"), {'src': src, 'method': method})
+	if stats is not None:
+		stats.add(method, size)
+	return method
@@ -0,0 +1,131 @@
+"""Per-digest locks, so that processes adding the same implementation don't duplicate the work.
+
+Several processes often try to add the same implementation at once (e.g. when many jobs on a
+build host start the same program). Without locking, each one unpacks and hashes its own copy and
+all but the first then throw theirs away. Instead, an importer takes an exclusive lock on
+".locks/DIGEST" in the store first. Anyone else wanting the same digest waits, and then finds it
+already stored.
+
+The locks are fcntl (flock) locks, so they are released automatically if the holder dies. The
+lock file records the holder's temporary directory; if a process gets the lock and finds a
+record left behind by a crashed holder, it deletes that directory. Lock files are removed when
+released.
+
+On platforms without fcntl, or if the lock file can't be created (e.g. a read-only store),
+importing continues without a lock.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger, support
+import os, errno
+
+#: The name of the directory of lock files inside each store (not a valid digest, so never looked up)
+LOCKS_NAME = '.locks'
+
+class DigestLock(object):
+	"""An exclusive lock on adding one digest to a store. Use as a context manager.
+	@ivar path: the lock file
+	@type path: str
+	@since: 2.5"""
+
+	def __init__(self, store_dir, digest, dry_run = False):
+		"""@type store_dir: str
+		@type digest: str
+		@param dry_run: don't really lock (or create the lock file)
+		@type dry_run: bool"""
+		self.store_dir = store_dir
+		self.digest = digest
+		self.path = os.path.join(store_dir, LOCKS_NAME, digest)
+		self.dry_run = dry_run
+		self._fd = None
+
+	def _open(self):
+		try:
+			return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+		except OSError as ex:
+			if ex.errno != errno.ENOENT:
+				raise
+			try:
+				os.makedirs(os.path.dirname(self.path))
+			except OSError as ex:
+				if ex.errno != errno.EEXIST:
+					raise
+			return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+	def acquire(self):
+		"""Wait until we hold the lock. If the previous holder crashed, remove its temporary directory.
+		@return: whether we got the lock (False if locking isn't possible here, or in dry-run mode)
+		@rtype: bool"""
+		if self.dry_run:
+			return False
+		try:
+			import fcntl
+		except ImportError:
+			return False
+		while True:
+			try:
+				fd = self._open()
+			except OSError as ex:
+				logger.info(_("Can't create lock file %(path)s: %(error)s"), {'path': self.path, 'error': ex})
+				return False
+			try:
+				try:
+					fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except (IOError, OSError) as ex:
+					if ex.errno not in (errno.EAGAIN, errno.EACCES):
+						raise
+					logger.info(_("Waiting for another process to finish adding %s"), self.digest)
+					fcntl.flock(fd, fcntl.LOCK_EX)
+				# The holder may have removed the file before we locked it
+				try:
+					current = os.stat(self.path)
+				except OSError:
+					current = None
+				ours = os.fstat(fd)
+				if current is not None and (current.st_dev, current.st_ino) == (ours.st_dev, ours.st_ino):
+					break
+			except:
+				os.close(fd)
+				raise
+			os.close(fd)
+		self._fd = fd
+		self._remove_stale_tmp()
+		return True
+
+	def _remove_stale_tmp(self):
+		os.lseek(self._fd, 0, 0)
+		old_tmp = os.read(self._fd, 4096).decode('utf-8')
+		if not old_tmp: return
+		# Only ever delete our own temporary directories
+		if os.path.dirname(old_tmp) == os.path.normpath(self.store_dir) and os.path.basename(old_tmp).startswith('tmp-') and os.path.isdir(old_tmp):
+			logger.warning(_("Removing %s, left by an interrupted import"), old_tmp)
+			support.ro_rmtree(old_tmp)
+		self.set_tmp(None)
+
+	def set_tmp(self, tmp):
+		"""Record our temporary directory, so it can be removed if we crash while holding the lock.
+		@type tmp: str | None"""
+		if self._fd is None: return
+		os.ftruncate(self._fd, 0)
+		if tmp is not None:
+			os.lseek(self._fd, 0, 0)
+			os.write(self._fd, tmp.encode('utf-8'))
+
+	def release(self):
+		"""Remove the lock file and release the lock."""
+		if self._fd is None: return
+		try:
+			os.unlink(self.path)		# (before unlocking, so waiters will see it has gone)
+		except OSError as ex:
+			logger.info(_("Can't remove lock file %(path)s: %(error)s"), {'path': self.path, 'error': ex})
+		os.close(self._fd)
+		self._fd = None
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.release()
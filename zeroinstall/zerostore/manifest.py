@@ -26,7 +26,7 @@ A top-level ".manifest" file is ignored.
 
 
 import os, sys, stat, base64
-from zeroinstall import SafeException, _, logger
+from zeroinstall import SafeException, _, logger, support
 from zeroinstall.zerostore import BadDigest, parse_algorithm_digest_pair, format_algorithm_digest_pair
 
 # unicode compat
@@ -38,15 +38,137 @@ else:
 import hashlib
 sha1_new = hashlib.sha1
 
+# Files are hashed in blocks of this many bytes, so that memory use doesn't
+# depend on the size of the largest file in the tree.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def _digest_file(digest, path, block_size = None):
+	"""Feed the contents of the regular file 'path' into 'digest', one block at a time.
+	@param digest: a digest object (as returned by L{Algorithm.new_digest})
+	@param path: the file to read
+	@type path: str
+	@param block_size: the number of bytes to read at once (default L{HASH_BLOCK_SIZE})
+	@type block_size: int | None
+	@return: digest"""
+	buf = bytearray(block_size or HASH_BLOCK_SIZE)
+	view = memoryview(buf)
+	with open(path, 'rb') as stream:
+		while True:
+			got = stream.readinto(buf)
+			if not got: break
+			digest.update(view[:got])
+	return digest
+
+def default_jobs():
+	"""The number of files to hash in parallel if the caller doesn't specify.
+	This is taken from $ZEROINSTALL_MANIFEST_JOBS ("0" means one per CPU).
+	If it isn't set, files are hashed one at a time.
+	@rtype: int"""
+	value = os.environ.get('ZEROINSTALL_MANIFEST_JOBS')
+	if not value:
+		return 1
+	try:
+		jobs = int(value)
+		if jobs < 0: raise ValueError(value)
+	except ValueError:
+		logger.warning(_("Invalid $ZEROINSTALL_MANIFEST_JOBS '%s'; hashing one file at a time"), value)
+		return 1
+	if jobs == 0:
+		import multiprocessing
+		try:
+			jobs = multiprocessing.cpu_count()
+		except NotImplementedError:
+			jobs = 1
+	return jobs
+
+def _hash_files(items, new_digest, jobs, digests = None, cache = None):
+	"""Turn the output of a manifest walk into manifest lines.
+	'items' yields either finished lines or, for regular files, (type, path, rest) tuples
+	where the line is "type digest rest". Lines come out in the same order as the items
+	go in. If jobs > 1, a pool of threads reads and hashes the files (hashlib releases the
+	GIL while hashing), reading ahead of the consumer by a few files.
+	@type new_digest: () -> digest
+	@type jobs: int
+	@param digests: hex digests which are already known, indexed by path (these files are not read)
+	@type digests: {str: str} | None
+	@param cache: digests of unchanged files are taken from here, and new ones are added
+	@type cache: L{digestcache.DigestCache} | None"""
+	def hash_file(path):
+		return _digest_file(new_digest(), path).hexdigest()
+
+	if cache is not None:
+		import time
+		hash_name = new_digest().name.lower()
+		uncached_hash_file = hash_file
+		def hash_file(path):
+			info = os.lstat(path)
+			digest = cache.lookup(hash_name, info)
+			if digest is None:
+				started = time.time()
+				digest = uncached_hash_file(path)
+				cache.add(hash_name, info, digest, started)
+			return digest
+
+	if digests:
+		def with_known_digests(items):
+			for item in items:
+				if isinstance(item, tuple):
+					type, path, rest = item
+					known = digests.get(path, None)
+					if known is not None:
+						item = "%s %s %s" % (type, known, rest)
+				yield item
+		items = with_known_digests(items)
+
+	if jobs <= 1:
+		for item in items:
+			if isinstance(item, tuple):
+				type, path, rest = item
+				item = "%s %s %s" % (type, hash_file(path), rest)
+			yield item
+		return
+
+	from multiprocessing.pool import ThreadPool
+	from collections import deque
+
+	def finish(item):
+		if isinstance(item, tuple):
+			type, result, rest = item
+			item = "%s %s %s" % (type, result.get(), rest)
+		return item
+
+	pool = ThreadPool(jobs)
+	try:
+		pending = deque()
+		for item in items:
+			if isinstance(item, tuple):
+				type, path, rest = item
+				item = (type, pool.apply_async(hash_file, (path,)), rest)
+			pending.append(item)
+			if len(pending) > jobs * 4:
+				yield finish(pending.popleft())
+		while pending:
+			yield finish(pending.popleft())
+	finally:
+		pool.terminate()
+
 class Algorithm(object):
 	"""Abstract base class for algorithms.
 	An algorithm knows how to generate a manifest from a directory tree.
 	@ivar rating: how much we like this algorithm (higher is better)
 	@type rating: int
 	"""
-	def generate_manifest(self, root):
+	def generate_manifest(self, root, jobs = None, digests = None, cache = None):
 		"""Returns an iterator that yields each line of the manifest for the directory
-		tree rooted at 'root'."""
+		tree rooted at 'root'.
+		@param jobs: the number of files to hash in parallel (default: L{default_jobs})
+		@type jobs: int | None
+		@param digests: digests of files whose contents are already known, indexed by full path.
+		Use this only if you wrote the files yourself, as they will not be read again.
+		@type digests: {str: str} | None
+		@param cache: a cache of file digests to use (and update). Files whose size and mtime haven't
+		changed are not read again, so only use this for trees you trust (never for verification).
+		@type cache: L{digestcache.DigestCache} | None"""
 		raise Exception('Abstract')
 
 	def new_digest(self):
@@ -63,9 +185,19 @@ class OldSHA1(Algorithm):
 
 	rating = 10
 
-	def generate_manifest(self, root):
-		"""@type root: str"""
-		def recurse(sub):
+	def generate_manifest(self, root, jobs = None, digests = None, cache = None):
+		"""@type root: str
+		@type jobs: int | None
+		@type digests: {str: str} | None
+		@type cache: L{digestcache.DigestCache} | None"""
+		if jobs is None: jobs = default_jobs()
+		return _hash_files(self._walk(root), sha1_new, jobs, digests, cache)
+
+	def _walk(self, root):
+		"""Like L{generate_manifest}, but yield (type, path, rest) tuples for regular files
+		instead of hashing them (see L{_hash_files}).
+		@type root: str"""
+		def recurse(sub, full, info):
 			# To ensure that a line-by-line comparison of the manifests
 			# is possible, we require that filenames don't contain newlines.
 			# Otherwise, you can name a file so that the part after the \n
@@ -73,44 +205,45 @@ class OldSHA1(Algorithm):
 			if '\n' in sub: raise BadDigest("Newline in filename '%s'" % sub)
 			assert sub.startswith('/')
 
-			if sub == '/.manifest': return
-
-			full = os.path.join(root, sub[1:].replace('/', os.sep))
-			info = os.lstat(full)
-			
-			m = info.st_mode
-			if stat.S_ISDIR(m):
-				if sub != '/':
-					yield "D %s %s" % (int(info.st_mtime), sub)
-				items = os.listdir(full)
-				items.sort()
-				subdir = sub
-				if not subdir.endswith('/'):
-					subdir += '/'
-				for x in items:
-					for y in recurse(subdir + x):
+			if sub != '/':
+				yield "D %s %s" % (int(info.st_mtime), sub)
+			subdir = sub
+			if not subdir.endswith('/'):
+				subdir += '/'
+
+			for entry in support.scan_dir(full):
+				path = subdir + entry.name
+				if '\n' in path: raise BadDigest("Newline in filename '%s'" % path)
+				if path == '/.manifest': continue
+
+				leaf = entry.name
+				if entry.is_symlink():
+					target = os.readlink(entry.path).encode('utf-8')
+					d = sha1_new(target).hexdigest()
+					# Note: Can't use utime on symlinks, so skip mtime
+					# Note: eCryptfs may report length as zero, so count ourselves instead
+					yield "S %s %s %s" % (d, len(target), leaf)
+					continue
+
+				info = entry.stat(follow_symlinks = False)
+				m = info.st_mode
+				if stat.S_ISDIR(m):
+					for y in recurse(path, entry.path, info):
 						yield y
-				return
-
-			assert sub[1:]
-			leaf = os.path.basename(sub[1:])
-			if stat.S_ISREG(m):
-				with open(full, 'rb') as stream:
-					d = sha1_new(stream.read()).hexdigest()		# XXX could be very large!
-				if m & 0o111:
-					yield "X %s %s %s %s" % (d, int(info.st_mtime), info.st_size, leaf)
+				elif stat.S_ISREG(m):
+					rest = "%s %s %s" % (int(info.st_mtime), info.st_size, leaf)
+					if m & 0o111:
+						yield ("X", entry.path, rest)
+					else:
+						yield ("F", entry.path, rest)
 				else:
-					yield "F %s %s %s %s" % (d, int(info.st_mtime), info.st_size, leaf)
-			elif stat.S_ISLNK(m):
-				target = os.readlink(full).encode('utf-8')
-				d = sha1_new(target).hexdigest()
-				# Note: Can't use utime on symlinks, so skip mtime
-				# Note: eCryptfs may report length as zero, so count ourselves instead
-				yield "S %s %s %s" % (d, len(target), leaf)
-			else:
-				raise SafeException(_("Unknown object '%s' (not a file, directory or symlink)") %
-						full)
-		for x in recurse(_u('/')): yield x
+					raise SafeException(_("Unknown object '%s' (not a file, directory or symlink)") %
+							entry.path)
+
+		full = os.path.join(root, '')
+		info = os.lstat(full)
+		if not stat.S_ISDIR(info.st_mode): raise Exception(_('Not a directory: "%s"') % full)
+		for x in recurse(_u('/'), full, info): yield x
 	
 	def new_digest(self):
 		return sha1_new()
@@ -135,14 +268,16 @@ def generate_manifest(root, alg = 'sha1'):
 	@deprecated: use L{get_algorithm} and L{Algorithm.generate_manifest} instead."""
 	return get_algorithm(alg).generate_manifest(root)
 	
-def add_manifest_file(dir, digest_or_alg):
+def add_manifest_file(dir, digest_or_alg, digests = None):
 	"""Writes a .manifest file into 'dir', and returns the digest.
 	You should call fixup_permissions before this to ensure that the permissions are correct.
 	On exit, dir itself has mode 555. Subdirectories are not changed.
 	@param dir: root of the implementation
 	@type dir: str
 	@param digest_or_alg: should be an instance of Algorithm. Passing a digest here is deprecated.
-	@type digest_or_alg: L{Algorithm}"""
+	@type digest_or_alg: L{Algorithm}
+	@param digests: already-known file digests (see L{Algorithm.generate_manifest})
+	@type digests: {str: str} | None"""
 	mfile = os.path.join(dir, '.manifest')
 	if os.path.islink(mfile) or os.path.exists(mfile):
 		raise SafeException(_("Directory '%s' already contains a .manifest file!") % dir)
@@ -153,16 +288,18 @@ def add_manifest_file(dir, digest_or_alg):
 	else:
 		digest = digest_or_alg
 		alg = get_algorithm('sha1')
-	for line in alg.generate_manifest(dir):
+	for line in alg.generate_manifest(dir, digests = digests):
 		manifest += line + '\n'
 	manifest = manifest.encode('utf-8')
 	digest.update(manifest)
 
 	os.chmod(dir, 0o755)
-	with open(mfile, 'wb') as stream:
+	try:
+		with open(mfile, 'wb') as stream:
+			stream.write(manifest)
+		os.chmod(mfile, 0o444)
+	finally:
 		os.chmod(dir, 0o555)
-		stream.write(manifest)
-	os.chmod(mfile, 0o444)
 	return digest
 
 def splitID(id):
@@ -173,9 +310,11 @@ def splitID(id):
 	alg, digest = parse_algorithm_digest_pair(id)
 	return (get_algorithm(alg), digest)
 
-def copy_with_verify(src, dest, mode, alg, required_digest):
+def copy_with_verify(src, dest, mode, alg, required_digest, stats = None):
 	"""Copy path src to dest, checking that the contents give the right digest.
 	dest must not exist. New file is created with a mode of 'mode & umask'.
+	If the kernel can copy the file for us (e.g. using a reflink), we do that and then
+	check the digest of the new file. Otherwise, we hash the data as we copy it.
 	@param src: source filename
 	@type src: str
 	@param dest: target filename
@@ -186,21 +325,40 @@ def copy_with_verify(src, dest, mode, alg, required_digest):
 	@type alg: L{Algorithm}
 	@param required_digest: expected digest value
 	@type required_digest: str
+	@param stats: if given, record the copy method used here
+	@type stats: L{fastcopy.CopyStats} | None
 	@raise BadDigest: the contents of the file don't match required_digest"""
+	from zeroinstall.zerostore import fastcopy
+	# Either way, we hash exactly the bytes in the new file, so the source changing
+	# under us can't produce a copy which doesn't match the digest.
 	with open(src, 'rb') as src_obj:
-		dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+		dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), mode)
 		try:
-			digest = alg.new_digest()
-			while True:
-				data = src_obj.read(256)
-				if not data: break
-				digest.update(data)
-				while data:
-					written = os.write(dest_fd, data)
-					assert written >= 0
-					data = data[written:]
+			method = fastcopy.kernel_copy(src_obj.fileno(), dest_fd)
+			if method:
+				size = os.fstat(dest_fd).st_size
+			else:
+				method = 'userspace'
+				size = 0
+				buf = bytearray(HASH_BLOCK_SIZE)
+				view = memoryview(buf)
+				digest = alg.new_digest()
+				while True:
+					got = src_obj.readinto(buf)
+					if not got: break
+					size += got
+					data = view[:got]
+					digest.update(data)
+					while data:
+						written = os.write(dest_fd, data)
+						assert written >= 0
+						data = data[written:]
 		finally:
 			os.close(dest_fd)
+	if method != 'userspace':
+		digest = _digest_file(alg.new_digest(), dest)
+	if stats is not None:
+		stats.add(method, size)
 	actual = digest.hexdigest()
 	if actual == required_digest: return
 	os.unlink(dest)
@@ -208,19 +366,33 @@ def copy_with_verify(src, dest, mode, alg, required_digest):
 			 "Expected: %(required_digest)s\n"
 			 "Actual:   %(actual_digest)s") % {'src': src, 'required_digest': required_digest, 'actual_digest': actual})
 
-def verify(root, required_digest = None):
+def verify(root, required_digest = None, fast = False, sample = None):
 	"""Ensure that directory 'dir' generates the given digest.
 	For a non-error return:
 	 - Dir's name must be a digest (in the form "alg=value")
 	 - The calculated digest of the contents must match this name.
 	 - If there is a .manifest file, then its digest must also match.
+	In fast mode, if the .manifest matches the digest then each line of the actual manifest is
+	compared with it as it is generated, stopping at the first difference. Without a valid
+	.manifest, the whole tree is checked as usual.
 	@type root: str
 	@type required_digest: str | None
-	@raise BadDigest: if verification fails."""
+	@param fast: stop at the first difference from the .manifest
+	@type fast: bool
+	@param sample: only hash this percentage of the files, chosen at random (the names, sizes and
+	mtimes of all files are still checked). This implies fast. It is a quick health check, not a
+	guarantee that the contents are correct.
+	@type sample: float | None
+	@raise BadDigest: if verification fails.
+	@since: 2.5 (fast and sample)"""
 	if required_digest is None:
 		required_digest = os.path.basename(root)
 	alg = splitID(required_digest)[0]
 
+	if fast or sample is not None:
+		if _verify_fast(root, required_digest, alg, sample):
+			return
+
 	digest = alg.new_digest()
 	lines = []
 	for line in alg.generate_manifest(root):
@@ -266,6 +438,70 @@ def verify(root, required_digest = None):
 		error.detail += _("The .manifest file matches neither of the other digests. Odd.")
 	raise error
 
+def _verify_fast(root, required_digest, alg, sample):
+	"""Compare the tree with its .manifest, stopping at the first difference (see L{verify}).
+	@type root: str
+	@type required_digest: str
+	@type alg: L{Algorithm}
+	@type sample: float | None
+	@return: False if there is no .manifest matching required_digest, so nothing was checked
+	@rtype: bool
+	@raise BadDigest: if the tree doesn't match the .manifest"""
+	try:
+		with open(os.path.join(root, '.manifest'), 'rb') as stream:
+			manifest_data = stream.read()
+	except EnvironmentError as ex:
+		logger.info(_("Can't read .manifest file (%s); checking everything"), ex)
+		return False
+
+	digest = alg.new_digest()
+	digest.update(manifest_data)
+	if alg.getID(digest) != required_digest:
+		logger.info(_("The .manifest file doesn't match the required digest; checking everything"))
+		return False
+
+	recorded = manifest_data.decode('utf-8').split('\n')
+	if recorded[-1] == '':
+		del recorded[-1]
+
+	if sample is None:
+		items = alg.generate_manifest(root)
+	else:
+		import random
+		choose = random.Random().random
+		items = alg._walk(root)
+
+	n_items = 0
+	try:
+		for item in items:
+			expected = recorded[n_items] if n_items < len(recorded) else None
+			n_items += 1
+			if isinstance(item, tuple):
+				type, path, rest = item
+				if choose() * 100 >= sample:
+					# Not in the sample, so just check everything except the digest
+					parts = (expected or '').split(' ', 2)
+					if len(parts) == 3 and parts[0] == type and parts[2] == rest:
+						continue
+				item = "%s %s %s" % (type, _digest_file(alg.new_digest(), path).hexdigest(), rest)
+			if item != expected:
+				break
+		else:
+			if n_items == len(recorded):
+				return True
+			item, expected = None, recorded[n_items]
+	finally:
+		items.close()
+
+	error = BadDigest(_("Cached item does NOT verify."))
+	error.detail = _("The .manifest file matches the directory name.\n"
+			"The contents of the directory have changed. First difference:\n")
+	if expected is not None:
+		error.detail += '-' + expected + '\n'
+	if item is not None:
+		error.detail += '+' + item + '\n'
+	raise error
+
 # XXX: Be more careful about the source tree changing under us. In particular, what happens if:
 # - A regualar file suddenly turns into a symlink?
 # - We find a device file (users can hard-link them if on the same device)
@@ -275,6 +511,8 @@ def copy_tree_with_verify(source, target, manifest_data, required_digest):
 	(will typically be under the control of another user).
 	The copy is first done to a temporary directory in target, then renamed to the final name
 	only if correct. Therefore, an invalid 'target/required_digest' will never exist.
+	If target has a pool (see L{pool}), files already in it are taken from there instead of source,
+	and the new files are added to it.
 	A successful return means than target/required_digest now exists (whether we created it or not).
 	@type source: str
 	@type target: str
@@ -309,7 +547,10 @@ def copy_tree_with_verify(source, target, manifest_data, required_digest):
 
 	tmpdir = tempfile.mkdtemp(prefix = 'tmp-copy-', dir = target)
 	try:
-		_copy_files(alg, wanted, source, tmpdir)
+		from zeroinstall.zerostore import fastcopy, pool
+		stats = fastcopy.CopyStats()
+		copied = _copy_files(alg, wanted, source, tmpdir, stats, pool.for_store(target))
+		stats.log(source)
 
 		if wanted:
 			raise SafeException(_('Copy failed; files missing from source:') + '\n- ' +
@@ -322,8 +563,9 @@ def copy_tree_with_verify(source, target, manifest_data, required_digest):
 				mode = os.stat(path).st_mode
 				os.chmod(path, mode & 0o555)
 
-		# Check that the copy is correct
-		actual_digest = alg.getID(add_manifest_file(tmpdir, alg))
+		# Check that the copy is correct. The contents of each file were checked as they were
+		# copied, so this just needs to check the structure, sizes, types and mtimes.
+		actual_digest = alg.getID(add_manifest_file(tmpdir, alg, digests = copied))
 		if actual_digest != required_digest:
 			raise SafeException(_("Copy failed; double-check of target gave the wrong digest.\n"
 					     "Unless the target was modified during the copy, this is a BUG\n"
@@ -375,29 +617,37 @@ def _parse_manifest(manifest_data):
 		wanted[path] = data[:-1]
 	return wanted
 
-def _copy_files(alg, wanted, source, target):
+def _copy_files(alg, wanted, source, target, stats = None, pool = None):
 	"""Scan for files under 'source'. For each one:
 	If it is in wanted and has the right details (or they can be fixed; e.g. mtime),
 	then copy it into 'target'.
 	If it's not in wanted, warn and skip it.
 	On exit, wanted contains only files that were not found.
-	@type alg: L{Algorithm}
+	Each source file is read only once, as it is copied (files in the pool are read from there instead).
+	@type alg: L{HashLibAlgorithm}
 	@type wanted: {str: tuple}
 	@type source: str
-	@type target: str"""
+	@type target: str
+	@type stats: L{fastcopy.CopyStats} | None
+	@param pool: take files from here, if possible, and add the others to it
+	@type pool: L{pool.ObjectPool} | None
+	@return: the digest of each file copied, indexed by its path in target
+	@rtype: {str: str}"""
+	copied = {}
 	dir = ''
-	for line in alg.generate_manifest(source):
-		if line[0] == 'D':
-			type, name = line.split(' ', 1)
+	for item in alg._walk(source):
+		if isinstance(item, tuple):
+			type, unused, rest = item
+			actual_mtime, actual_size, name = rest.split(' ', 2)
+			path = os.path.join(dir, name)
+		elif item[0] == 'D':
+			type, name = item.split(' ', 1)
 			assert name.startswith('/')
 			dir = name[1:]
 			path = dir
-		elif line[0] == 'S':
-			type, actual_digest, actual_size, name = line.split(' ', 3)
-			path = os.path.join(dir, name)
 		else:
-			assert line[0] in 'XF'
-			type, actual_digest, actual_mtime, actual_size, name = line.split(' ', 4)
+			assert item[0] == 'S'
+			type, actual_digest, actual_size, name = item.split(' ', 3)
 			path = os.path.join(dir, name)
 		try:
 			required_details = wanted.pop(path)
@@ -420,12 +670,17 @@ def _copy_files(alg, wanted, source, target):
 				mode = 0o555
 			else:
 				mode = 0o444
-			copy_with_verify(os.path.join(source, path),
-					dest_path,
-					mode,
-					alg,
-					required_digest)
-			os.utime(dest_path, (required_mtime, required_mtime))
+			if pool is None or not pool.link_into(alg, required_digest, type, required_mtime, int(required_size), dest_path, stats):
+				copy_with_verify(os.path.join(source, path),
+						dest_path,
+						mode,
+						alg,
+						required_digest,
+						stats)
+				os.utime(dest_path, (required_mtime, required_mtime))
+				if pool is not None:
+					pool.add(alg, required_digest, dest_path)
+			copied[dest_path] = required_digest
 		elif type == 'S':
 			required_type, required_digest, required_size = required_details
 			if required_size != actual_size:
@@ -442,6 +697,7 @@ def _copy_files(alg, wanted, source, target):
 			os.symlink(symlink_target, dest_path)
 		else:
 			raise SafeException(_("Unknown manifest type %(type)s for '%(path)s'") % {'type': type, 'path': path})
+	return copied
 
 class HashLibAlgorithm(Algorithm):
 	new_digest = None		# Constructor for digest objects
@@ -454,8 +710,18 @@ class HashLibAlgorithm(Algorithm):
 		self.new_digest = getattr(hashlib, hash_name or name)
 		self.rating = rating
 
-	def generate_manifest(self, root):
-		"""@type root: str"""
+	def generate_manifest(self, root, jobs = None, digests = None, cache = None):
+		"""@type root: str
+		@type jobs: int | None
+		@type digests: {str: str} | None
+		@type cache: L{digestcache.DigestCache} | None"""
+		if jobs is None: jobs = default_jobs()
+		return _hash_files(self._walk(root), self.new_digest, jobs, digests, cache)
+
+	def _walk(self, root):
+		"""Like L{generate_manifest}, but yield (type, path, rest) tuples for regular files
+		instead of hashing them (see L{_hash_files}).
+		@type root: str"""
 		def recurse(sub):
 			# To ensure that a line-by-line comparison of the manifests
 			# is possible, we require that filenames don't contain newlines.
@@ -465,41 +731,38 @@ class HashLibAlgorithm(Algorithm):
 			assert sub.startswith('/')
 
 			full = os.path.join(root, sub[1:])
-			info = os.lstat(full)
 			new_digest = self.new_digest
-			
-			m = info.st_mode
-			if not stat.S_ISDIR(m): raise Exception(_('Not a directory: "%s"') % full)
-			if sub != '/':
+
+			if sub == '/':
+				if not stat.S_ISDIR(os.lstat(full).st_mode): raise Exception(_('Not a directory: "%s"') % full)
+			else:
 				yield "D %s" % sub
-			items = os.listdir(full)
-			items.sort()
-			dirs = []
-			for leaf in items:
-				path = os.path.join(root, sub[1:], leaf)
-				info = os.lstat(path)
-				m = info.st_mode
 
-				if stat.S_ISREG(m):
+			# The type of each entry is usually known from the directory listing, so
+			# only regular files need to be stat'd.
+			dirs = []
+			for entry in support.scan_dir(full):
+				leaf = entry.name
+				if entry.is_file(follow_symlinks = False):
 					if leaf == '.manifest': continue
 
-					with open(path, 'rb') as stream:
-						d = new_digest(stream.read()).hexdigest()
-					if m & 0o111:
-						yield "X %s %s %s %s" % (d, int(info.st_mtime), info.st_size, leaf)
+					info = entry.stat(follow_symlinks = False)
+					rest = "%s %s %s" % (int(info.st_mtime), info.st_size, leaf)
+					if info.st_mode & 0o111:
+						yield ("X", entry.path, rest)
 					else:
-						yield "F %s %s %s %s" % (d, int(info.st_mtime), info.st_size, leaf)
-				elif stat.S_ISLNK(m):
-					target = os.readlink(path).encode('utf-8')
+						yield ("F", entry.path, rest)
+				elif entry.is_symlink():
+					target = os.readlink(entry.path).encode('utf-8')
 					d = new_digest(target).hexdigest()
 					# Note: Can't use utime on symlinks, so skip mtime
 					# Note: eCryptfs may report length as zero, so count ourselves instead
 					yield "S %s %s %s" % (d, len(target), leaf)
-				elif stat.S_ISDIR(m):
+				elif entry.is_dir(follow_symlinks = False):
 					dirs.append(leaf)
 				else:
 					raise SafeException(_("Unknown object '%s' (not a file, directory or symlink)") %
-							path)
+							entry.path)
 
 			if not sub.endswith('/'):
 				sub += '/'
@@ -508,7 +771,7 @@ class HashLibAlgorithm(Algorithm):
 				for y in recurse(sub + x): yield y
 			return
 
-		for x in recurse(_u('/')): yield x
+		return recurse(_u('/'))
 
 	def getID(self, digest):
 		"""@rtype: str"""
@@ -533,20 +796,23 @@ def fixup_permissions(root):
 	"""Set permissions recursively for children of root:
 	 - If any X bit is set, they all must be.
 	 - World readable, non-writable.
+	Items which already have the right mode are not changed.
 	@type root: str
 	@raise Exception: if there are unsafe special bits set (setuid, etc)."""
 
-	for main, dirs, files in os.walk(root):
-		for x in ['.'] + files:
-			full = os.path.join(main, x)
-
-			raw_mode = os.lstat(full).st_mode
-			if stat.S_ISLNK(raw_mode): continue
-
-			mode = stat.S_IMODE(raw_mode)
-			if mode & ~0o777:
-				raise Exception(_("Unsafe mode: extracted file '%(filename)s' had special bits set in mode '%(mode)s'") % {'filename': full, 'mode': oct(mode)})
-			if mode & 0o111:
-				os.chmod(full, 0o555)
-			else:
-				os.chmod(full, 0o444)
+	def fixup(full, info):
+		mode = stat.S_IMODE(info.st_mode)
+		if mode & ~0o777:
+			raise Exception(_("Unsafe mode: extracted file '%(filename)s' had special bits set in mode '%(mode)s'") % {'filename': full, 'mode': oct(mode)})
+		if mode & 0o111:
+			required = 0o555
+		else:
+			required = 0o444
+		if mode != required:
+			os.chmod(full, required)
+
+	fixup(root, os.stat(root))
+	for main, entries in support.walk_entries(root):
+		for entry in entries:
+			if entry.is_symlink(): continue
+			fixup(entry.path, entry.stat(follow_symlinks = False))
@@ -0,0 +1,229 @@
+"""A compact binary index of a .manifest file.
+
+Operations over a whole store (e.g. optimising it or finding the size of each item) need the
+details of every file in every implementation. Parsing the text manifests line by line is slow
+when there are tens of thousands of them, so the store also writes an index for each
+implementation it adds, which can be memory-mapped and read without any string splitting.
+
+The index for STORE/DIGEST is STORE/.index/DIGEST. Keeping it outside the implementation means
+that the implementation's digest is unaffected. It is only a cache of the .manifest file: it is
+never trusted when checking an implementation, and it can be rebuilt from the .manifest at any time.
+Since an implementation's digest determines its .manifest, an index left behind by a deleted
+implementation is still correct if the same implementation is added again.
+
+The format is a header, followed by a fixed-size record for each line of the manifest, followed
+by the UTF-8 encoded paths. All integers are little-endian."""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger
+from zeroinstall.zerostore import BadDigest
+import os, errno, struct, binascii
+
+#: The name of the directory in the store holding the indexes
+INDEX_DIR = '.index'
+
+_MAGIC = b'0IDX'
+_VERSION = 1
+
+# magic, version, digest size, number of records, .manifest mtime, .manifest size
+_header = struct.Struct('<4sHHIqQ')
+
+# type, mtime, size, path offset, path length, digest
+_RECORD_FORMAT = '<BxxxqqII%ds'
+
+def _record(digest_size):
+	return struct.Struct(_RECORD_FORMAT % digest_size)
+
+def build(manifest_data, manifest_mtime, manifest_size):
+	"""Create an index for a manifest.
+	@param manifest_data: the contents of the .manifest file
+	@type manifest_data: bytes
+	@param manifest_mtime: the modification time of the .manifest file (used to detect stale indexes)
+	@type manifest_mtime: int
+	@param manifest_size: the size of the .manifest file
+	@type manifest_size: int
+	@return: the contents of the index
+	@rtype: bytes
+	@raise BadDigest: if the manifest can't be parsed"""
+	records = []
+	digest_size = 0
+	dir = ''
+	for line in manifest_data.decode('utf-8').split('\n'):
+		if not line: continue
+		if line[0] == 'D':
+			rest = line[2:]
+			if not rest.startswith('/'):
+				rest = rest.split(' ', 1)[-1]		# Old 'sha1' format has the mtime first
+			if not rest.startswith('/'): raise BadDigest(_("Not absolute: '%s'") % line)
+			dir = rest[1:]
+			records.append(('D', None, 0, 0, dir))
+			continue
+		if line[0] == 'S':
+			data = line.split(' ', 3)
+			if len(data) != 4: raise BadDigest(_("Bad line '%s'") % line)
+			itype, digest, size, name = data
+			mtime = 0
+		elif line[0] in 'FX':
+			data = line.split(' ', 4)
+			if len(data) != 5: raise BadDigest(_("Bad line '%s'") % line)
+			itype, digest, mtime, size, name = data
+		else:
+			raise BadDigest(_("Bad line '%s'") % line)
+		digest = binascii.unhexlify(digest)
+		digest_size = len(digest)
+		records.append((itype, digest, int(mtime), int(size), dir + '/' + name if dir else name))
+
+	record = _record(digest_size)
+	no_digest = b'\0' * digest_size
+	parts = [_header.pack(_MAGIC, _VERSION, digest_size, len(records), manifest_mtime, manifest_size)]
+	paths = []
+	offset = 0
+	for itype, digest, mtime, size, path in records:
+		path = path.encode('utf-8')
+		if digest is not None and len(digest) != digest_size:
+			raise BadDigest(_("Inconsistent digest lengths in manifest"))
+		parts.append(record.pack(ord(itype), mtime, size, offset, len(path), digest or no_digest))
+		paths.append(path)
+		offset += len(path)
+	return b''.join(parts + paths)
+
+def get_index_path(impl_dir):
+	"""Get the path of the index for the implementation in impl_dir (which needn't exist).
+	@type impl_dir: str
+	@rtype: str"""
+	impl_dir = impl_dir.rstrip(os.sep)
+	return os.path.join(os.path.dirname(impl_dir), INDEX_DIR, os.path.basename(impl_dir))
+
+def write_index(impl_dir):
+	"""(Re)build the index for the .manifest file in impl_dir.
+	If this fails, any existing index is removed, so that a stale one is never left behind.
+	@type impl_dir: str
+	@raise BadDigest: if the manifest can't be parsed"""
+	index_path = get_index_path(impl_dir)
+	tmp_path = index_path + '.new'
+	try:
+		with open(os.path.join(impl_dir, '.manifest'), 'rb') as stream:
+			info = os.fstat(stream.fileno())
+			data = build(stream.read(), int(info.st_mtime), info.st_size)
+		index_dir = os.path.dirname(index_path)
+		if not os.path.isdir(index_dir):
+			os.makedirs(index_dir)
+		with open(tmp_path, 'wb') as stream:
+			stream.write(data)
+		from zeroinstall.support import portable_rename
+		portable_rename(tmp_path, index_path)
+	except:
+		for path in (tmp_path, index_path):
+			if os.path.exists(path):
+				os.unlink(path)
+		raise
+
+def remove_index(impl_dir):
+	"""Delete the index for the implementation in impl_dir, if any.
+	@type impl_dir: str"""
+	try:
+		os.unlink(get_index_path(impl_dir))
+	except OSError as ex:
+		if ex.errno != errno.ENOENT:
+			raise
+
+class ManifestIndex(object):
+	"""A memory-mapped (or in-memory) manifest index.
+	Iterating over it yields (type, digest, mtime, size, path) for each line of the manifest,
+	in the same order. type is 'D', 'F', 'X' or 'S'. digest is the hex digest (None for directories).
+	mtime is None for directories and symlinks. path is relative to the implementation (no leading '/').
+	Use as a context manager, or call L{close} when finished.
+	@ivar manifest_mtime: the mtime of the .manifest file this was built from
+	@type manifest_mtime: int
+	@ivar manifest_size: the size of the .manifest file this was built from
+	@type manifest_size: int"""
+
+	def __init__(self, data, close = None):
+		"""@param data: the contents of the index (any object supporting the buffer interface)
+		@param close: called by L{close}
+		@type close: () -> None | None
+		@raise BadDigest: if data isn't a valid index"""
+		self._data = data
+		self._close = close
+		if len(data) < _header.size:
+			raise BadDigest(_("Manifest index is truncated"))
+		magic, version, self._digest_size, self._count, self.manifest_mtime, self.manifest_size = _header.unpack_from(data, 0)
+		if magic != _MAGIC or version != _VERSION:
+			raise BadDigest(_("Not a manifest index (or unsupported version)"))
+		self._record = _record(self._digest_size)
+		self._paths = _header.size + self._count * self._record.size
+		if len(data) < self._paths:
+			raise BadDigest(_("Manifest index is truncated"))
+
+	def __len__(self):
+		return self._count
+
+	def __iter__(self):
+		data = self._data
+		unpack_from = self._record.unpack_from
+		record_size = self._record.size
+		paths = self._paths
+		for i in range(self._count):
+			itype, mtime, size, offset, length, digest = unpack_from(data, _header.size + i * record_size)
+			itype = chr(itype)
+			path = data[paths + offset:paths + offset + length].decode('utf-8')
+			if itype == 'D':
+				yield (itype, None, None, 0, path)
+			else:
+				yield (itype, binascii.hexlify(digest).decode('ascii'), mtime if itype != 'S' else None, size, path)
+
+	def total_size(self):
+		"""The total size of all the regular files listed.
+		@rtype: int"""
+		return sum(size for itype, digest, mtime, size, path in self if itype in 'FX')
+
+	def close(self):
+		if self._close is not None:
+			self._close()
+			self._close = None
+		self._data = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+def load(impl_dir, save = False):
+	"""Get the index for the implementation in impl_dir, memory-mapping the index file if it
+	exists and is up-to-date. Otherwise, build it from the .manifest (and write it too, if
+	'save' is set and the store is writable).
+	@type impl_dir: str
+	@type save: bool
+	@rtype: L{ManifestIndex}
+	@raise BadDigest: if the .manifest can't be parsed
+	@raise EnvironmentError: if the .manifest can't be read"""
+	manifest_info = os.stat(os.path.join(impl_dir, '.manifest'))
+	index_path = get_index_path(impl_dir)
+	try:
+		index = _map(index_path)
+		if (index.manifest_mtime, index.manifest_size) == (int(manifest_info.st_mtime), manifest_info.st_size):
+			return index
+		index.close()
+		logger.info(_("Manifest index %s is out-of-date"), index_path)
+	except (EnvironmentError, ValueError, BadDigest) as ex:
+		logger.debug(_("Can't use manifest index %(path)s: %(error)s"), {'path': index_path, 'error': ex})
+
+	if save:
+		try:
+			write_index(impl_dir)
+			return _map(index_path)
+		except EnvironmentError as ex:
+			logger.info(_("Can't save manifest index %(path)s: %(error)s"), {'path': index_path, 'error': ex})
+
+	with open(os.path.join(impl_dir, '.manifest'), 'rb') as stream:
+		info = os.fstat(stream.fileno())
+		return ManifestIndex(build(stream.read(), int(info.st_mtime), info.st_size))
+
+def _map(path):
+	import mmap
+	with open(path, 'rb') as stream:
+		data = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+	return ManifestIndex(data, data.close)
@@ -8,13 +8,26 @@ from __future__ import print_function
 from zeroinstall import _, logger
 import os, sys
 
-def _already_linked(a, b):
-	"""@type a: str
-	@type b: str
-	@rtype: bool"""
-	ai = os.stat(a)
-	bi = os.stat(b)
-	return (ai.st_dev, ai.st_ino) == (bi.st_dev, bi.st_ino)
+#: The ways duplicate files can be shared:
+#:  - hardlink: replace duplicates with hard-links (files must also have the same mtime and permissions)
+#:  - reflink: share the file-system extents (btrfs, XFS); each file keeps its own inode
+#:  - auto: reflink if the file-system supports it, otherwise hardlink
+MODES = ('hardlink', 'reflink', 'auto')
+
+# Read this much of each file at a time when comparing them
+_COMPARE_BLOCK = 1024 * 1024
+
+# Files from new implementations are handled in batches of about this many, and the
+# dedup index is committed after each batch.
+_BATCH_FILES = 50000
+
+def _lstat(path):
+	"""@type path: str
+	@return: the file's details, or None if it doesn't exist"""
+	try:
+		return os.lstat(path)
+	except OSError:
+		return None
 
 def _byte_identical(a, b):
 	"""@type a: str
@@ -23,47 +36,228 @@ def _byte_identical(a, b):
 	with open(a, 'rb') as af:
 		with open(b, 'rb') as bf:
 			while True:
-				adata = af.read(100)
-				bdata = bf.read(100)
+				adata = af.read(_COMPARE_BLOCK)
+				bdata = bf.read(_COMPARE_BLOCK)
 				if adata != bdata:
 					return False
 				if not adata:
 					return True
 
-def _link(a, b, tmpfile):
-	"""Keep 'a', delete 'b' and hard-link to 'a'
-	@type a: str
-	@type b: str
-	@type tmpfile: str"""
-	if not _byte_identical(a, b):
-		logger.warning(_("Files should be identical, but they're not!\n%(file_a)s\n%(file_b)s"), {'file_a': a, 'file_b': b})
+def _warn_differ(a, b):
+	logger.warning(_("Files should be identical, but they're not!\n%(file_a)s\n%(file_b)s"), {'file_a': a, 'file_b': b})
 
-	b_dir = os.path.dirname(b)
+def _check_group(impl_dir, size, first_loc, dups, compare = True):
+	"""Decide which copies of a file can be replaced by links to the first one.
+	Each file is stat'd only once, and the contents are only read if the sizes match.
+	This doesn't change anything on disk, so several groups can be checked at once.
+	@param impl_dir: the implementation cache directory
+	@type impl_dir: str
+	@param size: the size of the file according to the manifests
+	@type size: int
+	@param first_loc: the (implementation, path) of the copy to keep
+	@type first_loc: (str, str)
+	@param dups: the locations of the new copies
+	@type dups: [(str, str)]
+	@param compare: compare the contents (not needed if the kernel will do it anyway)
+	@type compare: bool
+	@return: (copy to keep from now on, unique bytes, already linked bytes, [(keep, replace)])
+	@rtype: ((str, str), int, int, [(str, str)])"""
+	uniq = already = 0
+	links = []
+	first_full = os.path.join(impl_dir, *first_loc)
+	first_info = _lstat(first_full)
+	for loc in dups:
+		full = os.path.join(impl_dir, *loc)
+		info = _lstat(full)
+		if first_info is None:
+			# Modified or removed by something else; use this copy from now on
+			first_loc, first_full, first_info = loc, full, info
+			uniq += size
+		elif info is None:
+			logger.warning(_("File '%s' listed in manifest is missing"), full)
+		elif (info.st_dev, info.st_ino) == (first_info.st_dev, first_info.st_ino):
+			already += size
+		elif info.st_size != first_info.st_size or (compare and size and not _byte_identical(first_full, full)):
+			_warn_differ(first_full, full)
+			uniq += size
+		else:
+			links.append((first_full, full))
+	return (first_loc, uniq, already, links)
+
+def _link_dir(b_dir, pairs, tmpfile):
+	"""For each (a, b, size), keep 'a', delete 'b' and hard-link to 'a'.
+	Every 'b' must be in b_dir, which is made writable just once for all of them.
+	@type b_dir: str
+	@type pairs: [(str, str, int)]
+	@type tmpfile: str"""
 	old_mode = os.lstat(b_dir).st_mode
 	os.chmod(b_dir, old_mode | 0o200)	# Need write access briefly
 	try:
-		os.link(a, tmpfile)
-		try:
-			os.rename(tmpfile, b)
-		except:
-			os.unlink(tmpfile)
-			raise
+		for a, b, size in pairs:
+			os.link(a, tmpfile)
+			try:
+				os.rename(tmpfile, b)
+			except:
+				os.unlink(tmpfile)
+				raise
 	finally:
 		os.chmod(b_dir, old_mode)
 
-def optimise(impl_dir):
+def _dedupe_file(a, b, size):
+	"""Make 'b' share the extents of the identical file 'a'.
+	@type a: str
+	@type b: str
+	@type size: int
+	@return: False if the files aren't identical after all
+	@rtype: bool
+	@raise OSError: (or IOError) if the file-system doesn't support it"""
+	from zeroinstall.zerostore import fastcopy
+	a_fd = os.open(a, os.O_RDONLY)
+	try:
+		b_fd = os.open(b, os.O_RDONLY)		# Enough for the owner of the file
+		try:
+			return fastcopy.dedupe(a_fd, b_fd, size)
+		finally:
+			os.close(b_fd)
+	finally:
+		os.close(a_fd)
+
+def _reflink_supported(impl_dir):
+	"""Check whether we can dedupe files in impl_dir, using a pair of temporary files.
+	@type impl_dir: str
+	@rtype: bool"""
+	import tempfile
+	data = os.urandom(64 * 1024)
+	paths = []
+	try:
+		for x in range(2):
+			stream = tempfile.NamedTemporaryFile(dir = impl_dir, prefix = 'optimise-', delete = False)
+			paths.append(stream.name)
+			with stream:
+				stream.write(data)
+		_dedupe_file(paths[0], paths[1], len(data))
+		return True
+	except (OSError, IOError) as ex:
+		logger.info(_("Can't dedupe files in %(dir)s: %(error)s"), {'dir': impl_dir, 'error': ex})
+		return False
+	finally:
+		for path in paths:
+			os.unlink(path)
+
+class DedupIndex(object):
+	"""A persistent record of the files already seen by L{optimise} in one implementation cache,
+	so that later runs only need to process new implementations. It maps each (type, digest, mtime,
+	size) key to the first copy we found, and lists the implementations already processed.
+	The index is a SQLite database in ~/.cache/0install.net/injector/optimise/.
+	If an implementation is removed, files whose first copy was in it are forgotten. Any remaining
+	copies of them won't be linked with new ones until the index is rebuilt (see L{clear}).
+	@since: 2.5"""
+
+	_FORMAT = 1
+
+	def __init__(self, impl_dir, path = None, mode = 'hardlink'):
+		"""@param impl_dir: the implementation cache directory
+		@type impl_dir: str
+		@param path: the database file (default: based on impl_dir's real path and mode)
+		@type path: str | None
+		@param mode: which files count as duplicates depends on how they will be shared (see L{MODES})
+		@type mode: str"""
+		import sqlite3, hashlib
+		if path is None:
+			from zeroinstall.support import basedir
+			from zeroinstall.injector import namespaces
+			name = hashlib.sha256(os.path.realpath(impl_dir).encode('utf-8')).hexdigest()[:32]
+			if mode != 'hardlink':
+				name += '-' + mode
+			name += '.db'
+			path = os.path.join(basedir.save_cache_path(namespaces.config_site, namespaces.config_prog, 'optimise'), name)
+		self.path = path
+		self.db = sqlite3.connect(path)
+		version = self.db.execute('PRAGMA user_version').fetchone()[0]
+		if version != self._FORMAT:
+			self.db.executescript("""
+				DROP TABLE IF EXISTS files;
+				DROP TABLE IF EXISTS impls;
+				CREATE TABLE files (itype TEXT, digest TEXT, mtime INTEGER, size INTEGER, impl TEXT, path TEXT,
+						    PRIMARY KEY (itype, digest, mtime, size));
+				CREATE INDEX files_by_impl ON files (impl);
+				CREATE TABLE impls (name TEXT PRIMARY KEY, inode INTEGER);
+				PRAGMA user_version = %d;""" % self._FORMAT)
+			self.db.commit()
+
+	def get_impls(self):
+		"""@return: the inode of each implementation directory already processed, by name
+		@rtype: {str: int}"""
+		return dict(self.db.execute('SELECT name, inode FROM impls'))
+
+	def get_first_copy(self, key):
+		"""@param key: (type, digest, mtime, size)
+		@return: the implementation and path within it of the first copy seen, if any
+		@rtype: (str, str) | None"""
+		return self.db.execute('SELECT impl, path FROM files WHERE itype = ? AND digest = ? AND mtime = ? AND size = ?', key).fetchone()
+
+	def set_first_copy(self, key, loc_path):
+		"""@type key: (str, str, int, int)
+		@type loc_path: (str, str)"""
+		self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', tuple(key) + tuple(loc_path))
+
+	def add_impl(self, name, inode):
+		"""Record that an implementation has been processed (call L{commit} afterwards).
+		@type name: str
+		@type inode: int"""
+		self.db.execute('INSERT OR REPLACE INTO impls VALUES (?, ?)', (name, inode))
+
+	def commit(self):
+		"""Save the changes made since the last commit."""
+		self.db.commit()
+
+	def remove_impl(self, name):
+		"""Forget an implementation, and all first copies inside it.
+		@type name: str"""
+		self.db.execute('DELETE FROM files WHERE impl = ?', (name,))
+		self.db.execute('DELETE FROM impls WHERE name = ?', (name,))
+		self.db.commit()
+
+	def clear(self):
+		"""Forget everything, so that the next run processes every implementation."""
+		self.db.execute('DELETE FROM files')
+		self.db.execute('DELETE FROM impls')
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+def optimise(impl_dir, full = False, jobs = None, mode = 'hardlink'):
 	"""Scan an implementation cache directory for duplicate files, and
-	hard-link any duplicates together to save space.
+	hard-link (or reflink) any duplicates together to save space.
+	Implementations processed by a previous run are skipped (see L{DedupIndex}), so the
+	results only count the new ones.
+	This works in three stages: the manifests are read to find groups of files with the
+	same type, digest, mtime and size (just digest and size in reflink mode), then the groups
+	are checked in parallel (see L{_check_group}), and then the duplicates are replaced,
+	one directory at a time (or deduped in parallel).
 	@param impl_dir: a $cache/0install.net/implementations directory
 	@type impl_dir: str
+	@param full: forget previous runs and process every implementation
+	@type full: bool
+	@param jobs: the number of groups to check in parallel (default: L{manifest.default_jobs})
+	@type jobs: int | None
+	@param mode: how to share duplicate files (see L{MODES})
+	@type mode: str
 	@return: (unique bytes, duplicated bytes, already linked, manifest size)
 	@rtype: (int, int, int, int)"""
 
-	first_copy = {}		# TypeDigest -> Path
-	dup_size = uniq_size = already_linked = man_size = 0
+	totals = [0, 0, 0, 0]	# uniq_size, dup_size, already_linked, man_size
 
 	import random
-	from zeroinstall.zerostore import BadDigest, parse_algorithm_digest_pair
+	from zeroinstall import SafeException
+	from zeroinstall.zerostore import BadDigest, parse_algorithm_digest_pair, manifest, manifestindex
+
+	assert mode in MODES, mode
+	if mode == 'auto':
+		mode = 'reflink' if _reflink_supported(impl_dir) else 'hardlink'
+		print(_("Using %s mode") % mode)
+	reflink = mode == 'reflink'
 
 	for x in range(10):
 		tmpfile = os.path.join(impl_dir, 'optimise-%d' % random.randint(0, 1000000))
@@ -72,70 +266,149 @@ def optimise(impl_dir):
 	else:
 		raise Exception(_("Can't generate unused tempfile name!"))
 
-	dirs = os.listdir(impl_dir)
-	total = len(dirs)
-	msg = ""
-	def clear():
-		print("\r" + (" " * len(msg)) + "\r", end='')
-	for i, impl in enumerate(dirs):
-		clear()
-		msg = _("[%(done)d / %(total)d] Reading manifests...") % {'done': i, 'total': total}
-		print(msg, end='')
+	if jobs is None: jobs = manifest.default_jobs()
+
+	msg = [""]
+	def progress(new_msg):
+		print("\r" + (" " * len(msg[0])) + "\r" + new_msg, end='')
 		sys.stdout.flush()
+		msg[0] = new_msg
 
-		try:
-			alg, manifest_digest = parse_algorithm_digest_pair(impl)
-		except BadDigest:
-			logger.warning(_("Skipping non-implementation '%s'"), impl)
-			continue
-		manifest_path = os.path.join(impl_dir, impl, '.manifest')
-		try:
-			ms = open(manifest_path, 'rt')
-		except OSError as ex:
-			logger.warning(_("Failed to read manifest file '%(manifest_path)s': %(exception)s"), {'manifest': manifest_path, 'exception': str(ex)})
-			continue
-
-		if alg == 'sha1':
-			ms.close()
-			continue
-
-		man_size += os.path.getsize(manifest_path)
-
-		dir = ""
-		for line in ms:
-			if line[0] == 'D':
-				itype, path = line.split(' ', 1)
-				assert path.startswith('/')
-				dir = path[1:-1]	# Strip slash and newline
-				continue
+	pool = None
+	dedup_index = DedupIndex(impl_dir, mode = mode)
+	try:
+		if full:
+			dedup_index.clear()
 
-			if line[0] == "S":
-				itype, digest, size, rest = line.split(' ', 3)
-				uniq_size += int(size)
+		# An implementation directory with a new inode has been replaced since we saw it
+		current = {}
+		for impl in os.listdir(impl_dir):
+			if impl.startswith('.'):
+				continue		# Our .locks, .trash and .index directories
+			try:
+				alg, manifest_digest = parse_algorithm_digest_pair(impl)
+			except BadDigest:
+				logger.warning(_("Skipping non-implementation '%s'"), impl)
 				continue
+			if alg == 'sha1':
+				continue
+			current[impl] = os.stat(os.path.join(impl_dir, impl)).st_ino
+
+		done = dedup_index.get_impls()
+		for impl, inode in list(done.items()):
+			if current.get(impl, None) != inode:
+				dedup_index.remove_impl(impl)
+				del done[impl]
+		dirs = sorted(impl for impl in current if impl not in done)
+		if done:
+			print(_("Skipping %d implementations already optimised (use --full to include them)") % len(done))
 
-			assert line[0] in "FX"
+		if jobs > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(jobs)
 
-			itype, digest, mtime, size, path = line.split(' ', 4)
-			path = path[:-1]	# Strip newline
-			size = int(size)
+		def check(item):
+			(itype, digest, mtime, size), (first_loc, dups) = item
+			return (itype, digest, mtime, size), _check_group(impl_dir, size, first_loc, dups, compare = not reflink)
 
-			key = (itype, digest, mtime, size)
-			loc_path = (impl, dir, path)
+		def dedupe(item):
+			a, b, size = item
+			try:
+				return a, b, size, _dedupe_file(a, b, size)
+			except (OSError, IOError) as ex:
+				raise SafeException(_("Failed to dedupe '%(file)s': %(error)s\n"
+						"(try --mode=hardlink if the file-system doesn't support reflinks)") % {'file': b, 'error': ex})
 
-			first_loc = first_copy.get(key, None)
-			if first_loc:
-				first_full = os.path.join(impl_dir, *first_loc)
-				new_full = os.path.join(impl_dir, *loc_path)
-				if _already_linked(first_full, new_full):
-					already_linked += size
-				else:
-					_link(first_full, new_full, tmpfile)
-					dup_size += size
+		def finish_batch(batch_impls, groups):
+			# Check groups of possible duplicates (largest first, as they save the most space)
+			progress(_("Comparing %d groups of duplicate files...") % len(groups))
+			items = sorted(groups.items(), key = lambda item: -item[0][3])
+			results = pool.imap_unordered(check, items) if pool else map(check, items)
+			by_dir = {}
+			for key, (first_loc, uniq, already, links) in results:
+				if first_loc != groups[key][0]:
+					dedup_index.set_first_copy(key, first_loc)
+				totals[0] += uniq
+				totals[2] += already
+				for a, b in links:
+					by_dir.setdefault(os.path.dirname(b), []).append((a, b, key[3]))
+
+			if reflink:
+				# The files stay where they are, so the directories don't need to be writable
+				pairs = [pair for dir_pairs in by_dir.values() for pair in dir_pairs]
+				progress(_("Deduping %d files...") % len(pairs))
+				for a, b, size, same in (pool.imap_unordered(dedupe, pairs) if pool else map(dedupe, pairs)):
+					if same:
+						totals[1] += size
+					else:
+						_warn_differ(a, b)
+						totals[0] += size
 			else:
-				first_copy[key] = loc_path
-				uniq_size += size
+				progress(_("Linking duplicates in %d directories...") % len(by_dir))
+				for b_dir, pairs in by_dir.items():
+					_link_dir(b_dir, pairs, tmpfile)
+					totals[1] += sum(size for a, b, size in pairs)
+
+			for impl in batch_impls:
+				dedup_index.add_impl(impl, current[impl])
+			dedup_index.commit()
+
+		total = len(dirs)
+		batch_impls = []
+		batch_files = 0
+		groups = {}		# (type, digest, mtime, size) -> (first location, [new locations])
+		for i, impl in enumerate(dirs):
+			progress(_("[%(done)d / %(total)d] Reading manifests...") % {'done': i, 'total': total})
+
+			manifest_path = os.path.join(impl_dir, impl, '.manifest')
+			try:
+				index = manifestindex.load(os.path.join(impl_dir, impl), save = True)
+			except (EnvironmentError, BadDigest) as ex:
+				logger.warning(_("Failed to read manifest file '%(manifest_path)s': %(exception)s"), {'manifest_path': manifest_path, 'exception': str(ex)})
+				continue
 
-		ms.close()
-	clear()
-	return (uniq_size, dup_size, already_linked, man_size)
+			totals[3] += os.path.getsize(manifest_path)
+
+			with index:
+				for itype, digest, mtime, size, path in index:
+					if itype == 'D':
+						continue
+
+					if itype == 'S':
+						totals[0] += size
+						continue
+
+					if reflink:
+						key = ('F', digest, 0, size)		# Permissions and mtime can differ
+					else:
+						key = (itype, digest, mtime, size)
+					loc_path = (impl, path)
+
+					group = groups.get(key, None)
+					if group is not None:
+						group[1].append(loc_path)
+						continue
+
+					first_loc = dedup_index.get_first_copy(key)
+					if first_loc:
+						groups[key] = (tuple(first_loc), [loc_path])
+					else:
+						# Only the index needs to know about files we haven't seen before
+						dedup_index.set_first_copy(key, loc_path)
+						totals[0] += size
+				batch_files += len(index)
+			batch_impls.append(impl)
+
+			if batch_files >= _BATCH_FILES:
+				finish_batch(batch_impls, groups)
+				batch_impls = []
+				batch_files = 0
+				groups = {}
+		if batch_impls:
+			finish_batch(batch_impls, groups)
+		progress("")
+	finally:
+		if pool is not None:
+			pool.terminate()
+		dedup_index.close()
+	return tuple(totals)
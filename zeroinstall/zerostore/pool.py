@@ -0,0 +1,256 @@
+"""A content-addressed pool of the files in a store.
+
+Many implementations contain identical files (libraries, licences, icons, etc). If a store has
+a pool, each regular file added to the store is also linked into the pool, named by its digest.
+When another implementation with the same file is added later, the file is taken from the pool
+instead of being copied (or, if it was unpacked from an archive, the new copy is replaced by a
+link to the pool's). This saves both disk space and I/O when importing.
+
+Files in the store and the pool are hard-linked where possible. A hard-link shares the
+permissions and modification time too, so when these differ from the pool's copy we try to
+use a reflink instead (on file-systems which support it), which only shares the data.
+
+The pool is optional. To use it, create a directory named like the store with ".pool" on the
+end (e.g. ~/.cache/0install.net/implementations.pool). Files in the pool which are no longer
+used by any implementation have a link count of one, and can be removed using L{ObjectPool.purge}
+(done by "0store optimise").
+
+The pool's files are never written to after being added. However, a pool file could still be
+modified through one of its hard-links, so its contents are checked against its name before it is
+used (this still saves the disk space and the writes of a copy).
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger
+import os, errno
+
+#: The pool for store directory D is D + POOL_SUFFIX
+POOL_SUFFIX = '.pool'
+
+def for_store(store_dir):
+	"""Get the pool for a store, if it has one.
+	@type store_dir: str
+	@rtype: L{ObjectPool} | None"""
+	pool_dir = store_dir.rstrip(os.sep) + POOL_SUFFIX
+	if os.path.isdir(pool_dir):
+		return ObjectPool(pool_dir)
+	return None
+
+def _hash_name(alg):
+	"""Files are named by the hash function, not the manifest algorithm, so that e.g. sha256
+	and sha256new implementations can share files."""
+	return alg.new_digest().name.lower()
+
+class ObjectPool(object):
+	"""A directory of files, each named by the digest of its contents.
+	@ivar dir: the pool directory
+	@type dir: str
+	@ivar shared: the number of files taken from the pool since this object was created
+	@type shared: int
+	@ivar added: the number of files added to the pool since this object was created
+	@type added: int
+	@since: 2.5"""
+
+	def __init__(self, dir):
+		"""@type dir: str"""
+		self.dir = dir
+		self.shared = 0
+		self.added = 0
+
+	def get_path(self, alg, digest):
+		"""The path of the pool's copy of a file (which may not exist).
+		@type alg: L{manifest.Algorithm}
+		@param digest: the hex digest of the file's contents
+		@type digest: str
+		@rtype: str"""
+		return os.path.join(self.dir, _hash_name(alg), digest[:2], digest[2:])
+
+	def _lookup(self, alg, digest, size):
+		path = self.get_path(alg, digest)
+		try:
+			info = os.lstat(path)
+		except OSError:
+			return None, None
+		if info.st_size != size:
+			logger.warning(_("Pool file %(path)s has the wrong size (%(actual)d, not %(expected)d); ignoring it"),
+					{'path': path, 'actual': info.st_size, 'expected': size})
+			return None, None
+		return path, info
+
+	def _check(self, alg, digest, path, pool_path):
+		"""Check that path (the pool file at pool_path, or a link to it) has the expected contents.
+		If not, the pool file is removed, so that a good copy can be added in its place.
+		@rtype: bool"""
+		from zeroinstall.zerostore import manifest
+		try:
+			if manifest._digest_file(alg.new_digest(), path).hexdigest() == digest:
+				return True
+		except EnvironmentError as ex:
+			logger.info(_("Can't read pool file %(path)s: %(error)s"), {'path': path, 'error': ex})
+			return False
+		logger.warning(_("Pool file %s has been modified; removing it"), pool_path)
+		try:
+			os.unlink(pool_path)
+		except OSError as ex:
+			logger.info(_("Can't remove %(path)s: %(error)s"), {'path': pool_path, 'error': ex})
+		return False
+
+	def add(self, alg, digest, path):
+		"""Link a file into the pool, if there isn't already a copy.
+		The caller must have checked that the file's contents have this digest.
+		Failures are logged, but otherwise ignored.
+		@type alg: L{manifest.Algorithm}
+		@type digest: str
+		@param path: the file in the store
+		@type path: str"""
+		pool_path = self.get_path(alg, digest)
+		try:
+			try:
+				os.link(path, pool_path)
+			except OSError as ex:
+				if ex.errno != errno.ENOENT:
+					raise
+				try:
+					os.makedirs(os.path.dirname(pool_path))
+				except OSError as ex:
+					if ex.errno != errno.EEXIST:
+						raise
+				os.link(path, pool_path)
+			self.added += 1
+		except OSError as ex:
+			if ex.errno != errno.EEXIST:
+				logger.info(_("Can't add %(path)s to pool: %(error)s"), {'path': path, 'error': ex})
+
+	def link_into(self, alg, digest, itype, mtime, size, dest, stats = None):
+		"""Create the new file dest using the pool's copy of a file, if there is one.
+		It is hard-linked if the permissions and mtime match, or reflinked otherwise.
+		@type alg: L{manifest.Algorithm}
+		@type digest: str
+		@param itype: the file's type in the manifest ('F' or 'X')
+		@type itype: str
+		@type mtime: int
+		@type size: int
+		@param dest: the file to create (its directory must be writable)
+		@type dest: str
+		@param stats: if given, record the method used here
+		@type stats: L{fastcopy.CopyStats} | None
+		@return: whether dest was created
+		@rtype: bool"""
+		pool_path, info = self._lookup(alg, digest, size)
+		if pool_path is None:
+			return False
+		mode = 0o555 if itype == 'X' else 0o444
+		try:
+			if (info.st_mode & 0o777, int(info.st_mtime)) == (mode, mtime):
+				os.link(pool_path, dest)
+				method = 'pool'
+			else:
+				if not _reflink(pool_path, dest, mode):
+					return False		# Caller can copy from the source instead
+				os.utime(dest, (mtime, mtime))
+				method = 'pool-reflink'
+		except OSError as ex:
+			logger.info(_("Can't use pool file %(path)s: %(error)s"), {'path': pool_path, 'error': ex})
+			if os.path.lexists(dest):
+				os.unlink(dest)
+			return False
+		if not self._check(alg, digest, dest, pool_path):
+			os.unlink(dest)
+			return False
+		self.shared += 1
+		if stats is not None:
+			stats.add(method, size)
+		return True
+
+	def share_tree(self, root, alg):
+		"""Share the files in a newly checked implementation with the pool.
+		Files already in the pool are replaced by hard-links to them (if the permissions and
+		mtime match and the pool's copy is unmodified) or deduped (on file-systems which support
+		it, which compare the contents themselves); other files are added to it.
+		The tree's .manifest (and its index) must be up-to-date.
+		@param root: the implementation (every directory in it is made writable briefly, if needed)
+		@type root: str
+		@type alg: L{manifest.Algorithm}"""
+		from zeroinstall.zerostore import manifestindex, fastcopy
+
+		replace = {}		# Directory -> [(pool file, file)]
+		with manifestindex.load(root) as index:
+			for itype, digest, mtime, size, path in index:
+				if itype not in 'FX': continue
+				full = os.path.join(root, path)
+				pool_path, info = self._lookup(alg, digest, size)
+				if pool_path is None:
+					self.add(alg, digest, full)
+					continue
+				file_info = os.lstat(full)
+				if (info.st_dev, info.st_ino) == (file_info.st_dev, file_info.st_ino):
+					continue
+				if (info.st_mode, int(info.st_mtime)) == (file_info.st_mode, int(file_info.st_mtime)):
+					if self._check(alg, digest, pool_path, pool_path):
+						replace.setdefault(os.path.dirname(full), []).append((pool_path, full))
+					else:
+						self.add(alg, digest, full)
+				elif size:
+					try:
+						with open(pool_path, 'rb') as a:
+							with open(full, 'rb') as b:
+								if fastcopy.dedupe(a.fileno(), b.fileno(), size):
+									self.shared += 1
+					except (OSError, IOError) as ex:
+						logger.debug(_("Can't dedupe %(path)s: %(error)s"), {'path': full, 'error': ex})
+
+		tmpfile = os.path.join(self.dir, 'tmp-link-%d' % os.getpid())
+		for dir, pairs in replace.items():
+			old_mode = os.lstat(dir).st_mode
+			os.chmod(dir, old_mode | 0o200)
+			try:
+				for pool_path, full in pairs:
+					os.link(pool_path, tmpfile)
+					try:
+						os.rename(tmpfile, full)
+					except:
+						os.unlink(tmpfile)
+						raise
+					self.shared += 1
+			finally:
+				os.chmod(dir, old_mode)
+
+	def purge(self):
+		"""Remove files which are no longer used by any implementation.
+		@return: the number of bytes freed
+		@rtype: int"""
+		freed = 0
+		for dirpath, dirnames, filenames in os.walk(self.dir):
+			for name in filenames:
+				path = os.path.join(dirpath, name)
+				info = os.lstat(path)
+				if info.st_nlink == 1:
+					# (if an import links to it at the same time, its copy is unaffected)
+					os.unlink(path)
+					freed += info.st_size
+		return freed
+
+def _reflink(src, dest, mode):
+	"""Create dest as a reflink (copy-on-write clone) of src.
+	@type src: str
+	@type dest: str
+	@type mode: int
+	@return: False if the file-system doesn't support it (and dest wasn't created)
+	@rtype: bool"""
+	from zeroinstall.zerostore import fastcopy
+	src_fd = os.open(src, os.O_RDONLY)
+	try:
+		dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+		try:
+			ok = fastcopy.kernel_copy(src_fd, dest_fd, allowed = ['reflink']) is not None
+		finally:
+			os.close(dest_fd)
+	finally:
+		os.close(src_fd)
+	if ok:
+		os.chmod(dest, mode)		# (umask may have removed some bits)
+	else:
+		os.unlink(dest)
+	return ok
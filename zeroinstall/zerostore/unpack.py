@@ -52,6 +52,10 @@ def _gnu_tar():
 	logger.debug(_("Is GNU tar = %s"), gnu_tar)
 	return gnu_tar
 
+# Extract tar and zip archives using Python's modules (see L{archive}) rather than running tar
+# and unzip, where possible. Starting the external tools costs more than unpacking a small archive.
+_in_process = True
+
 # unicode compat
 if sys.version_info < (3,):
 	def _u(s):
@@ -74,6 +78,99 @@ def recent_gnu_tar():
 	logger.debug(_("Recent GNU tar = %s"), recent_gnu_tar)
 	return recent_gnu_tar
 
+# Multi-threaded decompressors, in order of preference. Each entry is the program and the
+# arguments to make it use several threads. They are all used with "-d -c", or by tar.
+_parallel_decompressors = {
+	'gzip': [('pigz', [])],
+	'bzip2': [('lbzip2', []), ('pbzip2', [])],
+	'xz': [('xz', ['-T0'])],
+}
+
+# Archives smaller than this are quicker to decompress in-process than to start another program for
+_PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+
+_xz_version = None
+def _xz_is_parallel():
+	"""xz only decompresses using several threads since version 5.4.
+	@rtype: bool"""
+	global _xz_version
+	if _xz_version is None:
+		try:
+			child = subprocess.Popen(['xz', '--version'], stdout = subprocess.PIPE,
+						stderr = subprocess.STDOUT, universal_newlines = True)
+			out, unused = child.communicate()
+			version = re.search(r'\s(\d+)\.(\d+)', out)
+			_xz_version = (int(version.group(1)), int(version.group(2))) if version else ()
+		except OSError:
+			_xz_version = ()
+		logger.debug(_("xz version = %s"), _xz_version)
+	return _xz_version >= (5, 4)
+
+def _get_decompressor(decompress):
+	"""Choose a multi-threaded program to decompress data in this format.
+	$ZEROINSTALL_DECOMPRESSORS can be "none" to disable them, or a comma-separated list of
+	FORMAT=COMMAND settings to use a particular command for a format (or "FORMAT=none" to
+	disable them for that format), e.g. "bzip2=pbzip2 -p4,xz=none". Otherwise, the first
+	of L{_parallel_decompressors} found in $PATH is used.
+	@param decompress: the compression (as for L{extract_tar})
+	@type decompress: str | None
+	@return: the command (without "-d -c"), or None to use the usual single-threaded method
+	@rtype: [str] | None"""
+	if decompress is None:
+		return None
+	setting = os.environ.get('ZEROINSTALL_DECOMPRESSORS', '').strip()
+	if setting == 'none':
+		return None
+	if setting:
+		import shlex
+		for item in setting.split(','):
+			if '=' not in item:
+				logger.warning(_("Invalid entry '%s' in $ZEROINSTALL_DECOMPRESSORS (should be FORMAT=COMMAND)"), item)
+				continue
+			name, command = item.split('=', 1)
+			if name.strip() == decompress:
+				command = shlex.split(command)
+				if command in ([], ['none']):
+					return None
+				logger.debug(_("Using %(command)s for %(format)s, from $ZEROINSTALL_DECOMPRESSORS"), {'command': command, 'format': decompress})
+				return command
+	for prog, args in _parallel_decompressors.get(decompress, []):
+		path = find_in_path(prog)
+		if path and (prog != 'xz' or _xz_is_parallel()):
+			return [path] + args
+	return None
+
+def _use_parallel(stream, start_offset):
+	"""Is this archive big enough to be worth decompressing with a separate process? It must
+	be a real file too, so that the process can read it.
+	@rtype: bool"""
+	try:
+		return os.fstat(stream.fileno()).st_size - start_offset >= _PARALLEL_MIN_SIZE
+	except (AttributeError, EnvironmentError, ValueError):
+		return False		# e.g. a L{archive.FileSlice}
+
+def _extract_piped(stream, destdir, extract, command, start_offset, alg, digests):
+	"""Decompress stream with command, and extract the resulting tar archive in-process.
+	@type command: [str]"""
+	from zeroinstall.zerostore import archive
+	stream.seek(start_offset)
+	child = subprocess.Popen(command + ['-d', '-c'], stdin = stream, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	try:
+		archive.extract_members(archive.tar_members(child.stdout, None), destdir, extract, alg, digests)
+		while child.stdout.read(64 * 1024):
+			pass		# (tar stops at the end-of-archive marker; let the decompressor finish)
+	except:
+		child.kill()
+		child.wait()
+		raise
+	finally:
+		child.stdout.close()
+	cerr = child.stderr.read()
+	child.stderr.close()
+	status = child.wait()
+	if status != 0:
+		raise SafeException(_('Failed to extract archive (using %(command)s); exit code %(status)d:\n%(err)s') % {'command': command, 'status': status, 'err': cerr.strip()})
+
 # Disabled, as Plash does not currently support fchmod(2).
 _pola_run = None
 #_pola_run = find_in_path('pola-run')
@@ -104,6 +201,15 @@ def type_from_url(url):
 	if url.endswith('.gem'): return 'application/x-ruby-gem'
 	return None
 
+# The compression used by each type of tar archive
+_tar_compression = {
+	'application/x-tar': None,
+	'application/x-compressed-tar': 'gzip',
+	'application/x-bzip-compressed-tar': 'bzip2',
+	'application/x-lzma-compressed-tar': 'lzma',
+	'application/x-xz-compressed-tar': 'xz',
+}
+
 def check_type_ok(mime_type):
 	"""Check we have the needed software to extract from an archive of the given type.
 	@type mime_type: str
@@ -115,14 +221,11 @@ def check_type_ok(mime_type):
 					"I need to extract it. Install the 'rpm' package first (this works even if "
 					"you're on a non-RPM-based distribution such as Debian)."))
 	elif mime_type == 'application/x-deb':
-		if not find_in_path('ar'):
-			raise SafeException(_("This package looks like a Debian package, but you don't have the 'ar' command "
-					"I need to extract it. Install the package containing it (sometimes called 'binutils') "
-					"first. This works even if you're on a non-Debian-based distribution such as Red Hat)."))
+		pass	# We read the ar archive ourselves
 	elif mime_type == 'application/x-bzip-compressed-tar':
 		pass	# We'll fall back to Python's built-in tar.bz2 support
 	elif mime_type == 'application/zip':
-		if not find_in_path('unzip'):
+		if not _in_process and not find_in_path('unzip'):
 			raise SafeException(_("This package looks like a zip-compressed archive, but you don't have the 'unzip' command "
 					"I need to extract it. Install the package containing it first."))
 	elif mime_type == 'application/vnd.ms-cab-compressed':
@@ -136,7 +239,8 @@ def check_type_ok(mime_type):
 	elif mime_type == 'application/x-lzma-compressed-tar':
 		pass	# We can get it through Zero Install
 	elif mime_type == 'application/x-xz-compressed-tar':
-		if not find_in_path('unxz'):
+		from zeroinstall.zerostore import archive
+		if not (_in_process and archive.can_read('xz')) and not find_in_path('unxz'):
 			raise SafeException(_("This package looks like a xz-compressed package, but you don't have the 'unxz' command "
 					"I need to extract it. Install the package containing it (it's probably called 'xz-utils') "
 					"first."))
@@ -146,6 +250,24 @@ def check_type_ok(mime_type):
 		from zeroinstall import version
 		raise SafeException(_("Unsupported archive type '%(type)s' (for injector version %(version)s)") % {'type': mime_type, 'version': version})
 
+def _stream_path(stream, start_offset):
+	"""If the archive is the whole of a named file, get its path, so that tools which can't read
+	stdin can use it directly instead of a copy.
+	@type stream: file
+	@type start_offset: int
+	@rtype: str | None"""
+	name = getattr(stream, 'name', None)
+	if start_offset or name is None or isinstance(name, int):
+		return None
+	try:
+		info = os.stat(name)
+		stream_info = os.fstat(stream.fileno())
+	except (OSError, TypeError, AttributeError, ValueError):
+		return None		# e.g. "<fdopen>"
+	if (info.st_dev, info.st_ino) != (stream_info.st_dev, stream_info.st_ino):
+		return None
+	return os.path.abspath(name)
+
 def _exec_maybe_sandboxed(writable, prog, *args):
 	"""execlp prog, with (only) the 'writable' directory writable if sandboxing is available.
 	If no sandbox is available, run without a sandbox."""
@@ -161,7 +283,7 @@ def _exec_maybe_sandboxed(writable, prog, *args):
 		pola_args += ['-fw', writable]
 	os.execl(_pola_run, _pola_run, *pola_args)
 
-def unpack_archive(url, data, destdir, extract = None, type = None, start_offset = 0):
+def unpack_archive(url, data, destdir, extract = None, type = None, start_offset = 0, alg = None, digests = None):
 	"""Unpack stream 'data' into directory 'destdir'. If extract is given, extract just
 	that sub-directory from the archive (i.e. destdir/extract will exist afterwards).
 	Works out the format from the name.
@@ -170,74 +292,109 @@ def unpack_archive(url, data, destdir, extract = None, type = None, start_offset
 	@type destdir: str
 	@type extract: str | None
 	@type type: str | None
-	@type start_offset: int"""
+	@type start_offset: int
+	@param alg: if given, files extracted in-process are hashed as they are written (since 2.5)
+	@type alg: L{manifest.Algorithm} | None
+	@param digests: the hex digests of the files hashed using alg are stored here, indexed by path (since 2.5)
+	@type digests: {str: str} | None"""
 	if type is None: type = type_from_url(url)
 	if type is None: raise SafeException(_("Unknown extension (and no MIME type given) in '%s'") % url)
 	if type == 'application/x-bzip-compressed-tar':
-		extract_tar(data, destdir, extract, 'bzip2', start_offset)
+		extract_tar(data, destdir, extract, 'bzip2', start_offset, alg, digests)
 	elif type == 'application/x-deb':
-		extract_deb(data, destdir, extract, start_offset)
+		extract_deb(data, destdir, extract, start_offset, alg, digests)
 	elif type == 'application/x-rpm':
 		extract_rpm(data, destdir, extract, start_offset)
 	elif type == 'application/zip':
-		extract_zip(data, destdir, extract, start_offset)
+		extract_zip(data, destdir, extract, start_offset, alg, digests)
 	elif type == 'application/x-tar':
-		extract_tar(data, destdir, extract, None, start_offset)
+		extract_tar(data, destdir, extract, None, start_offset, alg, digests)
 	elif type == 'application/x-lzma-compressed-tar':
-		extract_tar(data, destdir, extract, 'lzma', start_offset)
+		extract_tar(data, destdir, extract, 'lzma', start_offset, alg, digests)
 	elif type == 'application/x-xz-compressed-tar':
-		extract_tar(data, destdir, extract, 'xz', start_offset)
+		extract_tar(data, destdir, extract, 'xz', start_offset, alg, digests)
 	elif type == 'application/x-compressed-tar':
-		extract_tar(data, destdir, extract, 'gzip', start_offset)
+		extract_tar(data, destdir, extract, 'gzip', start_offset, alg, digests)
 	elif type == 'application/vnd.ms-cab-compressed':
 		extract_cab(data, destdir, extract, start_offset)
 	elif type == 'application/x-apple-diskimage':
 		extract_dmg(data, destdir, extract, start_offset)
 	elif type == 'application/x-ruby-gem':
-		extract_gem(data, destdir, extract, start_offset)
+		extract_gem(data, destdir, extract, start_offset, alg, digests)
 	else:
 		raise SafeException(_('Unknown MIME type "%(type)s" for "%(url)s"') % {'type': type, 'url': url})
 
-def extract_deb(stream, destdir, extract = None, start_offset = 0):
+def generate_manifest(url, data, alg, extract = None, type = None, start_offset = 0):
+	"""Generate the manifest of an archive's contents (or of its 'extract' sub-directory) by
+	reading the archive directly, if that's possible for this type of archive and algorithm.
+	This gives the same result as unpacking it with L{unpack_archive} and generating the
+	manifest of the directory, but nothing is written to disk.
+	@type url: str
+	@type data: file
+	@type alg: L{manifest.Algorithm}
+	@type extract: str | None
+	@type type: str | None
+	@type start_offset: int
+	@return: the lines of the manifest, or None if the archive must be unpacked instead
+	@rtype: [str] | None
+	@since: 2.5"""
+	from zeroinstall.zerostore import archive, manifest
+	if type is None: type = type_from_url(url)
+	if type is None: raise SafeException(_("Unknown extension (and no MIME type given) in '%s'") % url)
+	if not _in_process or isinstance(alg, manifest.OldSHA1):
+		return None
+	if extract:
+		if not re.match('^[a-zA-Z0-9][- _a-zA-Z0-9.]*$', extract):
+			raise SafeException(_('Illegal character in extract attribute'))
+	if type == 'application/zip':
+		members = archive.zip_members(data, start_offset)
+	else:
+		decompress = _tar_compression.get(type, False)
+		if decompress is False or not archive.can_read(decompress):
+			return None
+		data.seek(start_offset)
+		members = archive.tar_members(data, decompress)
+	return archive.generate_manifest(members, alg, extract)
+
+def extract_deb(stream, destdir, extract = None, start_offset = 0, alg = None, digests = None):
 	"""@type stream: file
 	@type destdir: str
-	@type start_offset: int"""
+	@type start_offset: int
+	@param alg: see L{unpack_archive} (since 2.5)
+	@param digests: see L{unpack_archive} (since 2.5)"""
 	if extract:
 		raise SafeException(_('Sorry, but the "extract" attribute is not yet supported for Debs'))
 
+	from zeroinstall.zerostore import archive
 	stream.seek(start_offset)
-	# ar can't read from stdin, so make a copy...
-	deb_copy_name = os.path.join(destdir, 'archive.deb')
-	with open(deb_copy_name, 'wb') as deb_copy:
-		shutil.copyfileobj(stream, deb_copy)
-
-	data_tar = None
-	p = subprocess.Popen(('ar', 't', 'archive.deb'), stdout=subprocess.PIPE, cwd=destdir, universal_newlines=True)
-	o = p.communicate()[0]
-	for line in o.split('\n'):
-		if line == 'data.tar':
+	for name, offset, size in archive.ar_members(stream):
+		if name == 'data.tar':
 			data_compression = None
-		elif line == 'data.tar.gz':
+		elif name == 'data.tar.gz':
 			data_compression = 'gzip'
-		elif line == 'data.tar.bz2':
+		elif name == 'data.tar.bz2':
 			data_compression = 'bzip2'
-		elif line == 'data.tar.lzma':
+		elif name == 'data.tar.lzma':
 			data_compression = 'lzma'
-		elif line == 'data.tar.xz':
+		elif name == 'data.tar.xz':
 			data_compression = 'xz'
 		else:
 			continue
-		data_tar = line
 		break
 	else:
 		raise SafeException(_("File is not a Debian package."))
 
-	_extract(stream, destdir, ('ar', 'x', 'archive.deb', data_tar))
-	os.unlink(deb_copy_name)
-	data_name = os.path.join(destdir, data_tar)
-	with open(data_name, 'rb') as data_stream:
-		os.unlink(data_name)
-		extract_tar(data_stream, destdir, None, data_compression)
+	data_stream = archive.FileSlice(stream, offset, size)
+	if _in_process and archive.can_read(data_compression):
+		extract_tar(data_stream, destdir, None, data_compression, alg = alg, digests = digests)
+	else:
+		# The external tools need a real file to read
+		data_name = os.path.join(destdir, name)
+		with open(data_name, 'wb') as data_copy:
+			shutil.copyfileobj(data_stream, data_copy)
+		with open(data_name, 'rb') as data_copy:
+			os.unlink(data_name)
+			extract_tar(data_copy, destdir, None, data_compression, alg = alg, digests = digests)
 
 def extract_rpm(stream, destdir, extract = None, start_offset = 0):
 	if extract:
@@ -278,10 +435,12 @@ def extract_rpm(stream, destdir, extract = None, start_offset = 0):
 			os.close(fd)
 		os.unlink(cpiopath)
 
-def extract_gem(stream, destdir, extract = None, start_offset = 0):
+def extract_gem(stream, destdir, extract = None, start_offset = 0, alg = None, digests = None):
 	"""@type stream: file
 	@type destdir: str
 	@type start_offset: int
+	@param alg: see L{unpack_archive} (since 2.5)
+	@param digests: see L{unpack_archive} (since 2.5)
 	@since: 0.53"""
 	stream.seek(start_offset)
 	payload = 'data.tar.gz'
@@ -290,7 +449,7 @@ def extract_gem(stream, destdir, extract = None, start_offset = 0):
 	try:
 		extract_tar(stream, destdir=tmpdir, extract=payload, decompress=None)
 		with open(os.path.join(tmpdir, payload), 'rb') as payload_stream:
-			extract_tar(payload_stream, destdir=destdir, extract=extract, decompress='gzip')
+			extract_tar(payload_stream, destdir=destdir, extract=extract, decompress='gzip', alg=alg, digests=digests)
 	finally:
 		if payload_stream:
 			payload_stream.close()
@@ -301,66 +460,90 @@ def extract_cab(stream, destdir, extract, start_offset = 0):
 	if extract:
 		raise SafeException(_('Sorry, but the "extract" attribute is not yet supported for Cabinet files'))
 
-	stream.seek(start_offset)
-	# cabextract can't read from stdin, so make a copy...
-	cab_copy_name = os.path.join(destdir, 'archive.cab')
-	cab_copy = open(cab_copy_name, 'wb')
-	shutil.copyfileobj(stream, cab_copy)
-	cab_copy.close()
+	cab_path = _stream_path(stream, start_offset)
+	if cab_path is None:
+		stream.seek(start_offset)
+		# cabextract can't read from stdin, so make a copy...
+		cab_copy_name = os.path.join(destdir, 'archive.cab')
+		cab_copy = open(cab_copy_name, 'wb')
+		shutil.copyfileobj(stream, cab_copy)
+		cab_copy.close()
+	else:
+		cab_copy_name = None
 
-	_extract(stream, destdir, ['cabextract', '-s', '-q', 'archive.cab'])
-	os.unlink(cab_copy_name)
+	_extract(stream, destdir, ['cabextract', '-s', '-q', cab_path or 'archive.cab'])
+	if cab_copy_name:
+		os.unlink(cab_copy_name)
 
 def extract_dmg(stream, destdir, extract, start_offset = 0):
 	"""@since: 0.46"""
 	if extract:
 		raise SafeException(_('Sorry, but the "extract" attribute is not yet supported for DMGs'))
 
-	stream.seek(start_offset)
-	# hdiutil can't read from stdin, so make a copy...
-	dmg_copy_name = os.path.join(destdir, 'archive.dmg')
-	dmg_copy = open(dmg_copy_name, 'wb')
-	shutil.copyfileobj(stream, dmg_copy)
-	dmg_copy.close()
+	dmg_path = _stream_path(stream, start_offset)
+	if dmg_path is None:
+		stream.seek(start_offset)
+		# hdiutil can't read from stdin, so make a copy...
+		dmg_path = dmg_copy_name = os.path.join(destdir, 'archive.dmg')
+		dmg_copy = open(dmg_copy_name, 'wb')
+		shutil.copyfileobj(stream, dmg_copy)
+		dmg_copy.close()
+	else:
+		dmg_copy_name = None
 
 	mountpoint = mkdtemp(prefix='archive')
-	subprocess.check_call(["hdiutil", "attach", "-quiet", "-mountpoint", mountpoint, "-nobrowse", dmg_copy_name])
+	subprocess.check_call(["hdiutil", "attach", "-quiet", "-mountpoint", mountpoint, "-nobrowse", dmg_path])
 	subprocess.check_call(["cp", "-pR"] + glob.glob("%s/*" % mountpoint) + [destdir])
 	subprocess.check_call(["hdiutil", "detach", "-quiet", mountpoint])
 	os.rmdir(mountpoint)
-	os.unlink(dmg_copy_name)
+	if dmg_copy_name:
+		os.unlink(dmg_copy_name)
 
-def extract_zip(stream, destdir, extract, start_offset = 0):
+def extract_zip(stream, destdir, extract, start_offset = 0, alg = None, digests = None):
 	"""@type stream: file
 	@type destdir: str
 	@type extract: str
-	@type start_offset: int"""
+	@type start_offset: int
+	@param alg: see L{unpack_archive} (since 2.5)
+	@param digests: see L{unpack_archive} (since 2.5)"""
 	if extract:
 		# Limit the characters we accept, to avoid sending dodgy
 		# strings to zip
 		if not re.match('^[a-zA-Z0-9][- _a-zA-Z0-9.]*$', extract):
 			raise SafeException(_('Illegal character in extract attribute'))
 
-	stream.seek(start_offset)
-	# unzip can't read from stdin, so make a copy...
-	zip_copy_name = os.path.join(destdir, 'archive.zip')
-	with open(zip_copy_name, 'wb') as zip_copy:
-		shutil.copyfileobj(stream, zip_copy)
+	if _in_process:
+		from zeroinstall.zerostore import archive
+		archive.extract_members(archive.zip_members(stream, start_offset), destdir, extract, alg, digests)
+		return
+
+	zip_path = _stream_path(stream, start_offset)
+	if zip_path is None:
+		stream.seek(start_offset)
+		# unzip can't read from stdin, so make a copy...
+		zip_copy_name = os.path.join(destdir, 'archive.zip')
+		with open(zip_copy_name, 'wb') as zip_copy:
+			shutil.copyfileobj(stream, zip_copy)
+	else:
+		zip_copy_name = None
 
-	args = ['unzip', '-q', '-o', 'archive.zip']
+	args = ['unzip', '-q', '-o', zip_path or 'archive.zip']
 
 	if extract:
 		args.append(extract + '/*')
 
 	_extract(stream, destdir, args)
-	os.unlink(zip_copy_name)
+	if zip_copy_name:
+		os.unlink(zip_copy_name)
 
-def extract_tar(stream, destdir, extract, decompress, start_offset = 0):
+def extract_tar(stream, destdir, extract, decompress, start_offset = 0, alg = None, digests = None):
 	"""@type stream: file
 	@type destdir: str
 	@type extract: str
 	@type decompress: str
-	@type start_offset: int"""
+	@type start_offset: int
+	@param alg: see L{unpack_archive} (since 2.5)
+	@param digests: see L{unpack_archive} (since 2.5)"""
 	if extract:
 		# Limit the characters we accept, to avoid sending dodgy
 		# strings to tar
@@ -369,9 +552,25 @@ def extract_tar(stream, destdir, extract, decompress, start_offset = 0):
 
 	assert decompress in [None, 'bzip2', 'gzip', 'lzma', 'xz']
 
-	if _gnu_tar():
+	from zeroinstall.zerostore import archive
+
+	if _in_process and archive.can_read(decompress):
+		decompressor = _get_decompressor(decompress) if _use_parallel(stream, start_offset) else None
+		if decompressor:
+			logger.debug(_("Decompressing %(format)s archive with %(command)s"), {'format': decompress, 'command': decompressor})
+			_extract_piped(stream, destdir, extract, decompressor, start_offset, alg, digests)
+		else:
+			if decompress:
+				logger.debug(_("Decompressing %s archive in-process"), decompress)
+			stream.seek(start_offset)
+			archive.extract_members(archive.tar_members(stream, decompress), destdir, extract, alg, digests)
+	elif _gnu_tar():
 		ext_cmd = ['tar']
-		if decompress:
+		decompressor = _get_decompressor(decompress)
+		if decompressor:
+			logger.debug(_("Decompressing %(format)s archive with %(command)s"), {'format': decompress, 'command': decompressor})
+			ext_cmd.append('--use-compress-program=' + ' '.join(decompressor))
+		elif decompress:
 			if decompress == 'bzip2':
 				ext_cmd.append('--bzip2')
 			elif decompress == 'gzip':
@@ -399,93 +598,29 @@ def extract_tar(stream, destdir, extract, decompress, start_offset = 0):
 	else:
 		import tempfile
 
-		# Since we don't have GNU tar, use python's tarfile module. This will probably
-		# be a lot slower and we do not support lzma and xz; however, it is portable.
-		# (lzma and xz are handled by first uncompressing stream to a temporary file.
-		# this is simple to do, but less efficient than piping through the program)
-		if decompress is None:
-			rmode = 'r|'
-		elif decompress == 'bzip2':
-			rmode = 'r|bz2'
-		elif decompress == 'gzip':
-			rmode = 'r|gz'
-		elif decompress == 'lzma':
+		# No GNU tar, and Python can't decompress this itself (lzma and xz need Python 3.3).
+		# Uncompress stream to a temporary file first and read that. This is simple to do,
+		# but less efficient than piping through the program.
+		stream.seek(start_offset)
+		if decompress == 'lzma':
 			unlzma = find_in_path('unlzma')
 			if not unlzma:
 				unlzma = os.path.abspath(os.path.join(os.path.dirname(__file__), '_unlzma'))
 			temp = tempfile.NamedTemporaryFile(suffix='.tar', mode='w+b')
 			subprocess.check_call([unlzma], stdin=stream, stdout=temp)
-			rmode = 'r|'
-			stream = temp
 		elif decompress == 'xz':
 			unxz = find_in_path('unxz')
 			if not unxz:
 				unxz = os.path.abspath(os.path.join(os.path.dirname(__file__), '_unxz'))
 			temp = tempfile.NamedTemporaryFile(suffix='.tar', mode='w+b')
 			subprocess.check_call([unxz], stdin=stream, stdout=temp)
-			rmode = 'r|'
-			stream = temp
 		else:
 			raise SafeException(_('GNU tar unavailable; unsupported compression format: %s') % decompress)
 
-		import tarfile
+		with temp:
+			temp.seek(0)
+			archive.extract_members(archive.tar_members(temp, None), destdir, extract, alg, digests)
 
-		stream.seek(start_offset)
-		# Python 2.5.1 crashes if name is None; see Python bug #1706850
-		tar = tarfile.open(name = '', mode = rmode, fileobj = stream)
-
-		current_umask = os.umask(0)
-		os.umask(current_umask)
-
-		uid = gid = None
-		try:
-			uid = os.geteuid()
-			gid = os.getegid()
-		except:
-			logger.debug(_("Can't get uid/gid"))
-
-		def chmod_extract(tarinfo):
-			# If any X bit is set, they all must be
-			if tarinfo.mode & 0o111:
-				tarinfo.mode |= 0o111
-
-			# Everyone gets read and write (subject to the umask)
-			# No special bits are allowed.
-			tarinfo.mode = ((tarinfo.mode | 0o666) & ~current_umask) & 0o777
-
-			# Don't change owner, even if run as root
-			if uid:
-				tarinfo.uid = uid
-			if gid:
-				tarinfo.gid = gid
-			tar.extract(tarinfo, destdir)
-
-		extracted_anything = False
-		ext_dirs = []
-
-		for tarinfo in tar:
-			name = _u(tarinfo.name)
-			if extract is None or \
-			   name.startswith(extract + '/') or \
-			   name == extract:
-				if tarinfo.isdir():
-					ext_dirs.append(tarinfo)
-
-				chmod_extract(tarinfo)
-				extracted_anything = True
-
-		# Due to a bug in tarfile (python versions < 2.5), we have to manually
-		# set the mtime of each directory that we extract after extracting everything.
-
-		for tarinfo in ext_dirs:
-			dirname = os.path.join(destdir, tarinfo.name)
-			os.utime(dirname, (tarinfo.mtime, tarinfo.mtime))
-
-		tar.close()
-
-		if extract and not extracted_anything:
-			raise SafeException(_('Unable to find specified file = %s in archive') % extract)
-	
 def _extract(stream, destdir, command, start_offset = 0):
 	"""Run execvp('command') inside destdir in a child process, with
 	stream seeked to 'start_offset' as stdin.
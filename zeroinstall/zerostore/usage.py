@@ -0,0 +1,164 @@
+"""Recording when implementations were last used.
+
+Many stores are on file-systems mounted with "noatime", and implementation directories are
+read-only, so the file-system can't tell us which implementations are still in use. Instead,
+the implementations are noted in a log each time a program is run from the cache, which
+"0store gc" and "0store list --usage" read. Merely finding an implementation in a store
+(e.g. for "0store find" or "0store audit") isn't a use.
+
+The log is a text file in the cache directory with a line "TIME DIGEST" for each use. Uses are
+collected in memory and appended in a single write when the process exits (or when enough have
+been collected), so recording a use costs almost nothing. Writes are opened in append mode, so
+concurrent processes don't corrupt each other's records. When the log gets large, it is
+compacted to a single line per digest.
+
+The log is only a hint: a record appended while another process is compacting the log may be
+lost, and nothing is recorded if the cache directory isn't writable.
+"""
+
+# Copyright (C) 2026, Zero Install contributors
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, logger
+from zeroinstall.support import basedir, portable_rename
+from zeroinstall.injector import namespaces
+import os, time
+
+#: The name of the log file, in ~/.cache/0install.net/injector
+LOG_NAME = 'usage-log'
+
+# Write the buffer out when it has this many entries, even if we're not exiting yet
+_MAX_PENDING = 1000
+
+# Compact the log when it is larger than this
+_COMPACT_SIZE = 256 * 1024
+
+class UsageLog(object):
+	"""The log of when each implementation was last used.
+	@ivar path: the log file
+	@type path: str
+	@since: 2.5"""
+
+	def __init__(self, path = None):
+		"""@param path: the log file (default: ~/.cache/0install.net/injector/usage-log)
+		@type path: str | None"""
+		if path is None:
+			path = os.path.join(basedir.save_cache_path(namespaces.config_site, namespaces.config_prog), LOG_NAME)
+		self.path = path
+		self._pending = {}		# Digest -> time
+
+	def record(self, digests, when = None):
+		"""Note that these implementations were used. This is only written to the log by L{flush}.
+		@param digests: the names of the implementations' directories
+		@type digests: [str]
+		@param when: the time they were used (default: now)
+		@type when: float | None"""
+		if when is None:
+			when = time.time()
+		for digest in digests:
+			self._pending[digest] = when
+		if len(self._pending) >= _MAX_PENDING:
+			self.flush()
+
+	def flush(self):
+		"""Append any pending records to the log, compacting it if it's getting large.
+		Errors are logged, but otherwise ignored."""
+		if not self._pending: return
+		data = ''.join('%d %s\n' % (when, digest) for digest, when in sorted(self._pending.items()))
+		self._pending = {}
+		try:
+			fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+			try:
+				os.write(fd, data.encode('utf-8'))		# (a single write, so it isn't interleaved with others)
+				size = os.fstat(fd).st_size
+			finally:
+				os.close(fd)
+			if size > _COMPACT_SIZE:
+				self.compact()
+		except EnvironmentError as ex:
+			logger.info(_("Failed to update usage log %(path)s: %(error)s"), {'path': self.path, 'error': ex})
+
+	def _read(self, stream, last_used):
+		for line in iter(stream.readline, b''):		# (not "for line in stream"; we may read the rest later)
+			try:
+				if not line.endswith(b'\n'): raise ValueError(line)
+				when, digest = line.decode('utf-8')[:-1].split(' ')
+				when = float(when)
+			except ValueError:
+				continue		# Truncated by a crash?
+			if when > last_used.get(digest, 0):
+				last_used[digest] = when
+
+	def load(self):
+		"""Read the log (including any unflushed records).
+		@return: the last time each implementation was used
+		@rtype: {str: float}"""
+		last_used = {}
+		try:
+			with open(self.path, 'rb') as stream:
+				self._read(stream, last_used)
+		except EnvironmentError as ex:
+			if os.path.exists(self.path):
+				logger.warning(_("Failed to read usage log %(path)s: %(error)s"), {'path': self.path, 'error': ex})
+		for digest, when in self._pending.items():
+			if when > last_used.get(digest, 0):
+				last_used[digest] = when
+		return last_used
+
+	def _rewrite(self, last_used, tail = None):
+		import tempfile
+		tmp = tempfile.NamedTemporaryFile(mode = 'wb', dir = os.path.dirname(self.path), prefix = LOG_NAME + '-', delete = False)
+		try:
+			tmp.write(''.join('%d %s\n' % (when, digest) for digest, when in sorted(last_used.items())).encode('utf-8'))
+			if tail is not None:
+				tmp.write(tail.read())		# Anything appended since we read it
+			tmp.close()
+			portable_rename(tmp.name, self.path)
+		except:
+			tmp.close()
+			os.unlink(tmp.name)
+			raise
+
+	def compact(self):
+		"""Rewrite the log with just the most recent use of each implementation."""
+		last_used = {}
+		with open(self.path, 'rb') as stream:
+			self._read(stream, last_used)
+			self._rewrite(last_used, stream)
+		logger.info(_("Compacted usage log %(path)s (%(n)d implementations)"), {'path': self.path, 'n': len(last_used)})
+
+	def forget(self, digests):
+		"""Remove the records for implementations which are no longer stored.
+		Errors are logged, but otherwise ignored.
+		@type digests: [str]"""
+		self.flush()
+		if not os.path.exists(self.path): return
+		last_used = {}
+		try:
+			with open(self.path, 'rb') as stream:
+				self._read(stream, last_used)
+				for digest in digests:
+					last_used.pop(digest, None)
+				self._rewrite(last_used, stream)
+		except EnvironmentError as ex:
+			logger.info(_("Failed to update usage log %(path)s: %(error)s"), {'path': self.path, 'error': ex})
+
+_log = None
+
+def get_log():
+	"""Get the log for this process. Pending records are written when the process exits.
+	@rtype: L{UsageLog}"""
+	global _log
+	if _log is None:
+		import atexit
+		_log = UsageLog()
+		atexit.register(_log.flush)
+	return _log
+
+def record(digests):
+	"""Note that these implementations were just used (see L{UsageLog.record}).
+	@type digests: [str]"""
+	try:
+		get_log().record(digests)
+	except EnvironmentError as ex:
+		logger.info(_("Can't record usage: %s"), ex)